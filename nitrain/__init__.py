@@ -1,7 +1,8 @@
 __version__ = "0.3.1"
 
 from .datasets import Dataset, GoogleCloudDataset, fetch_data
-from .explainers import OcclusionExplainer
+from .explainers import (OcclusionExplainer, GradientExplainer,
+                         SmoothGradExplainer, IntegratedGradientsExplainer)
 from .loaders import Loader
 from .trainers import Trainer
 from .models import (fetch_architecture, list_architectures, fetch_pretrained)
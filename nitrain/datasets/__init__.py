@@ -2,5 +2,6 @@
 
 from .dataset import Dataset
 from .google_cloud import GoogleCloudDataset
+from .metadata import MetadataIndex
 
 from .utils import fetch_data
\ No newline at end of file
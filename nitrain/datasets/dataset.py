@@ -43,6 +43,32 @@ class Dataset:
         self.inputs = inputs
         self.outputs = outputs
         self.transforms = transforms
+        self.metadata = None
+
+    def scan_metadata(self, path=None, num_workers=8):
+        """
+        Read the headers (shape, spacing, origin, direction, pixel type) of all
+        image files of the dataset in parallel threads, without reading the
+        voxels. The result is stored in `dataset.metadata`, where loaders look
+        up image shapes instead of reading the files.
+        
+        If `path` is given, the index is saved there as a `.npz` file and the
+        rows of files that did not change are reused on the next scan.
+        
+        Examples
+        --------
+        >>> dataset = nt.Dataset(readers.ImageReader('sub-*/anat/*_T1w.nii.gz'),
+        ...                      readers.ColumnReader('participants.tsv', 'age'))
+        >>> index = dataset.scan_metadata('~/metadata.npz')
+        >>> index['spacing']
+        """
+        from .metadata import scan_metadata, image_paths
+        
+        if path is not None:
+            path = os.path.expanduser(path)
+        paths = image_paths(self.inputs) + image_paths(self.outputs)
+        self.metadata = scan_metadata(paths, cache=path, num_workers=num_workers)
+        return self.metadata
 
     def select(self, n, random=False):
         """
@@ -125,6 +151,9 @@ class Dataset:
         if isinstance(idx, slice):
             idx = list(range(idx.stop)[idx])
             is_slice = True
+        elif isinstance(idx, (list, np.ndarray)):
+            idx = [int(i) for i in idx]
+            is_slice = True
         else:
             idx = [idx]
             is_slice = False
@@ -40,6 +40,7 @@ class GoogleCloudDataset(Dataset):
         self.inputs = inputs
         self.outputs = outputs
         self.transforms = transforms
+        self.metadata = None
     
     def __repr__(self):
         s = 'GoogleCloudDataset (n={})\n'.format(len(self))
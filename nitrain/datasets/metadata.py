@@ -0,0 +1,270 @@
+"""
+Read image metadata (shape, spacing, ...) from file headers only,
+without decoding the voxels.
+"""
+import os
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import ants
+
+__all__ = ['MetadataIndex',
+           'read_header',
+           'scan_headers',
+           'record_shapes',
+           'record_headers']
+
+# the columns of a metadata index with one value per image
+COLUMNS = ('path', 'mtime', 'size', 'ndim', 'shape', 'spacing', 'origin',
+           'direction', 'orientation', 'components', 'pixeltype')
+
+
+def read_header(path):
+    """
+    Read the shape, spacing, origin, direction, number of components and
+    pixel type of an image file from its header. The headers of recently
+    read files are cached until the files change.
+
+    Examples
+    --------
+    >>> from nitrain.datasets.metadata import read_header
+    >>> read_header(ants.get_data('mni'))['shape']
+    (182, 218, 182)
+    """
+    stat = os.stat(path)
+    # a copy, so callers cannot change the cached header
+    return dict(cached_header(os.path.abspath(path), stat.st_mtime_ns, stat.st_size))
+
+
+@lru_cache(maxsize=2**16)
+def cached_header(path, mtime, size):
+    """
+    Read the header of a file, cached by (path, mtime, size) so a file that
+    is written again is read again.
+    """
+    info = ants.image_header_info(path)
+    direction = np.asarray(info['direction'], dtype='float64')
+    return {'shape': tuple(int(d) for d in info['dimensions']),
+            'spacing': tuple(float(s) for s in info['spacing']),
+            'origin': tuple(float(o) for o in info['origin']),
+            'direction': tuple(direction.flatten().tolist()),
+            'orientation': orientation(direction),
+            'components': int(info['nComponents']),
+            'pixeltype': info['pixeltype'],
+            'mtime': mtime,
+            'size': size}
+
+
+def scan_headers(paths, num_workers=8):
+    """
+    Read the headers of many image files in parallel threads.
+    """
+    if num_workers > 1 and len(paths) > 1:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            return list(executor.map(read_header, paths))
+    return [read_header(path) for path in paths]
+
+
+def orientation(direction):
+    """
+    Get the orientation code of a direction matrix, e.g. 'RAI' for the
+    identity, in the convention of `ants.get_orientation`.
+    """
+    direction = np.asarray(direction)
+    if direction.shape != (3, 3):
+        return ''
+    letters = [('R', 'L'), ('A', 'P'), ('I', 'S')]
+    code = ''
+    for j in range(3):
+        i = int(np.argmax(np.abs(direction[:, j])))
+        code += letters[i][0] if direction[i, j] > 0 else letters[i][1]
+    return code
+
+
+class MetadataIndex:
+    """
+    Header metadata of the image files of a dataset, stored in columns
+    (one numpy array per field) and looked up by file path. The index can
+    be saved to and loaded from a `.npz` file.
+
+    Shapes, spacings and origins are padded with zeros to the largest
+    number of dimensions in the index; `get` returns them unpadded.
+
+    Examples
+    --------
+    >>> index = dataset.scan_metadata('metadata.npz')
+    >>> index.get(dataset.inputs.values[0])['spacing']
+    >>> index['shape']
+    """
+    def __init__(self, headers=None, paths=None):
+        headers = headers or []
+        paths = [os.path.abspath(path) for path in (paths or [])]
+        max_dim = max([len(h['shape']) for h in headers], default=0)
+
+        def padded(key, width):
+            values = np.zeros((len(headers), width))
+            for row, header in enumerate(headers):
+                values[row, :len(header[key])] = header[key]
+            return values
+
+        self.columns = {
+            'path': np.array(paths, dtype='str'),
+            'mtime': np.array([h['mtime'] for h in headers], dtype='int64'),
+            'size': np.array([h['size'] for h in headers], dtype='int64'),
+            'ndim': np.array([len(h['shape']) for h in headers], dtype='int64'),
+            'shape': padded('shape', max_dim).astype('int64'),
+            'spacing': padded('spacing', max_dim),
+            'origin': padded('origin', max_dim),
+            'direction': padded('direction', max_dim**2),
+            'orientation': np.array([h['orientation'] for h in headers], dtype='str'),
+            'components': np.array([h['components'] for h in headers], dtype='int64'),
+            'pixeltype': np.array([h['pixeltype'] for h in headers], dtype='str'),
+        }
+        self._build_lookup()
+
+    def _build_lookup(self):
+        self._rows = {path: row for row, path in enumerate(self.columns['path'].tolist())}
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def __len__(self):
+        return len(self.columns['path'])
+
+    def __contains__(self, path):
+        return os.path.abspath(path) in self._rows
+
+    def get(self, path):
+        """
+        Get the header of one file as a dictionary, or None if the file
+        is not in the index.
+        """
+        row = self._rows.get(os.path.abspath(path))
+        if row is None:
+            return None
+        ndim = int(self.columns['ndim'][row])
+        return {'shape': tuple(int(d) for d in self.columns['shape'][row, :ndim]),
+                'spacing': tuple(float(s) for s in self.columns['spacing'][row, :ndim]),
+                'origin': tuple(float(o) for o in self.columns['origin'][row, :ndim]),
+                'direction': tuple(float(d) for d in self.columns['direction'][row, :ndim**2]),
+                'orientation': str(self.columns['orientation'][row]),
+                'components': int(self.columns['components'][row]),
+                'pixeltype': str(self.columns['pixeltype'][row]),
+                'mtime': int(self.columns['mtime'][row]),
+                'size': int(self.columns['size'][row])}
+
+    def is_current(self, path):
+        """
+        Whether the file is in the index and has not changed since it was scanned.
+        """
+        row = self._rows.get(os.path.abspath(path))
+        if row is None or not os.path.exists(path):
+            return False
+        stat = os.stat(path)
+        return (self.columns['mtime'][row] == stat.st_mtime_ns and
+                self.columns['size'][row] == stat.st_size)
+
+    def save(self, path):
+        np.savez(path, **self.columns)
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        with np.load(path) as data:
+            index.columns = {column: data[column] for column in COLUMNS}
+        index._build_lookup()
+        return index
+
+    def __repr__(self):
+        return f'MetadataIndex (n={len(self)})'
+
+
+def scan_metadata(paths, cache=None, num_workers=8):
+    """
+    Build a metadata index of image files, reusing the rows of a saved index
+    for files that did not change. If `cache` is given, the index is saved there.
+    """
+    paths = list(dict.fromkeys(paths))
+    previous = None
+    if cache is not None and os.path.exists(cache):
+        previous = MetadataIndex.load(cache)
+
+    headers = [None] * len(paths)
+    missing = []
+    for i, path in enumerate(paths):
+        if previous is not None and previous.is_current(path):
+            headers[i] = previous.get(path)
+        else:
+            missing.append(i)
+
+    for i, header in zip(missing, scan_headers([paths[i] for i in missing], num_workers)):
+        headers[i] = header
+
+    index = MetadataIndex(headers, paths)
+    if cache is not None and (missing or previous is None or len(previous) != len(index)):
+        index.save(cache)
+    return index
+
+
+def image_paths(reader):
+    """
+    Get the paths of the local image files of a reader, including the
+    readers of a ComposeReader.
+    """
+    from ..readers import ImageReader, ComposeReader
+
+    if isinstance(reader, ComposeReader):
+        return [path for sub_reader in reader.readers for path in image_paths(sub_reader)]
+    if isinstance(reader, ImageReader) and reader.bucket is None:
+        return list(reader.values)
+    return []
+
+
+def record_shapes(dataset, num_workers=8):
+    """
+    Get the shape of the first image input of every record of a dataset
+    from its metadata index, the image headers or, for images in memory,
+    from the images. Returns None if the inputs are not images that can be
+    read locally.
+    """
+    headers = record_headers(dataset, num_workers)
+    return None if headers is None else [header['shape'] for header in headers]
+
+
+def record_headers(dataset, num_workers=8):
+    """
+    Like `record_shapes`, but get the header (shape, spacing, ...) of the first
+    image input of every record.
+    """
+    return reader_headers(dataset.inputs, num_workers, getattr(dataset, 'metadata', None))
+
+
+def reader_headers(reader, num_workers=8, index=None):
+    from ..readers import ImageReader, MemoryReader, ComposeReader
+
+    if isinstance(reader, ComposeReader):
+        for sub_reader in reader.readers:
+            headers = reader_headers(sub_reader, num_workers, index)
+            if headers is not None:
+                return headers
+        return None
+
+    if isinstance(reader, ImageReader) and reader.bucket is None:
+        if index is None:
+            return scan_headers(reader.values, num_workers)
+        # rows of files that changed since the index was built are stale
+        headers = [index.get(path) if index.is_current(path) else None
+                   for path in reader.values]
+        missing = [i for i, header in enumerate(headers) if header is None]
+        scanned = scan_headers([reader.values[i] for i in missing], num_workers)
+        for i, header in zip(missing, scanned):
+            headers[i] = header
+        return headers
+
+    if isinstance(reader, MemoryReader) and reader.as_image:
+        return [{'shape': tuple(image.shape), 'spacing': tuple(image.spacing),
+                 'origin': tuple(image.origin), 'components': image.components,
+                 'pixeltype': image.pixeltype} for image in reader.values]
+
+    return None
@@ -1,2 +1,3 @@
 # functions for explaining deep learning models in a neuroimaging context
-from .occlusion import OcclusionExplainer
\ No newline at end of file
+from .occlusion import OcclusionExplainer
+from .gradient import GradientExplainer, SmoothGradExplainer, IntegratedGradientsExplainer
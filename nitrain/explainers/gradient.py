@@ -0,0 +1,248 @@
+import numpy as np
+import ants
+
+from ..predictors.predictor import channel_axis, expand_channel
+
+__all__ = ['GradientExplainer',
+           'SmoothGradExplainer',
+           'IntegratedGradientsExplainer']
+
+
+class GradientExplainer:
+    """
+    Create a gradient (vanilla saliency) explainer which determines the
+    spatial importance of a medical image for model predictions as the
+    gradient of the model output with respect to each voxel.
+
+    One forward and backward pass gives the importance of every voxel, so
+    this is much cheaper than occlusion for 3D volumes. Keras and torch
+    models are supported and everything runs on the CPU if no GPU is available.
+
+    Examples
+    --------
+    >>> from nitrain.explainers import GradientExplainer
+    >>> explainer = GradientExplainer(model)
+    >>> importance = explainer.fit(dataset)
+    """
+
+    def __init__(self, model, target=None, batch_size=16, expand_dims=-1):
+        """
+        Initialize a gradient explainer from a fitted model.
+
+        Arguments
+        ---------
+        model : keras or torch model
+            the fitted model
+
+        target : integer (optional)
+            the output channel (e.g., class) to explain. By default, the sum
+            of all model outputs is explained.
+
+        batch_size : integer
+            number of images per forward/backward pass
+
+        expand_dims : integer or None
+            the axis at which to add a channel dimension to each image
+            before it is passed to the model. Use 0 for channels-first models.
+        """
+        self.model = model
+        self.target = target
+        self.batch_size = batch_size
+        self.expand_dims = expand_dims
+
+        # generated once fit() method is called
+        self.result_image = None
+
+    def fit(self, dataset):
+        """
+        Run the explainer on a dataset, a single image, or a list of images.
+
+        Returns an importance image with the geometry of each input image,
+        or a list of them for a dataset or a list of images. For models with
+        multiple inputs, each result is a list with one image per input.
+        """
+        if ants.is_image(dataset):
+            self.result_image = self._explain(dataset)
+            return self.result_image
+
+        if isinstance(dataset, list):
+            records = dataset
+        else:
+            records = (dataset[i][0] for i in range(len(dataset)))
+
+        self.result_image = [self._explain(x) for x in records]
+        return self.result_image
+
+    def _explain(self, x):
+        images = x if isinstance(x, list) else [x]
+        inputs = [image.numpy().astype('float32') for image in images]
+
+        attributions = self._attribute(inputs)
+
+        results = [ants.from_numpy(np.ascontiguousarray(attribution, dtype='float32'),
+                                   origin=image.origin,
+                                   spacing=image.spacing,
+                                   direction=image.direction,
+                                   has_components=image.has_components)
+                   for attribution, image in zip(attributions, images)]
+        return results if isinstance(x, list) else results[0]
+
+    def _attribute(self, inputs):
+        return [g[0] for g in self._gradients([xx[None] for xx in inputs])]
+
+    def _batched_mean_gradients(self, make_batch, n):
+        """
+        Mean gradient over `n` modified copies of the inputs, computed
+        with one forward/backward pass per `batch_size` copies.
+        """
+        total = None
+        for i in range(0, n, self.batch_size):
+            grads = self._gradients(make_batch(np.arange(i, min(i + self.batch_size, n))))
+            grads = [g.sum(axis=0) for g in grads]
+            total = grads if total is None else [t + g for t, g in zip(total, grads)]
+        return [t / n for t in total]
+
+    def _gradients(self, x_batch):
+        x_batch = [expand_channel(xx, self.expand_dims, batched=True) for xx in x_batch]
+
+        channels_first = self.expand_dims is not None and self.expand_dims >= 0
+        grads = model_gradients(self.model, x_batch, self.target, channels_first)
+
+        axis = channel_axis(self.expand_dims, batched=True)
+        if axis is not None:
+            grads = [np.squeeze(g, axis=axis) for g in grads]
+        return grads
+
+
+class SmoothGradExplainer(GradientExplainer):
+    """
+    Create a SmoothGrad explainer which averages the gradients of many
+    noisy copies of each image to get a less noisy importance map.
+
+    The noisy copies are passed through the model in batches, so the cost
+    is `n_samples / batch_size` forward/backward passes per image.
+
+    Examples
+    --------
+    >>> from nitrain.explainers import SmoothGradExplainer
+    >>> explainer = SmoothGradExplainer(model, n_samples=32, noise=0.1)
+    >>> importance = explainer.fit(dataset)
+    """
+    def __init__(self, model, n_samples=25, noise=0.15, target=None, batch_size=16, expand_dims=-1):
+        """
+        Arguments
+        ---------
+        n_samples : integer
+            number of noisy copies per image
+
+        noise : float
+            standard deviation of the gaussian noise as a fraction of
+            the intensity range of each image
+        """
+        super().__init__(model, target=target, batch_size=batch_size, expand_dims=expand_dims)
+        self.n_samples = n_samples
+        self.noise = noise
+
+    def _attribute(self, inputs):
+        sigmas = [self.noise * (xx.max() - xx.min()) for xx in inputs]
+
+        def make_batch(indices):
+            return [xx[None] + np.random.normal(0, sigma, (len(indices),) + xx.shape).astype('float32')
+                    for xx, sigma in zip(inputs, sigmas)]
+
+        return self._batched_mean_gradients(make_batch, self.n_samples)
+
+
+class IntegratedGradientsExplainer(GradientExplainer):
+    """
+    Create an Integrated Gradients explainer which integrates the gradients
+    along a straight path from a baseline image (e.g., all zeros) to each
+    image and multiplies them with the difference from the baseline.
+
+    The interpolation steps are passed through the model in batches, so the
+    cost is `n_steps / batch_size` forward/backward passes per image.
+
+    Examples
+    --------
+    >>> from nitrain.explainers import IntegratedGradientsExplainer
+    >>> explainer = IntegratedGradientsExplainer(model, n_steps=50)
+    >>> importance = explainer.fit(dataset)
+    """
+    def __init__(self, model, n_steps=32, baseline=0, target=None, batch_size=16, expand_dims=-1):
+        """
+        Arguments
+        ---------
+        n_steps : integer
+            number of interpolation steps between the baseline and the image
+
+        baseline : float
+            the value of the baseline image
+        """
+        super().__init__(model, target=target, batch_size=batch_size, expand_dims=expand_dims)
+        self.n_steps = n_steps
+        self.baseline = baseline
+
+    def _attribute(self, inputs):
+        # midpoint rule along the path from the baseline to the image
+        alphas = ((np.arange(self.n_steps) + 0.5) / self.n_steps).astype('float32')
+
+        def make_batch(indices):
+            a = alphas[indices]
+            return [self.baseline + a.reshape((-1,) + (1,) * xx.ndim) * (xx[None] - self.baseline)
+                    for xx in inputs]
+
+        grads = self._batched_mean_gradients(make_batch, self.n_steps)
+        return [(xx - self.baseline) * g for xx, g in zip(inputs, grads)]
+
+
+def model_gradients(model, x, target=None, channels_first=False):
+    """
+    Gradients of the (summed) outputs of a keras or torch model with
+    respect to each input of a batch of numpy arrays.
+
+    The outputs of different samples are independent, so the gradient of
+    their sum gives the gradient of every sample in one backward pass.
+    """
+    if hasattr(model, 'predict'):
+        import tensorflow as tf
+
+        x = [tf.convert_to_tensor(np.ascontiguousarray(xx, dtype='float32')) for xx in x]
+        with tf.GradientTape() as tape:
+            for xx in x:
+                tape.watch(xx)
+            y = model(x if len(x) > 1 else x[0], training=False)
+            if target is not None:
+                y = y[:, target] if channels_first else y[..., target]
+            score = tf.reduce_sum(y)
+        return [g.numpy() for g in tape.gradient(score, x)]
+
+    import torch
+
+    try:
+        device = next(model.parameters()).device
+    except (AttributeError, StopIteration):
+        device = 'cpu'
+
+    x = [torch.as_tensor(np.ascontiguousarray(xx, dtype='float32')).to(device).requires_grad_(True)
+         for xx in x]
+
+    # only the inputs need gradients, and the .grad of the parameters
+    # must not be changed by explaining a model during training
+    params = [p for p in model.parameters() if p.requires_grad] \
+        if hasattr(model, 'parameters') else []
+    training = getattr(model, 'training', False)
+    if training:
+        model.eval()
+    try:
+        for p in params:
+            p.requires_grad_(False)
+        y = model(*x)
+        if target is not None:
+            y = y[:, target] if channels_first else y[..., target]
+        grads = torch.autograd.grad(y.sum(), x)
+    finally:
+        for p in params:
+            p.requires_grad_(True)
+        if training:
+            model.train()
+    return [g.detach().cpu().numpy() for g in grads]
@@ -1,3 +1,9 @@
+import numpy as np
+import ants
+
+from ..predictors.predictor import predict_batch, expand_channel
+from ..samplers import PatchSampler, BlockSampler
+from ..samplers.base import grid_indices
 
 
 class OcclusionExplainer:
@@ -5,27 +11,287 @@ class OcclusionExplainer:
     Create an occlusion explainer which determines the spatial importance
     of a medical image for model predictions by systematically setting parts
     of the image to zero and determining how the model prediction changes.
-    
+
     This explainer can be run with or without ground-truth labels. Without ground
     truth labels, importance will be determined by how much the predicted result changes
-    with the occluded image compared to the original image. With ground truth labels, 
+    with the occluded image compared to the original image. With ground truth labels,
     importance will be determined by how much the performance of the model changes (although
     the change in predicted result will also be available in this case).
+
+    Examples
+    --------
+    >>> from nitrain.samplers import PatchSampler
+    >>> explainer = nt.OcclusionExplainer(model, sampler=PatchSampler(8, 4, batch_size=64))
+    >>> importance = explainer.fit(dataset)
     """
-    
-    def __init__(self, model, sampler=None):
+
+    def __init__(self, model, sampler=None, window_size=None, stride=None, value=0,
+                 batch_size=32, expand_dims=-1, use_labels=False, min_window_size=None,
+                 threshold=0.5, max_evaluations=None):
         """
         Initialize an occlusion explainer from a fitted model.
+
+        Arguments
+        ---------
+        model : keras or torch model
+            the fitted model
+
+        sampler : PatchSampler or BlockSampler (optional)
+            the occlusion windows are the patches or blocks of the sampler
+            and its batch size is the number of occluded images per model call
+
+        window_size : integer or tuple (optional)
+            size of the occlusion window if no sampler is given. Defaults to
+            1/8 of the image size along each axis.
+
+        stride : integer or tuple (optional)
+            stride of the occlusion window if no sampler is given. Defaults
+            to the window size.
+
+        value : float
+            the value that occluded voxels are set to
+
+        batch_size : integer
+            number of occluded images per model call if no sampler is given
+
+        expand_dims : integer or None
+            the axis at which to add a channel dimension to each image
+            before it is passed to the model
+
+        use_labels : boolean
+            whether importance is the change in model error with respect to
+            the ground-truth outputs of the dataset instead of the change
+            in the predicted result. If the output is a class label and the
+            model predicts a score per class, importance is the drop in the
+            score of the labeled class.
+
+        min_window_size : integer or tuple (optional)
+            if given, occlusion is run coarse-to-fine: after occluding with
+            the (large) window size, the windows are halved until this size
+            and only the windows whose importance is at least `threshold`
+            times the highest importance of their level are refined.
+
+        threshold : float
+            fraction of the highest importance of a level above which a
+            window is refined in coarse-to-fine mode
+
+        max_evaluations : integer (optional)
+            the maximum number of occluded images that are passed through
+            the model per record in coarse-to-fine mode. The coarsest level
+            is always completed and the most important windows are refined
+            first when the budget runs out.
         """
         self.model = model
         self.sampler = sampler
-        
+        self.value = value
+        self.expand_dims = expand_dims
+        self.use_labels = use_labels
+        self.min_window_size = min_window_size
+        self.threshold = threshold
+        self.max_evaluations = max_evaluations
+
+        if isinstance(sampler, PatchSampler):
+            window_size, stride, batch_size = sampler.patch_size, sampler.stride, sampler.batch_size
+        elif isinstance(sampler, BlockSampler):
+            window_size, stride, batch_size = sampler.block_size, sampler.stride, sampler.batch_size
+        elif sampler is not None:
+            raise ValueError('The sampler of an OcclusionExplainer must be a PatchSampler or BlockSampler.')
+
+        self.window_size = window_size
+        self.stride = stride
+        self.batch_size = batch_size
+
         # generated once fit() method is called
         self.result_image = None
-        
+        self.n_evaluations = None
+
     def fit(self, dataset):
         """
         Run occlusion explainer on a dataset loader, a single image, or
         a list of images.
+
+        Returns an importance image with the geometry of each input image,
+        or a list of them for a dataset or a list of images.
         """
-        return 1
\ No newline at end of file
+        if ants.is_image(dataset):
+            self.result_image = self._explain(dataset, None)
+            return self.result_image
+
+        if isinstance(dataset, list):
+            records = [(x, None) for x in dataset]
+        else:
+            records = (dataset[i] for i in range(len(dataset)))
+
+        self.result_image = [self._explain(x, y) for x, y in records]
+        return self.result_image
+
+    def _explain(self, x, y):
+        inputs = [xx.numpy() for xx in x] if isinstance(x, list) else [x.numpy()]
+        reference = x[0] if isinstance(x, list) else x
+        spatial_shape = tuple(reference.shape)
+
+        window_size = expand_param(self.window_size, spatial_shape,
+                                   [max(1, s // 8) for s in spatial_shape])
+        stride = expand_param(self.stride, spatial_shape, window_size)
+        window_size = [min(w, s) for w, s in zip(window_size, spatial_shape)]
+
+        starts = grid_indices(spatial_shape, window_size, stride, cover=True)
+
+        base_pred = self._predict(inputs)
+        target = y.numpy() if ants.is_image(y) else y
+
+        scores = self._window_scores(inputs, starts, window_size, base_pred, target)
+        importance = window_importance(starts, window_size, scores, spatial_shape)
+        self.n_evaluations = len(starts)
+
+        if self.min_window_size is not None:
+            min_window_size = expand_param(self.min_window_size, spatial_shape, window_size)
+            importance = self._refine(inputs, importance, starts, window_size, scores,
+                                      min_window_size, base_pred, target)
+
+        return ants.from_numpy(importance, origin=reference.origin,
+                               spacing=reference.spacing,
+                               direction=reference.direction)
+
+    def _refine(self, inputs, importance, starts, window_size, scores,
+                min_window_size, base_pred, target):
+        """
+        Coarse-to-fine occlusion. Important windows are split into windows
+        of half the size, level by level, and the finer importance replaces
+        the coarser importance inside the refined windows.
+        """
+        spatial_shape = importance.shape
+        budget = self.max_evaluations
+
+        while any(w > m for w, m in zip(window_size, min_window_size)):
+            if budget is not None and self.n_evaluations >= budget:
+                break
+
+            selected = np.where(scores >= self.threshold * scores.max())[0] if scores.max() > 0 else []
+            if len(selected) == 0:
+                break
+
+            # most important windows first, so they are refined within the budget
+            selected = selected[np.argsort(-scores[selected], kind='stable')]
+
+            new_size = [max(m, w // 2) for w, m in zip(window_size, min_window_size)]
+            offsets = grid_indices(window_size, new_size, new_size, cover=True)
+            new_starts = (starts[selected][:, None, :] + offsets[None, :, :]).reshape(-1, len(new_size))
+            _, first = np.unique(new_starts, axis=0, return_index=True)
+            new_starts = new_starts[np.sort(first)]
+
+            if budget is not None:
+                new_starts = new_starts[:budget - self.n_evaluations]
+
+            new_scores = self._window_scores(inputs, new_starts, new_size, base_pred, target)
+            self.n_evaluations += len(new_starts)
+
+            counts = window_counts(new_starts, new_size, spatial_shape)
+            refined = counts > 0
+            fine = window_importance(new_starts, new_size, new_scores, spatial_shape)
+
+            # keep the scale of the coarser level inside the refined region
+            if fine[refined].mean() > 0:
+                fine = fine * (importance[refined].mean() / fine[refined].mean())
+            importance[refined] = fine[refined]
+
+            starts, window_size, scores = new_starts, new_size, new_scores
+
+        return importance
+
+    def _window_scores(self, inputs, starts, window_size, base_pred, target):
+        spatial_shape = inputs[0].shape[:len(window_size)]
+        scores = []
+        for i in range(0, len(starts), self.batch_size):
+            masks = window_masks(starts[i:i+self.batch_size], window_size, spatial_shape)
+            scores.append(self._score(inputs, masks, base_pred, target))
+        return np.concatenate(scores) if scores else np.zeros(0, dtype='float32')
+
+    def _score(self, inputs, masks, base_pred, target):
+        """
+        Importance of each occlusion mask: the change in prediction, or
+        the change in error if labels are used.
+        """
+        y_pred = self._predict(inputs, masks)
+        n = len(masks)
+
+        if self.use_labels and target is not None:
+            target = np.asarray(target, dtype='float32')
+            if target.size == 1 and base_pred.shape[-1] > 1:
+                # a class label: importance is the drop in the score of that class
+                label = int(target.reshape(()))
+                base_score = base_pred[..., label].mean()
+                score = y_pred[..., label].reshape(n, -1).mean(axis=1)
+                return (base_score - score).astype('float32')
+            target = target.reshape(base_pred.shape[1:])
+            base_error = np.mean((base_pred - target) ** 2)
+            error = ((y_pred - target) ** 2).reshape(n, -1).mean(axis=1)
+            return (error - base_error).astype('float32')
+
+        return np.abs(y_pred - base_pred).reshape(n, -1).mean(axis=1).astype('float32')
+
+    def _predict(self, inputs, masks=None):
+        if masks is None:
+            x_batch = [xx[None] for xx in inputs]
+        else:
+            x_batch = [occlude(xx, masks, self.value) for xx in inputs]
+
+        x_batch = [expand_channel(xx, self.expand_dims, batched=True) for xx in x_batch]
+
+        y_pred = predict_batch(self.model, x_batch if len(x_batch) > 1 else x_batch[0])
+        return np.asarray(y_pred, dtype='float32')
+
+
+def window_importance(starts, window_size, scores, spatial_shape, batch_size=256):
+    """
+    Spread the score of each window over the voxels it covers and
+    average the scores of overlapping windows.
+    """
+    importance = np.zeros(spatial_shape, dtype='float32')
+    counts = np.zeros(spatial_shape, dtype='float32')
+    for i in range(0, len(starts), batch_size):
+        masks = window_masks(starts[i:i+batch_size], window_size, spatial_shape)
+        importance += np.tensordot(scores[i:i+batch_size], masks, axes=1)
+        counts += masks.sum(axis=0)
+    return importance / np.maximum(counts, 1)
+
+
+def window_counts(starts, window_size, spatial_shape):
+    counts = np.zeros(spatial_shape, dtype='float32')
+    for start in starts:
+        counts[tuple(slice(a, a + w) for a, w in zip(start, window_size))] += 1
+    return counts
+
+
+def window_masks(starts, window_size, spatial_shape):
+    """
+    Boolean masks of shape (n_windows, *spatial_shape) that are True inside
+    each window, built with one broadcast per axis instead of per window.
+    """
+    n = len(starts)
+    ndim = len(spatial_shape)
+    masks = np.ones((n,) + tuple(spatial_shape), dtype=bool)
+    for axis in range(ndim):
+        coords = np.arange(spatial_shape[axis])
+        inside = (coords[None, :] >= starts[:, axis, None]) & \
+                 (coords[None, :] < starts[:, axis, None] + window_size[axis])
+        shape = [n] + [1] * ndim
+        shape[axis + 1] = spatial_shape[axis]
+        masks &= inside.reshape(shape)
+    return masks
+
+
+def occlude(array, masks, value=0):
+    """
+    Make one occluded copy of an image array for each mask.
+    """
+    masks = masks.reshape(masks.shape + (1,) * (array.ndim - masks.ndim + 1))
+    return np.where(masks, np.asarray(value, dtype=array.dtype), array[None])
+
+
+def expand_param(param, spatial_shape, default):
+    if param is None:
+        return list(default)
+    if isinstance(param, int):
+        return [param] * len(spatial_shape)
+    return list(param)
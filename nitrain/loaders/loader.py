@@ -1,11 +1,22 @@
+import os
+import sys
 import math
+import queue
+import random
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import warnings
 import ants
 from copy import deepcopy, copy
+from contextlib import nullcontext
 
 from .. import samplers, transforms as tx
 from ..datasets.utils import reduce_to_list, apply_transforms
+from .shared_memory import to_shared_memory, from_shared_memory, free_shared_memory
+from .threads import thread_plan, set_image_threads, worker_context
+from ..transforms.base import thread_pool, pool_executor
 
 class Loader:
     def __init__(self,
@@ -14,10 +25,98 @@ class Loader:
                  transforms=None,
                  channels_first=False,
                  shuffle=False,
-                 sampler=None):
+                 sampler=None,
+                 num_workers=0,
+                 dtype=None,
+                 rank=None,
+                 world_size=None,
+                 seed=None,
+                 drop_last=False,
+                 prefetch=0,
+                 pool_size=None,
+                 bucket_by=None,
+                 num_threads=None,
+                 transform_threads=0):
         """
         Arguments
         ---------
+        shuffle : boolean or integer
+            whether the records are visited in a random order every epoch. If
+            True, the order is a full permutation of the records. An integer
+            gives the size of a shuffle buffer instead: records are read
+            roughly in their stored order and each one is moved by at most
+            that many positions, which keeps reads local for streaming or
+            remote readers. Either way the order of the whole epoch is known
+            before the first record is read, and it is the order of prefetching.
+        rank : integer (optional)
+            index of this process when training with several processes
+        world_size : integer (optional)
+            number of training processes. Each process reads a disjoint
+            shard of the records. If rank and world_size are not given, they
+            are taken from the RANK and WORLD_SIZE environment variables (set
+            by `torchrun` and `nitrain.trainers.launch`) or from an initialized
+            torch.distributed process group, and otherwise there is one process.
+        seed : integer (optional)
+            seed of the shuffle. The order of an epoch is derived from the
+            seed and the epoch (see `set_epoch`), so all processes agree on
+            it. If not given, a single process shuffles with the global
+            numpy random state and several processes use a seed of 0.
+        drop_last : boolean
+            whether the records that do not divide evenly over the processes
+            are dropped. By default, the shards are padded with records from
+            the start of the epoch so all shards are the same size.
+        dtype : string or dict
+            dtype that batches are collated to. A dict can give separate dtypes
+            for 'inputs' and 'outputs' - e.g., {'inputs': 'float16', 'outputs': 'uint8'}.
+            A string only applies to the inputs. Unspecified sides keep the dtype
+            of the images, so segmentations read as uint8 are never promoted to float.
+        num_workers : integer
+            number of worker processes used to read, transform and sample
+            image batches. Batches are passed back to the main process through
+            shared memory so the voxel data is never pickled. If 0, everything
+            runs in the main process.
+        prefetch : integer
+            number of image batches that are read ahead in a background thread,
+            in the (shuffled) order of the epoch, when num_workers is 0. Reading
+            then overlaps with the transforms, sampling and training step.
+        pool_size : integer (optional)
+            number of records whose sampled slices or patches are kept in a
+            pool. Every batch draws `batch_size` items of the sampler uniformly
+            at random from all records in the pool, so batches mix many
+            subjects at the memory cost of `pool_size` records. A record whose
+            items are used up is replaced by the next record of the epoch,
+            which is read, transformed and sampled in a background thread.
+        bucket_by : string or callable (optional)
+            group records with different image sizes into image batches of
+            similar records instead of padding or resampling all of them to
+            one size. Either 'shape' or 'spacing' of the first input image, or
+            a function that maps an image header (see `Dataset.scan_metadata`)
+            to a bucket key - e.g., `lambda h: tuple(s // 32 for s in h['shape'])`.
+            The images of an image batch are zero-padded at the end to the
+            largest shape in its bucket (or in the image batch, if there are
+            transforms). Shapes come from the image headers, so no image is read.
+        num_threads : integer (optional)
+            total number of threads for reading and transforming images. Heavy
+            transforms (e.g., `BiasCorrection`, `Smooth`, `Resample`) run in
+            multi-threaded ITK filters. The records are transformed in
+            parallel worker processes (inter-op) and each worker's filters use
+            an equal share of the threads, so the workers do not oversubscribe
+            the cores. ITK fixes its threads when a process first transforms an
+            image, so workers are then started with the spawn method and the
+            budget in their environment. It does not apply if num_workers is 0:
+            set `ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS` before transforming
+            any image instead. If not given, ITK uses one thread per core in
+            every process.
+        transform_threads : integer
+            number of threads that read and transform the records of an image
+            batch concurrently, in each process. If an image batch has one
+            record, the images of the record (e.g., T1, T2 and a segmentation)
+            go through the loader transforms concurrently instead. ITK
+            releases the GIL, so this parallelizes heavy transforms without
+            the overhead of worker processes. One pool of threads is used
+            for a whole pass over the data. With
+            several threads, random transforms draw their parameters in a
+            nondeterministic order, so seeded runs are not reproducible.
         
         Examples
         --------
@@ -35,10 +134,26 @@ class Loader:
         self.channels_first = channels_first
         self.transforms = transforms
         self.shuffle = shuffle
+        self.num_workers = num_workers
+        self.dtype = dtype
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.drop_last = drop_last
+        self.prefetch = prefetch
+        self.pool_size = pool_size
+        self.bucket_by = bucket_by
+        self.num_threads = num_threads
+        self.transform_threads = transform_threads
+        self.epoch = 0
+        
+        if pool_size and bucket_by is not None:
+            raise Exception('The pool_size and bucket_by arguments can not be used together.')
         
         if sampler is None:
             sampler = samplers.BaseSampler(batch_size=images_per_batch)
         self.sampler = sampler
+        self._state = None
         
     def copy(self, dataset=None, drop_transforms=False):
         new_loader = Loader(
@@ -47,78 +162,646 @@ class Loader:
             channels_first = self.channels_first,
             transforms = self.transforms if not drop_transforms else None,
             shuffle = self.shuffle,
-            sampler = self.sampler
+            sampler = self.sampler,
+            num_workers = self.num_workers,
+            dtype = self.dtype,
+            rank = self.rank,
+            world_size = self.world_size,
+            seed = self.seed,
+            drop_last = self.drop_last,
+            prefetch = self.prefetch,
+            pool_size = self.pool_size,
+            bucket_by = self.bucket_by,
+            num_threads = self.num_threads,
+            transform_threads = self.transform_threads
         )
+        new_loader.epoch = self.epoch
         return new_loader
+    
+    def shard(self):
+        """
+        Get the (rank, world_size) of this process. Values that were not
+        given to the loader are inferred from the environment.
+        """
+        rank, world_size = self.rank, self.world_size
+        if rank is None or world_size is None:
+            env_rank, env_world_size = distributed_env()
+            rank = env_rank if rank is None else rank
+            world_size = env_world_size if world_size is None else world_size
+        if not 0 <= rank < world_size:
+            raise ValueError(f'The rank ({rank}) must be between 0 and world_size ({world_size}).')
+        return rank, world_size
+    
+    def _shard_size(self):
+        """
+        Number of records that each process reads per epoch.
+        """
+        _, world_size = self.shard()
+        if self.drop_last:
+            return len(self.dataset) // world_size
+        return math.ceil(len(self.dataset) / world_size)
+    
+    def set_epoch(self, epoch):
+        """
+        Set the epoch that the shuffled order of the records is derived
+        from when a seed is given. Trainers call this before every epoch.
+        """
+        self.epoch = epoch
+        
+    def to_keras(self, output_signature=None, deterministic=True):
+        """
+        Create a batched tf.data.Dataset from the loader.
+        
+        Every image batch is read, transformed and sampled inside a
+        `tf.py_function` and image batches are processed in parallel. The
+        sampled batches are emitted whole, so tf.data never splits them into
+        records or batches them again. The order of the records is planned
+        again every time the dataset is iterated, so every (Keras) epoch is
+        shuffled anew.
         
-    def to_keras(self, output_signature=None):
+        Arguments
+        ---------
+        output_signature : tuple
+            optional (x_spec, y_spec) of tf.TensorSpec with a None batch dimension.
+            If not given, it is inferred once from the first record and cached.
+        deterministic : boolean
+            whether batches are returned in order. Setting this to False lets
+            image batches that finish loading first be returned first.
+        
+        Examples
+        --------
+        >>> loader = nt.Loader(dataset, images_per_batch=4)
+        >>> keras_loader = loader.to_keras()
+        >>> xb, yb = next(iter(keras_loader))
+        """
         import tensorflow as tf
- 
-        # generate a training batch to infer the output signature
+        
         if output_signature is None:
-            tmp_batch_size = self.images_per_batch
-            self.images_per_batch = 1
-            x_batch, y_batch = next(iter(self))
-            self.images_per_batch = tmp_batch_size
-            if isinstance(x_batch, list):
-                x_spec = tuple([tf.type_spec_from_value(xb[0]) for xb in x_batch])
-            else:
-                x_spec = tf.type_spec_from_value(x_batch[0])
-            if isinstance(y_batch, list) and ants.is_image(y_batch[0]):
-                y_spec = tuple([tf.type_spec_from_value(yb[0]) for yb in y_batch])
-            else:
-                y_spec = tf.type_spec_from_value(y_batch[0])
+            output_signature = self._keras_signature()
+        
+        flat_specs = tf.nest.flatten(output_signature)
+        n_iterations = [0]
+        
+        def plan_image_batches():
+            # plan every pass over the pipeline as a new epoch
+            loader = copy(self)
+            loader.epoch = self.epoch + n_iterations[0]
+            n_iterations[0] += 1
+            for data_indices in loader._image_batches():
+                yield np.asarray(data_indices, dtype='int64')
+        
+        def load_image_batch(data_indices):
+            batches = [tf.nest.flatten(to_tuple(batch)) 
+                       for batch in self._load_image_batch(data_indices.numpy())]
+            sizes = [len(batch[0]) for batch in batches]
+            components = [stack_batches([batch[c] for batch in batches], max(sizes))
+                          for c in range(len(flat_specs))]
+            return components + [np.array(sizes, dtype='int64')]
         
-        generator = tf.data.Dataset.from_generator(
-            lambda: record_generator(self),
-            output_signature=(x_spec, y_spec)
-        ).batch(self.sampler.batch_size)
+        def read(data_indices):
+            tensors = tf.py_function(load_image_batch, [data_indices],
+                                     [spec.dtype for spec in flat_specs] + [tf.int64])
+            for tensor, spec in zip(tensors, flat_specs):
+                tensor.set_shape(tf.TensorShape([None]).concatenate(spec.shape))
+            tensors[-1].set_shape([None])
+            return tuple(tensors)
         
-        return generator
+        def split_batches(*tensors):
+            components, sizes = tensors[:-1], tensors[-1]
+            batches = tf.data.Dataset.from_tensor_slices((components, sizes))
+            return batches.map(lambda c, n: tf.nest.pack_sequence_as(output_signature,
+                                                                     [cc[:n] for cc in c]))
+        
+        dataset = tf.data.Dataset.from_generator(
+            plan_image_batches, output_signature=tf.TensorSpec([None], tf.int64))
+        dataset = dataset.map(read, num_parallel_calls=tf.data.AUTOTUNE, deterministic=deterministic)
+        dataset = dataset.flat_map(split_batches)
+        return dataset.prefetch(tf.data.AUTOTUNE)
+    
+    def _keras_signature(self):
+        """
+        Infer the tf output signature from one record. The result
+        is cached so repeated calls to `to_keras` do not load data again.
+        """
+        import tensorflow as tf
+        
+        if getattr(self, '_keras_output_signature', None) is None:
+            x_batch, y_batch = next(self._load_image_batch(slice(0, 1)))
+            self._keras_output_signature = (batch_spec(x_batch), batch_spec(y_batch))
+        return self._keras_output_signature
+        
+    def to_torch(self, num_workers=None, pin_memory=False, persistent_workers=False, **kwargs):
+        """
+        Create a torch DataLoader that runs this loader's readers, transforms
+        and sampler in torch worker processes.
+        
+        Image batches are split across the torch workers and each worker
+        yields fully sampled batches, so the DataLoader does no extra batching.
+        Random number generators are seeded separately in every worker. With
+        a `num_threads` budget, the workers are spawned instead of forked so
+        that the budget applies to their ITK filters (see `Loader`).
+        
+        Arguments
+        ---------
+        num_workers : integer
+            number of torch worker processes. Defaults to `num_workers` of the loader.
+        pin_memory : boolean
+            whether to copy batches into pinned memory before returning them
+        persistent_workers : boolean
+            whether to keep the worker processes alive between epochs
+        kwargs
+            other arguments passed to torch.utils.data.DataLoader (e.g., prefetch_factor)
+        
+        Examples
+        --------
+        >>> loader = nt.Loader(dataset, images_per_batch=4, sampler=SliceSampler(batch_size=32))
+        >>> torch_loader = loader.to_torch(num_workers=4, pin_memory=True)
+        >>> xb, yb = next(iter(torch_loader))
+        """
+        from torch.utils.data import DataLoader
+        from .torch_dataset import TorchLoaderDataset, worker_init_fn
+        
+        if num_workers is None:
+            num_workers = self.num_workers
+        if num_workers > 0 and self.num_threads is not None \
+                and 'multiprocessing_context' not in kwargs:
+            threads = thread_plan(self.num_threads, num_workers, self.transform_threads)[1]
+            kwargs['multiprocessing_context'] = worker_context(threads)
+        
+        return DataLoader(TorchLoaderDataset(self),
+                          batch_size=None,
+                          num_workers=num_workers,
+                          pin_memory=pin_memory,
+                          persistent_workers=persistent_workers and num_workers > 0,
+                          worker_init_fn=worker_init_fn,
+                          **kwargs)
                 
     def __iter__(self):
-        images_per_batch = self.images_per_batch
-        dataset = self.dataset
-        n_image_batches = math.ceil(len(dataset) / images_per_batch)
+        return self.iterate()
+    
+    def iterate(self, state=None):
+        """
+        Iterate over the batches of one pass over the data, optionally
+        continuing from a position returned by `state_dict()`.
         
-        original_indices = np.arange(len(dataset))
-        if self.shuffle:
-            np.random.shuffle(original_indices)
+        Image batches before the saved position are never read. The image
+        batch that was in progress is read again with the random state it
+        was first read with, and its already consumed batches are skipped,
+        so with `num_workers=0` the remaining batches are exactly those
+        of the interrupted pass. Batches of a `pool_size` pool mix records,
+        so the pass is drawn again from its start with the random state it
+        started with and the consumed batches are skipped.
         
-        image_batch_idx = 0
-        while image_batch_idx < n_image_batches:
+        Examples
+        --------
+        >>> batches = iter(loader)
+        >>> xb, yb = next(batches)
+        >>> state = loader.state_dict()
+        >>> for xb, yb in loader.iterate(state):
+        ...     pass
+        """
+        if state is None:
+            image_batches = self._image_batches()
+            start_idx, n_skip = 0, 0
+        else:
+            image_batches = state['image_batches']
+            start_idx, n_skip = state['image_batch'], state['batch']
+            if state['rng'] is not None:
+                np.random.set_state(state['rng'][0])
+                random.setstate(state['rng'][1])
+        
+        self._state = None
+        if self.pool_size:
+            rng = (np.random.get_state(), random.getstate()) if state is None else state['rng']
+            for n_batches, batch in enumerate(self._iter_pool(image_batches), 1):
+                if n_batches <= n_skip:
+                    continue
+                self._state = {'image_batches': image_batches,
+                               'image_batch': 0,
+                               'batch': n_batches,
+                               'rng': rng}
+                yield batch
+            return
+        
+        batch_idx, rng = -1, None
+        for image_batch_idx, batch in self._iter_image_batches(image_batches, start_idx):
+            if image_batch_idx != batch_idx:
+                batch_idx, n_batches = image_batch_idx, 0
+                rng = self._rng_state
+            n_batches += 1
+            if image_batch_idx == start_idx and n_batches <= n_skip:
+                continue
+            self._state = {'image_batches': image_batches,
+                           'image_batch': image_batch_idx,
+                           'batch': n_batches,
+                           'rng': rng}
+            yield batch
+    
+    def state_dict(self):
+        """
+        Get the position of the current pass over the data: the indices of
+        all image batches, the image batch in progress, the number of its
+        batches that were consumed and the random state it was read with.
+        With a pool, the position counts the batches of the whole pass and
+        the random state is the one the pass started with. Returns None if
+        no batch has been consumed yet.
+        """
+        return self._state
+    
+    def _iter_image_batches(self, image_batches, start_idx=0):
+        """
+        Yield (image batch index, batch) pairs for the image batches from
+        `start_idx` onwards.
+        """
+        if self.num_workers > 0:
+            self._rng_state = None
+            yield from self._iter_workers(image_batches, start_idx)
+            return
+        
+        with self._transform_pool() as executor:
+            records = (self._read_image_batch(image_batches[i], executor)
+                       for i in range(start_idx, len(image_batches)))
+            if self.prefetch > 0:
+                records = read_ahead(records, self.prefetch)
             
-            # TODO: implement shuffle here 
-            data_indices = slice(image_batch_idx*images_per_batch, min((image_batch_idx+1)*images_per_batch, len(dataset)))
-            x, y = dataset[data_indices, self.transforms is None]
-
-            if self.transforms:
+            for image_batch_idx, (x, y) in enumerate(records, start_idx):
+                self._rng_state = (np.random.get_state(), random.getstate())
+                pad_shape = self._pad_shape(image_batches[image_batch_idx])
+                for batch in self._sample_image_batch(x, y, pad_shape, executor):
+                    yield image_batch_idx, batch
+    
+    def _iter_pool(self, image_batches):
+        """
+        Yield batches drawn uniformly from the items (e.g., slices or patches)
+        of a pool of `pool_size` records, replacing each record once all
+        its items have been drawn.
+        """
+        order = np.concatenate(image_batches) if image_batches else []
+        rng = np.random.default_rng(np.random.randint(2**31))
+        with self._transform_pool() as executor:
+            records = read_ahead((self._record_items(idx, executor) for idx in order), 1)
+            
+            pool = []
+            
+            def fill():
+                # records drain at about the same time, so read more records when
+                # the pool cannot fill a batch and only the last batch is partial
+                while (len(pool) < self.pool_size or
+                       sum(len(items[2]) for items in pool) < self.sampler.batch_size):
+                    items = next(records, None)
+                    if items is None:
+                        break
+                    pool.append(items)
+            
+            fill()
+            while pool:
+                counts = np.array([len(items[2]) for items in pool])
+                n_draw = min(self.sampler.batch_size, counts.sum())
+                draws = rng.choice(counts.sum(), n_draw, replace=False)
+                
+                # map the draws to (record in the pool, remaining item of that record)
+                offsets = np.cumsum(counts) - counts
+                record_idx = np.searchsorted(np.cumsum(counts), draws, side='right')
+                
+                x_parts, y_parts = [], []
+                for i in np.unique(record_idx):
+                    x, y, remaining = pool[i]
+                    positions = draws[record_idx == i] - offsets[i]
+                    selected = remaining[positions]
+                    x_parts.append(take_batch(x, selected))
+                    y_parts.append(take_batch(y, selected))
+                    pool[i][2] = np.delete(remaining, positions)
+                
+                pool[:] = [items for items in pool if len(items[2]) > 0]
+                fill()
+                
+                yield concat_batches(x_parts), concat_batches(y_parts)
+    
+    def _record_items(self, idx, executor=None):
+        """
+        Read, transform and sample one record and collate all its items.
+        """
+        x, y = self._read_image_batch([idx], executor)
+        batches = list(self._sample_image_batch(x, y, executor=executor))
+        x = concat_batches([b[0] for b in batches])
+        y = concat_batches([b[1] for b in batches])
+        n_items = len(x[0]) if isinstance(x, list) else len(x)
+        return [x, y, np.arange(n_items)]
+    
+    def _image_batches(self):
+        """
+        Get the dataset indices of each image batch for one pass over the data.
+        """
+        images_per_batch = self.images_per_batch
+        n_records = len(self.dataset)
+        rank, world_size = self.shard()
+        
+        if not self.shuffle:
+            indices = np.arange(n_records)
+        else:
+            if self.seed is None and world_size == 1:
+                rng = np.random.default_rng(np.random.randint(2**31))
+            else:
+                # every process derives the same order from the seed and epoch
+                seed = 0 if self.seed is None else self.seed
+                rng = np.random.default_rng([seed, self.epoch])
+            
+            if self.bucket_by is not None:
+                # buckets are filled in the shuffled order, then their batches are shuffled
+                indices = rng.permutation(n_records)
+            elif self.shuffle is True:
+                indices = rng.permutation(n_records)
+            else:
+                indices = buffer_shuffle(n_records, int(self.shuffle), rng)
+        
+        if world_size > 1:
+            indices = np.resize(indices, self._shard_size() * world_size)[rank::world_size]
+        
+        if self.bucket_by is not None:
+            keys, _ = self._buckets()
+            buckets = {}
+            for idx in indices:
+                buckets.setdefault(keys[idx], []).append(idx)
+            image_batches = [np.array(bucket[i:i+images_per_batch])
+                             for bucket in buckets.values()
+                             for i in range(0, len(bucket), images_per_batch)]
+            if self.shuffle:
+                image_batches = [image_batches[i] for i in rng.permutation(len(image_batches))]
+            return image_batches
+        
+        return [indices[i:i+images_per_batch] 
+                for i in range(0, len(indices), images_per_batch)]
+    
+    def _buckets(self):
+        """
+        Get the bucket key of every record and the largest image shape of
+        every bucket, from the image headers. The result is cached.
+        """
+        buckets = getattr(self, '_bucket_cache', None)
+        if buckets is not None and len(buckets[0]) == len(self.dataset):
+            return buckets
+        
+        from ..datasets.metadata import record_headers
+        headers = record_headers(self.dataset)
+        if headers is None:
+            raise Exception('Bucketing requires input images that are in memory or in local files.')
+        
+        if self.bucket_by == 'shape':
+            keys = [tuple(header['shape']) for header in headers]
+        elif self.bucket_by == 'spacing':
+            keys = [tuple(round(s, 3) for s in header['spacing']) for header in headers]
+        elif callable(self.bucket_by):
+            keys = [self.bucket_by(header) for header in headers]
+        else:
+            raise ValueError(f'Unknown bucket_by value: {self.bucket_by}')
+        
+        max_shapes = {}
+        for key, header in zip(keys, headers):
+            shape = max_shapes.get(key, header['shape'])
+            max_shapes[key] = tuple(max(a, b) for a, b in zip(shape, header['shape']))
+        
+        self._bucket_cache = (keys, max_shapes)
+        return self._bucket_cache
+    
+    def _pad_shape(self, data_indices):
+        """
+        Shape that the images of an image batch are padded to, if bucketing.
+        """
+        if self.bucket_by is None:
+            return None
+        if self.transforms or getattr(self.dataset, 'transforms', None):
+            # transforms can change the shape, so pad to the largest image of the batch
+            return ()
+        keys, max_shapes = self._buckets()
+        first = (data_indices.start or 0) if isinstance(data_indices, slice) else data_indices[0]
+        return max_shapes[keys[int(first)]]
+    
+    def _transform_pool(self):
+        """
+        Open the pool of `transform_threads` threads that image batches are
+        read and transformed on. Returns a context that gives None without
+        transform threads.
+        """
+        if self.transform_threads > 1:
+            return pool_executor(self.transform_threads)
+        return nullcontext()
+    
+    def _load_image_batch(self, data_indices, executor=None):
+        """
+        Read, transform and sample one image batch and yield the
+        collated numpy batches. Without an `executor`, a pool of
+        transform threads is opened for this image batch only.
+        """
+        if executor is None and self.transform_threads > 1:
+            with self._transform_pool() as executor:
+                yield from self._load_image_batch(data_indices, executor)
+            return
+        x, y = self._read_image_batch(data_indices, executor)
+        yield from self._sample_image_batch(x, y, self._pad_shape(data_indices), executor)
+    
+    def _read_image_batch(self, data_indices, executor=None):
+        reduce = self.transforms is None
+        if isinstance(data_indices, slice):
+            data_indices = range(len(self.dataset))[data_indices]
+        if executor is not None and len(data_indices) > 1:
+            records = list(executor.map(lambda idx: self.dataset[int(idx), reduce],
+                                        data_indices))
+            return [r[0] for r in records], [r[1] for r in records]
+        return self.dataset[list(data_indices), reduce]
+    
+    def _sample_image_batch(self, x, y, pad_shape=None, executor=None):
+        """
+        Transform and sample the records of one image batch and yield
+        the collated numpy batches. If `pad_shape` is given, the images
+        are padded to that shape or to the largest image of the batch.
+        Transforms run on the pool of transform threads `executor`.
+        """
+        if self.transforms:
+            if executor is not None:
+                with thread_pool(self.transform_threads, executor):
+                    x, y = transform_records(x, y, self.transforms,
+                                             executor if len(x) > 1 else None)
+            else:
                 x, y = transform_records(x, y, self.transforms)
+        
+        if pad_shape is not None:
+            x, y = pad_records(x, y, pad_shape)
+        
+        # sample the batch
+        sampled_batch = self.sampler(x, y)
+        
+        x_dtype, y_dtype = split_dtype(self.dtype)
+        
+        # samplers that hold numpy arrays collate their batches directly
+        if hasattr(sampled_batch, 'collated_batches'):
+            yield from sampled_batch.collated_batches(self.channels_first, x_dtype, y_dtype)
+            return
+        
+        for x_batch, y_batch in sampled_batch:
 
-            image_batch_idx += 1
+            if self.channels_first is not None:
+                x_batch = expand_image_dims(x_batch, self.channels_first)
+                y_batch = expand_image_dims(y_batch, self.channels_first)
             
-            # sample the batch
-            sampled_batch = self.sampler(x, y)
+            x_batch = convert_to_numpy(x_batch, x_dtype)
+            y_batch = convert_to_numpy(y_batch, y_dtype)
             
-            for x_batch, y_batch in sampled_batch:
-
-                if self.channels_first is not None:
-                    x_batch = expand_image_dims(x_batch, self.channels_first)
-                    y_batch = expand_image_dims(y_batch, self.channels_first)
+            yield x_batch, y_batch
+    
+    def _iter_workers(self, image_batches, start_idx=0):
+        """
+        Load image batches in worker processes and yield their batches
+        in order, with the index of their image batch. At most two image
+        batches per worker are in flight so memory stays bounded.
+        """
+        threads = None
+        if self.num_threads is not None:
+            threads = thread_plan(self.num_threads, self.num_workers, self.transform_threads)[1]
+        ctx = worker_context(threads)
+        task_queue = ctx.Queue()
+        result_queue = ctx.Queue()
+        
+        # draw from the global rng so random transforms differ between epochs
+        base_seed = np.random.randint(2**31 - self.num_workers)
+        workers = [ctx.Process(target=worker_loop,
+                               args=(self, task_queue, result_queue, base_seed + i),
+                               daemon=True)
+                   for i in range(self.num_workers)]
+        for worker in workers:
+            worker.start()
+        
+        n_image_batches = len(image_batches)
+        pending = {i: [] for i in range(start_idx, n_image_batches)}
+        finished = set()
+        n_submitted = start_idx
+        
+        def submit():
+            nonlocal n_submitted
+            if n_submitted < n_image_batches:
+                task_queue.put((n_submitted, image_batches[n_submitted]))
+                n_submitted += 1
                 
-                x_batch = convert_to_numpy(x_batch)
-                y_batch = convert_to_numpy(y_batch)
+        try:
+            for _ in range(2 * self.num_workers):
+                submit()
                 
-                yield x_batch, y_batch
+            for image_batch_idx in range(start_idx, n_image_batches):
+                while True:
+                    if pending[image_batch_idx]:
+                        yield image_batch_idx, from_shared_memory(pending[image_batch_idx].pop(0))
+                    elif image_batch_idx in finished:
+                        break
+                    else:
+                        result_idx, result = get_result(result_queue, workers)
+                        if result is None:
+                            finished.add(result_idx)
+                            submit()
+                        elif isinstance(result, WorkerError):
+                            raise RuntimeError(f'Error in loader worker process:\n{result.message}')
+                        else:
+                            pending[result_idx].append(result)
+        finally:
+            # drop tasks that have not started, then stop the workers while
+            # draining results so no worker blocks on a full queue
+            while True:
+                try:
+                    task_queue.get_nowait()
+                except queue.Empty:
+                    break
+            for _ in workers:
+                task_queue.put(None)
+            
+            unconsumed = [d for descriptors in pending.values() for d in descriptors]
+            while any(w.is_alive() for w in workers):
+                try:
+                    unconsumed.append(result_queue.get(timeout=0.1)[1])
+                except queue.Empty:
+                    pass
+            while True:
+                try:
+                    unconsumed.append(result_queue.get_nowait()[1])
+                except queue.Empty:
+                    break
+            
+            # release blocks that were written but never consumed
+            for result in unconsumed:
+                if result is not None and not isinstance(result, WorkerError):
+                    free_shared_memory(result)
                 
     def __len__(self):
-        # TODO: take into account batch_size from sampler ?
-        # issue: requires loading at least one record from dataset
-        # issue: nslices, for example, may not be the same for all images in dataset
-        return math.ceil(len(self.dataset) / self.images_per_batch)
+        """
+        Number of batches in one pass over the data, taking the sampler into
+        account. The number of items the sampler takes from each record is
+        computed from the image shapes in the file headers, so no voxels are
+        decoded (see `nitrain.datasets.metadata`). For samplers that drop
+        items, such as `SliceSampler(min_foreground=...)`, this is an upper bound.
+        """
+        self._n_batches = self._count_batches()
+        return self._n_batches
+    
+    def _count_batches(self):
+        n_items = np.ones(len(self.dataset), dtype='int64')
+        n_items_fn = getattr(type(self.sampler), 'n_items', None)
+        if n_items_fn is not samplers.BaseSampler.n_items:
+            shapes = self._record_shapes() if n_items_fn is not None else None
+            if shapes is None:
+                return math.ceil(self._shard_size() / self.images_per_batch)
+            n_items = np.array([self.sampler.n_items(shape) for shape in shapes], dtype='int64')
+        
+        # plan the next epoch without consuming the global random state
+        np_state = np.random.get_state()
+        image_batches = self._image_batches()
+        np.random.set_state(np_state)
+        
+        batch_size = self.sampler.batch_size
+        if self.pool_size:
+            return math.ceil(sum(n_items[b].sum() for b in image_batches) / batch_size)
+        return sum(math.ceil(n_items[b].sum() / batch_size) for b in image_batches)
+    
+    def _record_shapes(self):
+        """
+        Get the shape of the first input image of every record from the image
+        headers. If the transforms change the shape, the transformed shape of
+        the first record is used for all records. The result is cached until
+        the headers change.
+        """
+        from ..datasets.metadata import record_headers
+        headers = record_headers(self.dataset)
+        if headers is None:
+            return None
+        
+        # a file that is written again has a new mtime and size
+        key = tuple((h['shape'], h.get('mtime'), h.get('size')) for h in headers)
+        cached = getattr(self, '_shapes', None)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        
+        shapes = [header['shape'] for header in headers]
+        if self.transforms or getattr(self.dataset, 'transforms', None):
+            # decode one record without touching the random state of training
+            np_state, py_state = np.random.get_state(), random.getstate()
+            try:
+                x, y = self._read_image_batch([0])
+                if self.transforms:
+                    x, y = transform_records(x, y, self.transforms)
+            finally:
+                np.random.set_state(np_state)
+                random.setstate(py_state)
+            
+            image = x[0]
+            while isinstance(image, list):
+                image = image[0]
+            if ants.is_image(image) and tuple(image.shape) != tuple(shapes[0]):
+                shapes = [tuple(image.shape)] * len(shapes)
+        
+        self._shapes = (key, shapes)
+        return shapes
     
     def __repr__(self):
-        s = 'Loader (batches={})\n'.format(self.__len__())
+        # the number of batches may need the image headers, so printing
+        # only shows it once len() has computed it
+        n_batches = getattr(self, '_n_batches', None)
+        s = 'Loader (batches={})\n'.format(n_batches) if n_batches is not None else 'Loader\n'
         
         s = s +\
             '   {}\n'.format(repr(self.dataset))+\
@@ -126,33 +809,219 @@ class Loader:
         return s
 
 
-def transform_records(x_list, y_list, transforms):
-    x_items = []
-    y_items = []
-    for x, y in zip(x_list, y_list):
+class WorkerError:
+    """
+    Picklable wrapper for an exception raised in a worker process.
+    """
+    def __init__(self, message):
+        self.message = message
+
+
+def worker_loop(loader, task_queue, result_queue, seed):
+    """
+    Process image batches from the task queue until a None task is received.
+    Every sampled batch is written to shared memory and only its descriptor
+    is put on the result queue, followed by None once the image batch is done.
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    
+    if loader.num_threads is not None:
+        set_image_threads(thread_plan(loader.num_threads, loader.num_workers,
+                                      loader.transform_threads)[1])
+    
+    with loader._transform_pool() as executor:
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            image_batch_idx, data_indices = task
+            try:
+                for batch in loader._load_image_batch(data_indices, executor):
+                    result_queue.put((image_batch_idx, to_shared_memory(batch)))
+            except Exception:
+                result_queue.put((image_batch_idx, WorkerError(traceback.format_exc())))
+            result_queue.put((image_batch_idx, None))
+
+
+def get_result(result_queue, workers, timeout=5):
+    while True:
+        try:
+            return result_queue.get(timeout=timeout)
+        except queue.Empty:
+            if any(w.exitcode not in (None, 0) for w in workers):
+                raise RuntimeError('A loader worker process exited unexpectedly.')
+
+
+def take_batch(x, indices):
+    if isinstance(x, list):
+        return [take_batch(xx, indices) for xx in x]
+    return x[indices]
+
+
+def concat_batches(batches):
+    if isinstance(batches[0], list):
+        return [concat_batches([b[i] for b in batches]) for i in range(len(batches[0]))]
+    return np.concatenate(batches)
+
+
+def buffer_shuffle(n, buffer_size, rng):
+    """
+    Shuffle the indices 0..n-1 with a shuffle buffer: the next index is drawn
+    at random from a buffer that is refilled in order, so every index comes
+    out at most `buffer_size` positions before its place in the input.
+    """
+    indices = np.empty(n, dtype='int64')
+    buffer = list(range(min(buffer_size, n)))
+    for i in range(n):
+        j = rng.integers(len(buffer))
+        indices[i] = buffer[j]
+        if i + len(buffer) < n:
+            buffer[j] = i + len(buffer)
+        else:
+            buffer.pop(j)
+    return indices
+
+
+def pad_records(x_list, y_list, shape):
+    """
+    Zero-pad the images of a batch of records at the end of each axis so
+    all images with as many dimensions as the largest one have the same
+    shape - at least `shape`.
+    """
+    images = []
+    def collect(value):
+        if isinstance(value, list):
+            for v in value:
+                collect(v)
+        elif ants.is_image(value):
+            images.append(value)
+    collect(x_list)
+    collect(y_list)
+    if not images:
+        return x_list, y_list
+    
+    ndim = max(max(image.dimension for image in images), len(shape))
+    target = [0] * ndim
+    for s in [shape] + [image.shape for image in images if image.dimension == ndim]:
+        if len(s) == ndim:
+            target = [max(a, b) for a, b in zip(target, s)]
+    
+    def pad(value):
+        if isinstance(value, list):
+            return [pad(v) for v in value]
+        if ants.is_image(value) and value.dimension == ndim and tuple(value.shape) != tuple(target):
+            return pad_image(value, target)
+        return value
+    
+    return pad(x_list), pad(y_list)
+
+
+def pad_image(image, shape):
+    """
+    Zero-pad an image at the end of each axis, which keeps its origin.
+    """
+    array = image.numpy()
+    pad_width = [(0, s - d) for s, d in zip(shape, image.shape)]
+    if image.has_components:
+        pad_width.append((0, 0))
+    return ants.from_numpy(np.pad(array, pad_width), origin=image.origin,
+                           spacing=image.spacing, direction=image.direction,
+                           has_components=image.has_components)
+
+
+def read_ahead(iterable, n_ahead):
+    """
+    Iterate over `iterable` while its next `n_ahead` items are computed
+    in a background thread.
+    """
+    iterator = iter(iterable)
+    end = object()
+    # a single thread calls next() so items are produced one at a time, in order
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        futures = deque(executor.submit(next, iterator, end) for _ in range(n_ahead))
+        while True:
+            item = futures.popleft().result()
+            if item is end:
+                break
+            futures.append(executor.submit(next, iterator, end))
+            yield item
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def distributed_env():
+    """
+    Get the (rank, world_size) of this process from the environment
+    variables set by torch launchers, or from an initialized
+    torch.distributed process group. Defaults to a single process.
+    """
+    if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
+        return int(os.environ['RANK']), int(os.environ['WORLD_SIZE'])
+    
+    # only look at torch if it was already imported by the user
+    dist = sys.modules.get('torch.distributed')
+    if dist is not None and dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+
+def transform_records(x_list, y_list, transforms, executor=None):
+    """
+    Apply transforms to every record of a batch, on the threads of
+    `executor` if one is given.
+    """
+    def transform_record(x, y):
         for tx_name, tx_value in transforms.items():
             x, y = apply_transforms(tx_name, tx_value, x, y)
-                                
-        x = reduce_to_list(x)
-        y = reduce_to_list(y)
-        
-        x_items.append(x)
-        y_items.append(y)
+        return reduce_to_list(x), reduce_to_list(y)
+    
+    if executor is not None:
+        records = list(executor.map(transform_record, x_list, y_list))
+    else:
+        records = [transform_record(x, y) for x, y in zip(x_list, y_list)]
     
-    return x_items, y_items
+    return [r[0] for r in records], [r[1] for r in records]
     
-def convert_to_numpy(x):
+def convert_to_numpy(x, dtype=None):
     """
+    Collate a (possibly nested) list of images or values into numpy arrays.
+    
+    Each image is copied exactly once, directly into the collated array,
+    and cast to `dtype` if given.
+    
     img = ants.image_read(ants.get_data('r16'))
     x = [[img,img,img], [img, img, img]]
     x2 = convert_to_numpy(x)
     """
     if isinstance(x[0], list):
-        return [convert_to_numpy(xx) for xx in x]
+        return [convert_to_numpy(xx, dtype) for xx in x]
     if ants.is_image(x[0]):
-        return np.array([xx.numpy() for xx in x])
+        first = image_view(x[0])
+        batch = np.empty((len(x),) + first.shape, dtype=dtype or first.dtype)
+        for i, xx in enumerate(x):
+            batch[i] = image_view(xx)
+        return batch
     else:
-        return np.array(x)
+        x = np.array(x)
+        if dtype is not None and x.dtype.kind in 'biuf':
+            x = x.astype(dtype, copy=False)
+        return x
+
+def image_view(image):
+    """
+    Get a numpy view of image data laid out like image.numpy() but without a copy
+    """
+    array = image.view()
+    if image.has_components and not image.channels_first:
+        array = np.moveaxis(array, 0, -1)
+    return array
+
+def split_dtype(dtype):
+    if isinstance(dtype, dict):
+        return dtype.get('inputs'), dtype.get('outputs')
+    return dtype, None
 
 def expand_image_dims(x, channels_first):
     mytx = tx.AddChannel(channels_first)
@@ -164,25 +1033,27 @@ def expand_image_dims(x, channels_first):
         else:
             return x
     
-def record_generator(loader):
+def to_tuple(x):
+    if isinstance(x, (list, tuple)):
+        return tuple([to_tuple(xx) for xx in x])
+    return x
+
+def batch_spec(x):
     """
-    This function takes a batch and returns individual records from it.
-    
-    It is necessary for tf.keras generators
+    Get a tf.TensorSpec with an unknown batch dimension for a
+    (possibly nested) numpy batch.
     """
-    my_iter = iter(loader)
-    for x_batch, y_batch in my_iter:
-        if isinstance(x_batch, list) and isinstance(x_batch[0], np.ndarray):
-            if isinstance(y_batch, list) and isinstance(y_batch[0], np.ndarray):
-                for i in range(len(x_batch[0])):
-                    yield tuple([xb[i] for xb in x_batch]), tuple([yb[i] for yb in y_batch])
-            else:
-                for i in range(len(x_batch[0])):
-                    yield tuple([xb[i] for xb in x_batch]), y_batch[i]
-        else:
-            if isinstance(y_batch, list) and isinstance(y_batch[0], np.ndarray):
-                for i in range(len(x_batch)):
-                    yield x_batch[i], tuple([yb[i] for yb in y_batch])
-            else:
-                for i in range(len(x_batch)):
-                    yield x_batch[i], y_batch[i]
\ No newline at end of file
+    import tensorflow as tf
+    if isinstance(x, (list, tuple)):
+        return tuple([batch_spec(xx) for xx in x])
+    spec = tf.type_spec_from_value(x)
+    return tf.TensorSpec(shape=[None] + spec.shape[1:].as_list(), dtype=spec.dtype)
+
+def stack_batches(batches, batch_size):
+    """
+    Stack batches along a new first axis, padding smaller batches
+    with repeats of their first item up to batch_size.
+    """
+    batches = [np.concatenate([b, np.repeat(b[:1], batch_size-len(b), axis=0)])
+               if len(b) < batch_size else b for b in batches]
+    return np.stack(batches)
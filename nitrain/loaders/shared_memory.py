@@ -0,0 +1,164 @@
+"""
+Shared-memory transport for moving batches between processes.
+
+Worker processes write every array of a (possibly nested) batch into a
+single `multiprocessing.shared_memory` block and only a small descriptor
+is sent back over the queue. The parent maps the block and gets numpy
+arrays that view the shared memory directly, so voxel data is never pickled.
+"""
+import sys
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+__all__ = ['to_shared_memory',
+           'from_shared_memory',
+           'free_shared_memory']
+
+# byte alignment of each array inside a block
+ALIGNMENT = 64
+
+
+def to_shared_memory(batch):
+    """
+    Copy all numpy arrays in a batch into one shared memory block.
+
+    The batch can be an array, a scalar, or any nesting of lists and tuples
+    of those - e.g. the `(x_batch, y_batch)` tuples yielded by a Loader with
+    multiple inputs. Arrays with object dtype are passed through as values.
+
+    The process that calls `from_shared_memory` on the returned descriptor
+    becomes the owner of the block and is responsible for releasing it.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from nitrain.loaders.shared_memory import to_shared_memory, from_shared_memory
+    >>> x = [np.zeros((4,32,32,1)), np.ones((4,32,32,1))]
+    >>> desc = to_shared_memory((x, np.arange(4)))
+    >>> x2, y2 = from_shared_memory(desc)
+    """
+    arrays = []
+    layout = _build_layout(batch, arrays)
+
+    size = 0
+    offsets = []
+    for array in arrays:
+        size = _align(size)
+        offsets.append(size)
+        size += array.nbytes
+
+    shm = _create_block(max(size, 1))
+    try:
+        for array, offset in zip(arrays, offsets):
+            target = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf, offset=offset)
+            target[...] = array
+            del target
+    finally:
+        shm.close()
+
+    return (shm.name, _fill_offsets(layout, iter(offsets)))
+
+
+def from_shared_memory(descriptor):
+    """
+    Map a batch written with `to_shared_memory` without copying it.
+
+    The block is unlinked immediately so it can never be leaked. The
+    memory itself stays mapped until the last array viewing it is deleted.
+    """
+    name, layout = descriptor
+    block = SharedBlock(name)
+    return _rebuild(layout, block)
+
+
+def free_shared_memory(descriptor):
+    """
+    Release the block behind a descriptor that will never be mapped.
+    """
+    name, _ = descriptor
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+class SharedBlock:
+    """
+    Owner of an attached shared memory block.
+
+    Arrays returned by `view` keep a reference to the block through their
+    `base`, so the mapping is closed only after every view is gone.
+    """
+    def __init__(self, name):
+        self.shm = shared_memory.SharedMemory(name=name)
+        self.shm.unlink()
+
+        # read the address through a temporary view so no buffer export
+        # is left open on the block (which would make close() fail)
+        tmp = np.frombuffer(self.shm.buf, dtype='uint8')
+        self.address = tmp.ctypes.data
+        del tmp
+
+    def view(self, offset, shape, dtype):
+        return np.asarray(_ArrayInterface(self, offset, shape, dtype))
+
+    def __del__(self):
+        self.shm.close()
+
+
+class _ArrayInterface:
+    def __init__(self, block, offset, shape, dtype):
+        self.block = block
+        self.__array_interface__ = {
+            'shape': tuple(shape),
+            'typestr': np.dtype(dtype).str,
+            'data': (block.address + offset, False),
+            'version': 3
+        }
+
+
+def _create_block(size):
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(create=True, size=size, track=False)
+
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    # the consuming process owns the block, so the resource tracker of
+    # this process must not unlink it when the process exits
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _build_layout(x, arrays):
+    if isinstance(x, (list, tuple)):
+        return (type(x).__name__, [_build_layout(xx, arrays) for xx in x])
+    if isinstance(x, np.ndarray) and x.dtype != object:
+        arrays.append(np.ascontiguousarray(x))
+        return ('array', None, x.shape, x.dtype.str)
+    return ('value', x)
+
+
+def _fill_offsets(layout, offsets):
+    kind = layout[0]
+    if kind in ('list', 'tuple'):
+        return (kind, [_fill_offsets(ll, offsets) for ll in layout[1]])
+    if kind == 'array':
+        return ('array', next(offsets), layout[2], layout[3])
+    return layout
+
+
+def _rebuild(layout, block):
+    kind = layout[0]
+    if kind == 'list':
+        return [_rebuild(ll, block) for ll in layout[1]]
+    if kind == 'tuple':
+        return tuple([_rebuild(ll, block) for ll in layout[1]])
+    if kind == 'array':
+        _, offset, shape, dtype = layout
+        return block.view(offset, shape, dtype)
+    return layout[1]
@@ -0,0 +1,140 @@
+"""
+Thread budget of the data pipeline.
+
+ITK filters - and so ANTs operations such as N4 bias correction, smoothing,
+resampling and applying transforms - use one thread per core by default. With
+several loader worker processes, every worker then starts a thread per core
+and the machine is oversubscribed. A thread budget splits the cores over the
+workers instead.
+
+ITK reads its default number of threads once per process, when its first
+multi-threaded filter runs, and forked processes inherit it. So a budget only
+takes effect in processes that are started fresh, with the spawn method, and
+with the budget in their environment. It cannot change the threads of a
+process that has already transformed images.
+"""
+import os
+import sys
+import multiprocessing
+from contextlib import contextmanager
+
+__all__ = ['thread_plan',
+           'set_image_threads',
+           'image_threads_env',
+           'worker_context',
+           'BudgetContext']
+
+THREAD_VARIABLES = ('ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS', 'OMP_NUM_THREADS')
+
+
+def thread_plan(num_threads, num_workers, transform_threads=0):
+    """
+    Split a budget of threads over the processes and transform threads that
+    read and transform images. Returns the kind of parallelism and the number
+    of threads that each ITK filter may use:
+
+    - 'intra' : one process transforms one image at a time and each
+      filter uses all threads, which is fastest for a few large volumes.
+    - 'inter' : images are transformed in parallel, in worker processes
+      and/or on `transform_threads` threads per process, and each filter
+      uses an equal share of the threads.
+
+    Examples
+    --------
+    >>> from nitrain.loaders.threads import thread_plan
+    >>> thread_plan(16, num_workers=4)
+    ('inter', 4)
+    >>> thread_plan(16, num_workers=2, transform_threads=4)
+    ('inter', 2)
+    """
+    if num_threads is None:
+        num_threads = os.cpu_count() or 1
+    n_parallel = max(num_workers, 1) * max(transform_threads, 1)
+    if n_parallel == 1:
+        return 'intra', num_threads
+    return 'inter', max(1, num_threads // n_parallel)
+
+
+def set_image_threads(num_threads, torch_threads=True):
+    """
+    Set the number of threads used by ITK filters and OpenMP in this process
+    and, if torch is imported, by torch operations.
+
+    ITK reads its default number of threads when its first multi-threaded
+    filter is created, so this only takes effect for ITK in a process that
+    has not transformed any image yet. Torch threads can be changed anytime.
+    """
+    num_threads = max(1, int(num_threads))
+    for name in THREAD_VARIABLES:
+        os.environ[name] = str(num_threads)
+
+    torch = sys.modules.get('torch')
+    if torch_threads and torch is not None:
+        torch.set_num_threads(num_threads)
+
+
+@contextmanager
+def image_threads_env(num_threads):
+    """
+    Set the ITK and OpenMP thread variables of this process for the duration
+    of the context, so that processes started within it inherit the budget.
+
+    Examples
+    --------
+    >>> with image_threads_env(4):
+    ...     worker.start()
+    """
+    previous = {name: os.environ.get(name) for name in THREAD_VARIABLES}
+    try:
+        set_image_threads(num_threads, torch_threads=False)
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+class BudgetProcess(multiprocessing.context.SpawnProcess):
+    """
+    Spawned process that starts with a thread budget in its environment.
+    """
+    num_threads = None
+
+    def start(self):
+        with image_threads_env(self.num_threads):
+            super().start()
+
+
+class BudgetContext(multiprocessing.context.SpawnContext):
+    """
+    Spawn context whose processes start with a thread budget.
+    """
+    def __init__(self, num_threads):
+        super().__init__()
+        self.num_threads = num_threads
+
+    def Process(self, *args, **kwargs):
+        process = BudgetProcess(*args, **kwargs)
+        process.num_threads = self.num_threads
+        return process
+
+
+def worker_context(num_threads):
+    """
+    Get the multiprocessing context to start worker processes with. With a
+    thread budget per worker, forked workers would inherit the ITK threads of
+    this process, so they are spawned with the budget in their environment
+    instead. Spawned workers import nitrain again, which takes a few seconds,
+    and the loader must be picklable.
+
+    Examples
+    --------
+    >>> ctx = worker_context(4)
+    >>> worker = ctx.Process(target=print, args=('hello',))
+    >>> worker.start()
+    """
+    if num_threads is None:
+        return multiprocessing.get_context()
+    return BudgetContext(num_threads)
@@ -0,0 +1,136 @@
+import random
+from copy import copy
+import numpy as np
+import ants
+
+import torch
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+
+from .loader import transform_records, expand_image_dims, split_dtype
+from .threads import thread_plan, set_image_threads
+
+__all__ = ['TorchDataset',
+           'TorchLoaderDataset',
+           'worker_init_fn']
+
+
+class TorchDataset(Dataset):
+    """
+    Map-style torch dataset for a nitrain dataset.
+
+    Each item is one record read with the dataset's readers and transforms,
+    plus any extra (e.g., random) transforms, and returned as numpy arrays
+    so the default torch collate function can batch them. Use this with
+    torch.utils.data.DataLoader to get multi-process loading, pin_memory
+    and persistent_workers.
+
+    Examples
+    --------
+    >>> from torch.utils.data import DataLoader
+    >>> from nitrain.loaders.torch_dataset import TorchDataset, worker_init_fn
+    >>> torch_dataset = TorchDataset(dataset, transforms={'inputs': tx.RandomFlip()})
+    >>> torch_loader = DataLoader(torch_dataset, batch_size=8, shuffle=True,
+                                  num_workers=4, worker_init_fn=worker_init_fn)
+    """
+    def __init__(self, dataset, transforms=None, channels_first=True, dtype=None):
+        self.dataset = dataset
+        self.transforms = transforms
+        self.channels_first = channels_first
+        self.dtype = dtype
+
+    def __getitem__(self, idx):
+        x, y = self.dataset[int(idx), self.transforms is None]
+
+        if self.transforms:
+            x, y = transform_records([x], [y], self.transforms)
+            x, y = x[0], y[0]
+
+        if self.channels_first is not None:
+            x = expand_image_dims(x, self.channels_first)
+            y = expand_image_dims(y, self.channels_first)
+
+        x_dtype, y_dtype = split_dtype(self.dtype)
+        return record_to_numpy(x, x_dtype), record_to_numpy(y, y_dtype)
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+class TorchLoaderDataset(IterableDataset):
+    """
+    Iterable torch dataset that yields the sampled batches of a nitrain loader.
+
+    The image batches of the loader are split across torch workers so that
+    each record is read and transformed by exactly one worker. This is
+    what `Loader.to_torch()` uses under the hood.
+    """
+    def __init__(self, loader):
+        self.loader = loader
+        self._n_iterations = 0
+
+    def __iter__(self):
+        loader = self.loader
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            # every worker must plan the same epoch. Torch gives all workers
+            # of an iteration the same base seed, and persistent workers count
+            # their iterations because they do not see `set_epoch` calls
+            loader = copy(self.loader)
+            loader.epoch = self.loader.epoch + self._n_iterations
+            self._n_iterations += 1
+            if loader.seed is not None:
+                # random transforms of seeded loaders are reproducible, but
+                # differ between workers and epochs
+                seed_worker(loader.seed, loader.epoch, worker_info.id)
+            elif loader.shard()[1] == 1:
+                loader.seed = (worker_info.seed - worker_info.id) % 2**63
+
+        image_batches = loader._image_batches()
+
+        if worker_info is not None:
+            image_batches = image_batches[worker_info.id::worker_info.num_workers]
+            # ITK already has the budget of the environment the worker was
+            # spawned with, this also limits the torch threads of the worker
+            if self.loader.num_threads is not None:
+                set_image_threads(thread_plan(self.loader.num_threads,
+                                              worker_info.num_workers,
+                                              self.loader.transform_threads)[1])
+
+        with loader._transform_pool() as executor:
+            for data_indices in image_batches:
+                yield from loader._load_image_batch(data_indices, executor)
+
+
+def worker_init_fn(worker_id):
+    """
+    Seed the numpy and python random number generators of a torch worker
+    from its torch seed.
+
+    Torch >= 1.9 already seeds both generators differently in every worker
+    and epoch, and this gives older versions the same behaviour. Loaders with
+    a `seed` reseed both generators from it when each epoch starts.
+    """
+    seed = torch.initial_seed() % 2**32
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+def seed_worker(seed, epoch, worker_id):
+    """
+    Seed the numpy and python random number generators of a torch worker
+    from the seed of a loader, the epoch and the worker.
+    """
+    seed = int(np.random.SeedSequence([seed, epoch, worker_id]).generate_state(1)[0])
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+def record_to_numpy(x, dtype=None):
+    if isinstance(x, list):
+        return [record_to_numpy(xx, dtype) for xx in x]
+    if ants.is_image(x):
+        x = x.numpy()
+    x = np.asarray(x)
+    if dtype is not None and x.dtype.kind in 'biuf':
+        x = x.astype(dtype, copy=False)
+    return x
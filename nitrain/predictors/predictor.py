@@ -1,16 +1,86 @@
+import os
 import numpy as np
 import ants
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 from ..loaders import Loader
+from ..samplers import PatchSampler, BlockSampler
+from ..samplers.base import grid_indices
 
 class Predictor:
-    
-    def __init__(self, model, task, sampler=None, expand_dims=-1):
+
+    def __init__(self, model, task, sampler=None, expand_dims=-1, overlap=None, blend='gaussian',
+                 batch_size=None, num_workers=1, tta=None):
+        """
+        Create a predictor from a fitted model.
+
+        Arguments
+        ---------
+        model : keras or torch model
+            the fitted model
+
+        task : string
+            options: regression, classification, segmentation
+
+        sampler : nitrain sampler (optional)
+            the sampler to apply to each record before inference. With a
+            PatchSampler or BlockSampler, sliding-window inference is used
+            and the window predictions are stitched back into a full image.
+
+        expand_dims : integer or None
+            the axis at which to add a channel dimension to each sampled
+            image. Use 0 for channels-first (e.g., torch) models.
+
+        overlap : float (optional)
+            fraction of the window size that neighboring windows overlap
+            during sliding-window inference. If None, the stride of the
+            sampler is used.
+
+        blend : string
+            how overlapping window predictions are combined during
+            sliding-window inference. Options: gaussian, mean. Gaussian
+            blending gives less weight to the window borders.
+
+        batch_size : integer (optional)
+            the number of items (slices, patches, windows or whole images)
+            per model call. Items from consecutive records are packed
+            together to fill each batch. Defaults to the batch size of
+            the sampler, or 1 if there is no sampler.
+
+        num_workers : integer
+            the number of threads used to read records ahead of the model
+            and, in `predict_to_dir`, to write the predicted images.
+
+        tta : list of transforms (optional)
+            test-time augmentations, e.g. [tx.Flip(0), tx.Rotate(10)]. Each
+            augmentation is applied to the preprocessed record, the prediction
+            is mapped back with the inverse of the augmentation, and the
+            predictions of all copies and the original are averaged. Transforms
+            must implement `inverse()`.
+
+        Examples
+        --------
+        >>> from nitrain.samplers import PatchSampler
+        >>> predictor = nt.Predictor(model, task='segmentation',
+                                     sampler=PatchSampler(32, 32, batch_size=16),
+                                     overlap=0.5)
+        >>> y_pred = predictor.predict(dataset)
+        """
+        if blend not in ('gaussian', 'mean'):
+            raise ValueError('Valid blend options: `gaussian`, `mean`.')
+
         self.model = model
         self.task = task
         self.sampler = sampler
         self.expand_dims = expand_dims
-    
+        self.overlap = overlap
+        self.blend = blend
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.tta = tta
+
     def predict(self, dataset):
         """
         Perform inference on an nt.Dataset.
@@ -27,44 +97,502 @@ class Predictor:
         The result of the prediction will be one (or a sequence of) of the 
         following depending on the model: ntimage, np.ndarray, scalar.
         """
+        return list(self.predict_iter(dataset))
+
+    def predict_iter(self, dataset):
+        """
+        Perform inference on an nt.Dataset and yield the prediction of each
+        record, in order, as soon as it is ready.
+        
+        Unlike `predict`, the predictions are never all held in memory so this
+        can be used for datasets of any size.
+        
+        Examples
+        --------
+        >>> predictor = nt.Predictor(model, task='segmentation', sampler=SliceSampler())
+        >>> for y_pred in predictor.predict_iter(dataset):
+        ...     print(y_pred.shape)
+        """
+        return self._iter_predictions(dataset, range(len(dataset)))
+
+    def predict_to_dir(self, dataset, out_dir, suffix='.nii.gz', overwrite=False):
+        """
+        Perform inference on an nt.Dataset and write each predicted image
+        to a directory as soon as it is ready.
+        
+        Output files are named after the record ids of the inputs if the
+        reader has them, otherwise after the input file paths (relative to
+        their common directory) or the record index. Records whose output file
+        already exists are skipped unless `overwrite` is True, so an
+        interrupted run can be resumed by calling this again.
+        
+        Files are first written under a temporary name and then renamed, so a
+        partially written file is never mistaken for a finished output.
+        
+        Returns the list of output file paths of all records.
+        
+        Examples
+        --------
+        >>> predictor = nt.Predictor(model, task='segmentation',
+                                     sampler=SliceSampler(), num_workers=4)
+        >>> files = predictor.predict_to_dir(dataset, '~/Desktop/predictions')
+        """
+        out_dir = os.path.expanduser(out_dir)
+        files = [os.path.join(out_dir, name) for name in output_filenames(dataset, suffix)]
+        
+        if overwrite:
+            indices = list(range(len(dataset)))
+        else:
+            indices = [i for i, file in enumerate(files) if not os.path.exists(file)]
         
-        y_pred_list = []
-        for x, y in dataset:
-            sampled_batch = self.sampler([x], [y])
+        writes = deque()
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            for idx, y_pred in zip(indices, self._iter_predictions(dataset, indices)):
+                if not ants.is_image(y_pred):
+                    raise ValueError('predict_to_dir can only be used when the predictions are images.')
+                
+                writes.append(executor.submit(write_image, y_pred, files[idx]))
+                
+                # bound the number of finished predictions held in memory
+                while len(writes) > 2 * self.num_workers:
+                    writes.popleft().result()
             
-            y_pred = []
-            for x_batch, y_batch in sampled_batch:
-                if isinstance(x_batch[0], list):
-                    x_batch_return = []
-                    for i in range(len(x_batch[0])):
-                        tmp_x_batch = np.array([np.expand_dims(xx[i].numpy(), self.expand_dims) if self.expand_dims else xx.numpy() for xx in x_batch])
-                        x_batch_return.append(tmp_x_batch)
-                    x_batch = x_batch_return
-                else:
-                    x_batch = np.array([np.expand_dims(xx.numpy(), self.expand_dims) if self.expand_dims else xx.numpy() for xx in x_batch])
+            while writes:
+                writes.popleft().result()
+        
+        return files
+
+    def _iter_predictions(self, dataset, indices):
+        """
+        Yield the prediction of each record in `indices` in order.
+        
+        The sampled items (slices, patches, windows or whole images) of
+        consecutive records are packed into full model batches of
+        `batch_size` items, so small records do not lead to tiny model calls.
+        Each item keeps a reference to the job of its record so the batch
+        predictions can be scattered back, and a record is yielded as soon
+        as all of its items are predicted. The next records are read by a
+        pool of `num_workers` threads while the model runs.
+        """
+        batch_size = self.batch_size or getattr(self.sampler, 'batch_size', None)
+        if batch_size is None:
+            # whole images: all augmented copies of a record go in one batch
+            batch_size = len(self.tta) + 1 if self.tta else 1
+        
+        jobs = deque()
+        batch = []
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            for x, y in read_records(dataset, indices, executor, self.num_workers):
+                job = self._create_job(x, y)
+                jobs.append((x, job))
+                
+                for item_idx, item in enumerate(job.items()):
+                    # items of different shapes cannot be stacked together
+                    if batch and not same_shapes(batch[0][2], item):
+                        self._run_batch(batch)
+                        batch = []
+                    batch.append((job, item_idx, item))
+                    if len(batch) == batch_size:
+                        self._run_batch(batch)
+                        batch = []
                 
-                # TODO: write general function for model prediction
-                tmp_y_pred = self.model.predict(x_batch)
-                y_pred.append(tmp_y_pred)
+                while jobs and jobs[0][1].is_done():
+                    x, job = jobs.popleft()
+                    yield self._process_prediction(job.result(), x)
             
-            # TODO: handle multiple inputs
-            y_pred = np.concatenate(y_pred)
-            y_pred = np.squeeze(y_pred)
+            if batch:
+                self._run_batch(batch)
             
-            # put sampled axis in correct place
-            if 'SliceSampler' in str(type(self.sampler)):
-                y_pred = np.rollaxis(y_pred, 0, self.sampler.axis) 
+            while jobs:
+                x, job = jobs.popleft()
+                yield self._process_prediction(job.result(), x)
+
+    def _create_job(self, x, y):
+        if self.tta:
+            return AugmentedJob(self, x, y)
+        return self._create_sampling_job(x, y)
+
+    def _create_sampling_job(self, x, y):
+        if isinstance(self.sampler, (PatchSampler, BlockSampler)):
+            return WindowJob(self, x)
+        elif self.sampler is None:
+            return RecordJob(self, x)
+        else:
+            return SampledJob(self, x, y)
+
+    def _run_batch(self, batch):
+        n_inputs = len(batch[0][2])
+        x_batch = [np.stack([item[i] for _, _, item in batch]) for i in range(n_inputs)]
+        y_batch = predict_batch(self.model, x_batch if n_inputs > 1 else x_batch[0])
+        
+        for (job, item_idx, _), y_item in zip(batch, y_batch):
+            job.add(item_idx, y_item)
+
+    def _process_prediction(self, y_pred, x):
+        # process prediction according to task
+        if y_pred.ndim > 1:
+            if self.task == 'segmentation' or self.task == 'classification':
+                y_pred = np.round(y_pred).astype('uint8')
             
-            # process prediction according to task
-            if y_pred.ndim > 1:
-                if self.task == 'segmentation' or self.task == 'classification':
-                    y_pred = np.round(y_pred).astype('uint8')
+            # copy the spatial metadata of the source image when possible
+            reference = x[0] if isinstance(x, list) else x
+            if ants.is_image(reference) and tuple(y_pred.shape[:reference.dimension]) == tuple(reference.shape) \
+                and y_pred.ndim <= reference.dimension + 1:
+                y_pred = ants.from_numpy(y_pred, origin=reference.origin,
+                                         spacing=reference.spacing,
+                                         direction=reference.direction,
+                                         has_components=y_pred.ndim > reference.dimension)
+            else:
                 y_pred = ants.from_numpy(y_pred)
                 
-            y_pred_list.append(y_pred)
+        return y_pred
+
+    def _expand(self, array):
+        return expand_channel(array, self.expand_dims)
+
+
+class RecordJob:
+    """
+    Inference job that predicts a whole record as one item.
+    """
+    def __init__(self, predictor, x):
+        self.predictor = predictor
+        self.x = x if isinstance(x, list) else [x]
+        self.n_items = 1
+        self.y = None
+    
+    def items(self):
+        yield [self.predictor._expand(xx.numpy()) for xx in self.x]
+    
+    def add(self, item_idx, y):
+        self.y = y
+    
+    def is_done(self):
+        return self.y is not None
+    
+    def result(self):
+        return np.squeeze(self.y)
 
-        return y_pred_list
 
+class SampledJob:
+    """
+    Inference job that predicts every item produced by the sampler
+    for a record and stacks the predictions back in sampling order.
+    """
+    def __init__(self, predictor, x, y):
+        self.predictor = predictor
+        self.x = x
+        self.y_true = y
+        self.n_items = None
+        self.n_done = 0
+    
+    def items(self):
+        # the sampler keeps state, so it is only run once items are requested
+        sampled = self.predictor.sampler([self.x], [self.y_true])
+        self.n_items = sampled.batch_length
+        self.y = [None] * self.n_items
+        
+        for x_batch, _ in sampled:
+            if isinstance(x_batch[0], list):
+                for i in range(len(x_batch[0])):
+                    yield [self.predictor._expand(xx[i].numpy()) for xx in x_batch]
+            else:
+                for xx in x_batch:
+                    yield [self.predictor._expand(xx.numpy())]
+    
+    def add(self, item_idx, y):
+        self.y[item_idx] = y
+        self.n_done += 1
+    
+    def is_done(self):
+        return self.n_done == self.n_items
+    
+    def result(self):
+        y_pred = np.squeeze(np.stack(self.y))
+        
+        # put sampled axis in correct place
+        if 'SliceSampler' in str(type(self.predictor.sampler)):
+            y_pred = np.moveaxis(y_pred, 0, self.predictor.sampler.axis)
+        
+        return y_pred
+
+
+class AugmentedJob:
+    """
+    Test-time augmentation job for one record.
+    
+    Each augmentation is applied to the already preprocessed record and
+    gets its own inference job. The items of all augmented copies are
+    packed into the same model batches. The prediction of each copy is
+    mapped back with the inverse of its augmentation and all copies
+    (including the original) are averaged.
+    """
+    def __init__(self, predictor, x, y):
+        self.jobs = []
+        self.inverses = []
+        self.references = []
+        for transform in [None] + list(predictor.tta):
+            if transform is None:
+                x_aug = x
+                inverse = None
+            else:
+                # the first input is transformed last so that the inverse
+                # of the transform refers to it
+                if isinstance(x, list):
+                    x_aug = [transform(xx) for xx in reversed(x)][::-1]
+                else:
+                    x_aug = transform(x)
+                inverse = transform.inverse()
             
+            self.jobs.append(predictor._create_sampling_job(x_aug, y))
+            self.inverses.append(inverse)
+            self.references.append(x_aug[0] if isinstance(x_aug, list) else x_aug)
+        
+        self.owners = []
+    
+    def items(self):
+        for job in self.jobs:
+            for item_idx, item in enumerate(job.items()):
+                self.owners.append((job, item_idx))
+                yield item
+    
+    def add(self, item_idx, y):
+        job, job_item_idx = self.owners[item_idx]
+        job.add(job_item_idx, y)
+    
+    def is_done(self):
+        return all(job.is_done() for job in self.jobs)
+    
+    def result(self):
+        y_preds = []
+        for job, inverse, reference in zip(self.jobs, self.inverses, self.references):
+            y_pred = job.result()
+            if inverse is not None and y_pred.ndim >= reference.dimension:
+                y_pred = invert_prediction(y_pred, inverse, reference)
+            y_preds.append(y_pred)
+        return np.mean(y_preds, axis=0)
+
+
+class WindowJob:
+    """
+    Sliding-window inference job for one record.
+    
+    Windows are cut lazily from the numpy array of each input and the
+    weighted predictions are accumulated into a single preallocated
+    volume, so memory use is bounded by the windows in flight.
+    """
+    def __init__(self, predictor, x):
+        self.predictor = predictor
+        sampler = predictor.sampler
+        
+        inputs = [xx.numpy() for xx in x] if isinstance(x, list) else [x.numpy()]
+        self.shape = inputs[0].shape
         
-        
\ No newline at end of file
+        size = getattr(sampler, 'patch_size', None) or sampler.block_size
+        self.size = list(size)
+        if predictor.overlap is None:
+            stride = list(sampler.stride)
+        else:
+            stride = [max(1, int(round(s * (1 - predictor.overlap)))) for s in self.size]
+        
+        # pad images that are smaller than a window
+        pad_width = [(0, max(0, w - s)) for w, s in zip(self.size, self.shape)]
+        if any(p[1] > 0 for p in pad_width):
+            inputs = [np.pad(xx, pad_width + [(0, 0)] * (xx.ndim - len(self.size))) for xx in inputs]
+        self.inputs = inputs
+        self.padded_shape = inputs[0].shape[:len(self.size)]
+        
+        self.weights = window_weights(self.size, predictor.blend)
+        self.indices = grid_indices(self.padded_shape, self.size, stride, cover=True)
+        self.n_items = len(self.indices)
+        self.n_done = 0
+        
+        self.output = None
+        self.norm = np.zeros(self.padded_shape, dtype='float32')
+    
+    def window(self, item_idx):
+        return tuple(slice(a, a + w) for a, w in zip(self.indices[item_idx], self.size))
+    
+    def items(self):
+        for item_idx in range(self.n_items):
+            window = self.window(item_idx)
+            yield [self.predictor._expand(xx[window]) for xx in self.inputs]
+    
+    def add(self, item_idx, y):
+        expand_dims = self.predictor.expand_dims
+        if expand_dims is not None and expand_dims >= 0:
+            y = np.moveaxis(y, expand_dims, -1)
+        
+        if self.output is None:
+            self.output = np.zeros(self.padded_shape + y.shape[len(self.size):], dtype='float32')
+        
+        window = self.window(item_idx)
+        weights = self.weights.reshape(self.weights.shape + (1,) * (y.ndim - len(self.size)))
+        self.output[window] += y * weights
+        self.norm[window] += self.weights
+        self.n_done += 1
+    
+    def is_done(self):
+        return self.n_done == self.n_items
+    
+    def result(self):
+        output = self.output
+        output /= self.norm.reshape(self.norm.shape + (1,) * (output.ndim - self.norm.ndim))
+        output = output[tuple(slice(0, s) for s in self.shape[:len(self.size)])]
+        if output.ndim > len(self.size) and output.shape[-1] == 1:
+            output = np.squeeze(output, axis=-1)
+        return output
+
+
+def invert_prediction(y_pred, inverse, reference):
+    """
+    Map a prediction made on an augmented image back to the original
+    image space with the inverse transform of the augmentation.
+    """
+    dimension = reference.dimension
+    channels = [y_pred] if y_pred.ndim == dimension else \
+        [y_pred[..., i] for i in range(y_pred.shape[-1])]
+    
+    inverted = []
+    for channel in channels:
+        image = ants.from_numpy(np.ascontiguousarray(channel, dtype='float32'),
+                                origin=reference.origin,
+                                spacing=reference.spacing,
+                                direction=reference.direction)
+        inverted.append(inverse(image).numpy())
+    
+    return inverted[0] if y_pred.ndim == dimension else np.stack(inverted, axis=-1)
+
+
+def read_records(dataset, indices, executor, n_ahead=1):
+    """
+    Yield the records of a dataset at `indices` while reading
+    the next `n_ahead` records in the background.
+    """
+    indices = iter(indices)
+    futures = deque()
+    for idx in indices:
+        futures.append(executor.submit(dataset.__getitem__, idx))
+        if len(futures) >= n_ahead:
+            break
+    
+    while futures:
+        record = futures.popleft().result()
+        idx = next(indices, None)
+        if idx is not None:
+            futures.append(executor.submit(dataset.__getitem__, idx))
+        yield record
+
+
+def write_image(image, file):
+    os.makedirs(os.path.dirname(file) or '.', exist_ok=True)
+    tmp_file = os.path.join(os.path.dirname(file), '.partial-' + os.path.basename(file))
+    ants.image_write(image, tmp_file)
+    os.replace(tmp_file, file)
+
+
+def output_filenames(dataset, suffix='.nii.gz'):
+    """
+    Get a unique output file name for each record of a dataset.
+    """
+    reader = dataset.inputs
+    if hasattr(reader, 'readers'):
+        reader = reader.readers[0]
+    
+    ids = getattr(reader, 'ids', None)
+    if ids is not None:
+        return [f'{id}{suffix}' for id in ids]
+    
+    values = getattr(reader, 'values', None)
+    if values is not None and len(values) > 0 and all(isinstance(v, str) for v in values):
+        common_dir = os.path.commonpath([os.path.dirname(os.path.abspath(v)) for v in values])
+        names = []
+        for value in values:
+            name = os.path.relpath(os.path.abspath(value), common_dir)
+            if name.endswith('.gz'):
+                name = name[:-3]
+            names.append(os.path.splitext(name)[0] + suffix)
+        if len(set(names)) == len(names):
+            return names
+    
+    n_digits = len(str(max(len(dataset) - 1, 0)))
+    return [f'{i:0{n_digits}d}{suffix}' for i in range(len(dataset))]
+
+
+def same_shapes(item, other):
+    return all(a.shape == b.shape for a, b in zip(item, other))
+
+
+def channel_axis(expand_dims, batched=False):
+    """
+    Get the axis at which a channel dimension is added to an image, or to
+    a batch of images if `batched`, for the `expand_dims` argument of
+    predictors and explainers. Returns None if no channel is added.
+    """
+    if expand_dims is None:
+        return None
+    return expand_dims + 1 if batched and expand_dims >= 0 else expand_dims
+
+
+def expand_channel(array, expand_dims, batched=False):
+    """
+    Add the channel dimension of `expand_dims` to an image or, if `batched`,
+    to a batch of images.
+    """
+    axis = channel_axis(expand_dims, batched)
+    return array if axis is None else np.expand_dims(array, axis)
+
+
+def predict_batch(model, x):
+    """
+    Run a keras or torch model on one batch of numpy arrays and
+    return the prediction as a numpy array.
+
+    Multiple inputs can be passed as a list of arrays.
+    """
+    if hasattr(model, 'predict'):
+        return np.asarray(model.predict(x, verbose=0))
+
+    import torch
+
+    try:
+        device = next(model.parameters()).device
+    except (AttributeError, StopIteration):
+        device = 'cpu'
+
+    x = x if isinstance(x, list) else [x]
+    x = [torch.as_tensor(np.ascontiguousarray(xx, dtype='float32')).to(device) for xx in x]
+
+    training = getattr(model, 'training', False)
+    if training:
+        model.eval()
+    try:
+        with torch.no_grad():
+            y = model(*x)
+    finally:
+        if training:
+            model.train()
+    return y.detach().cpu().numpy()
+
+
+def window_weights(size, blend='gaussian'):
+    """
+    Weight map used to blend overlapping window predictions.
+
+    Gaussian weights have a sigma of 1/8 of the window size along each
+    axis and are clipped away from zero so every voxel gets some weight.
+    """
+    if blend == 'mean':
+        return np.ones(size, dtype='float32')
+
+    weights = np.ones(size, dtype='float32')
+    for axis, s in enumerate(size):
+        center = (s - 1) / 2
+        sigma = s / 8
+        profile = np.exp(-0.5 * ((np.arange(s) - center) / sigma) ** 2)
+        shape = [1] * len(size)
+        shape[axis] = s
+        weights = weights * profile.reshape(shape).astype('float32')
+
+    weights = weights / weights.max()
+    return np.maximum(weights, 1e-3).astype('float32')
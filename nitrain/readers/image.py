@@ -1,5 +1,7 @@
 import glob
 import os
+import pathlib
+from tempfile import NamedTemporaryFile
 from parse import parse
 from fnmatch import fnmatch
 import glob
@@ -11,13 +13,18 @@ import numpy as np
 import ants
 
 class ImageReader:
-    def __init__(self, pattern, base_dir=None, exclude=None, label=None):
+    def __init__(self, pattern, base_dir=None, exclude=None, label=None, dtype=None):
         """
+        The `dtype` determines the pixel type that images are read as. By default,
+        all images are read as float32. Reading segmentation images as 'uint8' keeps
+        them compact from read time on instead of promoting them to float.
+        
         >>> import ants
         >>> from nitrain.readers import ImageReader
         >>> reader = ImageReader('volumes/*.nii')
         >>> reader.map_values(base_dir='~/Desktop/kaggle-liver-ct/')
         >>> img = reader[1]
+        >>> seg_reader = ImageReader('segmentations/*.nii', dtype='uint8')
         """
         self.pattern = os.path.expanduser(pattern)
         
@@ -26,9 +33,18 @@ class ImageReader:
         self.base_dir = base_dir
         self.exclude = exclude
         self.label = label
+        self.dtype = dtype
+        
+        # set by map_gcs_values when images are read from google cloud storage
+        self.bucket = None
+        self.credentials = None
+        self._bucket_client = None
+        self._client_pid = None
     
     def select(self, idx):
-        new_reader = ImageReader(self.pattern, self.base_dir, self.exclude, self.label)
+        new_reader = ImageReader(self.pattern, self.base_dir, self.exclude, self.label, self.dtype)
+        new_reader.bucket = self.bucket
+        new_reader.credentials = self.credentials
         new_reader.values = self.values
         new_reader.values = [new_reader.values[i] for i in idx]
         return new_reader
@@ -73,6 +89,8 @@ class ImageReader:
 
         self.values = x
         self.ids = ids
+        self.bucket = bucket
+        self.credentials = credentials
         
         if self.label is None:
             if base_label is not None:
@@ -123,7 +141,51 @@ class ImageReader:
                 self.label = 'pattern'
                 
     def __getitem__(self, idx):
-        return {self.label: ants.image_read(self.values[idx])}
+        if self.bucket is not None:
+            return {self.label: self._read_gcs_image(self.values[idx])}
+        return {self.label: ants.image_read(self.values[idx], pixeltype=pixeltype(self.dtype))}
+    
+    def _read_gcs_image(self, file):
+        tmp_file = NamedTemporaryFile(suffix=''.join(pathlib.Path(file).suffixes))
+        blob = self._get_bucket_client().blob(file)
+        blob.download_to_filename(tmp_file.name)
+        image = ants.image_read(tmp_file.name, pixeltype=pixeltype(self.dtype))
+        tmp_file.close()
+        return image
+    
+    def _get_bucket_client(self):
+        # storage clients can not be shared across processes, so each
+        # worker process lazily creates its own client
+        if self._bucket_client is None or self._client_pid != os.getpid():
+            credentials = self.credentials
+            if isinstance(credentials, str):
+                credentials = service_account.Credentials.from_service_account_file(credentials)
+            storage_client = storage.Client(credentials=credentials)
+            self._bucket_client = storage_client.bucket(self.bucket)
+            self._client_pid = os.getpid()
+        return self._bucket_client
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_bucket_client'] = None
+        state['_client_pid'] = None
+        return state
     
     def __len__(self):
-        return len(self.values)
\ No newline at end of file
+        return len(self.values)
+
+
+def pixeltype(dtype):
+    """
+    Get the ANTs pixel type that can hold values of a numpy dtype. Types
+    without an ANTs equivalent (e.g., float16 or signed integers) are read
+    as float and can be narrowed at collation in the Loader.
+    """
+    if dtype is None:
+        return 'float'
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'ub':
+        return 'unsigned char' if dtype.itemsize == 1 else 'unsigned int'
+    if dtype.kind == 'f' and dtype.itemsize > 4:
+        return 'double'
+    return 'float'
@@ -28,11 +28,18 @@ class BaseSampler:
         else:
             batch_length = len(self.x)
         
-        self.n_batches = math.ceil(len(self.x) / self.batch_size)
+        self.n_batches = math.ceil(batch_length / self.batch_size)
         self.batch_length = batch_length
         
         return self
 
+    def n_items(self, shape):
+        """
+        Number of items sampled from a record whose (first) input image has
+        this shape. Used to count batches from image headers alone.
+        """
+        return 1
+
     def __iter__(self):
         """
         Get a sampled batch
@@ -41,9 +48,9 @@ class BaseSampler:
         
         # apply shuffling
         if self.shuffle:
-            indices = random.sample(range(len(self.y)), len(self.y))
-            self.x = [self.x[i] for i in indices]
-            self.y = [self.y[i] for i in indices]
+            indices = random.sample(range(self.batch_length), self.batch_length)
+            self.x = take_items(self.x, indices)
+            self.y = take_items(self.y, indices)
             
         return self
 
@@ -63,7 +70,41 @@ def select_items(x, idx):
     else:
         return x[idx]
         
+def take_items(x, indices):
+    """
+    Reorder the items of every input (or output) by a list of indices.
+    """
+    if isinstance(x[0], list):
+        return [take_items(xx, indices) for xx in x]
+    if isinstance(x, np.ndarray):
+        return x[indices]
+    return [x[i] for i in indices]
+        
 def rearrange_values(x):
     if isinstance(x[0], list):
         return [rearrange_values([x[i][j] for i in range(len(x))]) for j in range(len(x[0]))]
-    return x
\ No newline at end of file
+    return x
+
+def grid_indices(shape, size, stride, cover=False):
+    """
+    Get the start index of every window of `size` that fits in an image
+    of `shape` when moving the window by `stride` along each axis.
+    
+    The result is an array of shape (n_windows, len(size)). If cover is True,
+    a last window flush with the end of each axis is added so that the
+    windows cover every voxel even if the stride does not divide evenly.
+    
+    Examples
+    --------
+    >>> from nitrain.samplers.base import grid_indices
+    >>> grid_indices((10,10), (4,4), (4,4), cover=True)
+    """
+    axis_starts = []
+    for dim_size, window_size, window_stride in zip(shape, size, stride):
+        starts = list(range(0, dim_size - window_size + 1, window_stride))
+        if cover and starts and starts[-1] != dim_size - window_size:
+            starts.append(dim_size - window_size)
+        axis_starts.append(starts)
+    
+    grid = np.meshgrid(*axis_starts)
+    return np.stack([g.flatten() for g in grid], axis=-1).astype('int64')
@@ -2,7 +2,7 @@ import numpy as np
 import ants
 import math
 
-from .base import BaseSampler
+from .base import BaseSampler, grid_indices
 
 class BlockSampler(BaseSampler):
     """
@@ -21,6 +21,9 @@ class BlockSampler(BaseSampler):
         self.batch_size = batch_size
         self.shuffle = shuffle
     
+    def n_items(self, shape):
+        return len(grid_indices(shape, self.block_size, self.stride))
+    
     def __call__(self, x, y):
         # create patches of all images
         self.x, self.y = create_blocks(x, y, self.block_size, self.stride)
@@ -33,7 +36,7 @@ class BlockSampler(BaseSampler):
         else:
             batch_length = len(self.x)
         
-        self.n_batches = math.ceil(len(self.x) / self.batch_size)
+        self.n_batches = math.ceil(batch_length / self.batch_size)
         self.batch_length = batch_length
         
         return self
@@ -44,16 +47,9 @@ def create_blocks(images, values, block_size, stride):
     new_outputs = []
     for tmp_input, tmp_output in zip(images, values):
         # extract all blocks
-        x_strides = np.arange(0, (tmp_input.shape[0]-block_size[0]+1), step=stride[0])
-        y_strides = np.arange(0, (tmp_input.shape[1]-block_size[1]+1), step=stride[1])
-        z_strides = np.arange(0, (tmp_input.shape[2]-block_size[2]+1), step=stride[2])
-        
-        grid = np.meshgrid(x_strides, y_strides, z_strides)
-        x_indices = grid[0].flatten()
-        y_indices = grid[1].flatten()
-        z_indices = grid[2].flatten()
+        indices = grid_indices(tmp_input.shape, block_size, stride)
         
-        for a, b, c in zip(x_indices, y_indices, z_indices):
+        for a, b, c in indices:
             cropped_input = tmp_input.crop_indices((a,b,c),
                                                (a+block_size[0],
                                                 b+block_size[1],
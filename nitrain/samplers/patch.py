@@ -2,7 +2,7 @@ import numpy as np
 import ants
 import math
 
-from .base import BaseSampler
+from .base import BaseSampler, grid_indices
 
 class PatchSampler(BaseSampler):
     """
@@ -21,6 +21,9 @@ class PatchSampler(BaseSampler):
         self.batch_size = batch_size
         self.shuffle = shuffle
     
+    def n_items(self, shape):
+        return len(grid_indices(shape, self.patch_size, self.stride))
+    
     def __call__(self, x, y):
         # create patches of all images
         self.x, self.y = create_patches(x, y, self.patch_size, self.stride)
@@ -33,7 +36,7 @@ class PatchSampler(BaseSampler):
         else:
             batch_length = len(self.x)
         
-        self.n_batches = math.ceil(len(self.x) / self.batch_size)
+        self.n_batches = math.ceil(batch_length / self.batch_size)
         self.batch_length = batch_length
         
         return self
@@ -45,14 +48,9 @@ def create_patches(inputs, outputs, patch_size, stride):
     new_outputs = []
     for tmp_input, tmp_output in zip(inputs, outputs):
         # extract all patches
-        x_strides = np.arange(0, (tmp_input.shape[0]-patch_size[0]+1), step=stride[0])
-        y_strides = np.arange(0, (tmp_input.shape[1]-patch_size[1]+1), step=stride[1])
-        
-        grid = np.meshgrid(x_strides, y_strides)
-        x_indices = grid[0].flatten()
-        y_indices = grid[1].flatten()
+        indices = grid_indices(tmp_input.shape, patch_size, stride)
         
-        for a, b in zip(x_indices, y_indices):
+        for a, b in indices:
             cropped_input = tmp_input.crop_indices((a,b), (a+patch_size[0],b+patch_size[1]))
             new_inputs.append(cropped_input)
             
@@ -4,46 +4,193 @@ import math
 
 import ants
 
-from .base import BaseSampler
-    
+from .base import BaseSampler, rearrange_values
+
 class SliceSampler(BaseSampler):
     """
     Sampler that returns batches of 2D slices from 3D images.
+
+    Each volume is converted to numpy once and its slices are views of that
+    array, so no image is created per slice. Loaders collate the batches
+    directly from these views.
+
+    Examples
+    --------
+    >>> from nitrain.samplers import SliceSampler
+    >>> # slices along the last axis without slices where the segmentation is empty
+    >>> sampler = SliceSampler(batch_size=32, axis=-1, min_foreground=0, foreground='outputs')
+    >>> loader = nt.Loader(dataset, images_per_batch=4, sampler=sampler)
     """
-    def __init__(self, batch_size=24, axis=-1, shuffle=False):
+    def __init__(self, batch_size=24, axis=-1, shuffle=False, min_foreground=None,
+                 foreground='inputs'):
+        """
+        Arguments
+        ---------
+        min_foreground : float (optional)
+            if given, only slices whose fraction of non-zero voxels is larger
+            than this are sampled. Use 0 to drop empty slices.
+        foreground : string
+            whether the foreground fraction is measured on the (first)
+            'inputs' or the (first) 'outputs' - e.g., a segmentation mask
+        """
         self.batch_size = batch_size
         self.axis = axis
         self.shuffle = shuffle
-    
+        self.min_foreground = min_foreground
+        self.foreground = foreground
+
+    def n_items(self, shape):
+        # an upper bound if empty slices are dropped
+        return shape[self.axis % len(shape)]
+
     def __call__(self, x, y):
-        # create slices of all images
-        self.x = create_slices(x, self.axis)
-        self.y = create_slices(y, self.axis)
-        
-        xx = self.x[0]
-        if isinstance(xx, list):
-            while isinstance(xx, list):
-                batch_length = len(xx)
-                xx = xx[0]
-        else:
-            batch_length = len(self.x)
+        # one array per volume with the sliced axis first
+        self.x = map_leaves(lambda values: SliceArrays(values, self.axis), rearrange_values(x))
+        self.y = map_leaves(lambda values: SliceArrays(values, self.axis), rearrange_values(y))
+
+        # every item is a (volume, slice) pair
+        reference = first_leaf(self.x)
+        n_slices = [len(array) for array in reference.arrays]
+        volume_idx = np.repeat(np.arange(len(n_slices)), n_slices)
+        slice_idx = np.concatenate([np.arange(n) for n in n_slices])
+
+        if self.min_foreground is not None:
+            mask = first_leaf(self.x if self.foreground == 'inputs' else self.y)
+            keep = np.concatenate([foreground_fraction(array) > self.min_foreground
+                                   for array in mask.arrays])
+            volume_idx, slice_idx = volume_idx[keep], slice_idx[keep]
+
+        self.volume_idx = volume_idx
+        self.slice_idx = slice_idx
+        self.batch_length = len(volume_idx)
+        self.n_batches = math.ceil(self.batch_length / self.batch_size)
 
-        self.batch_length = batch_length
-        self.n_batches = math.ceil(batch_length / self.batch_size)
-                
         return self
 
+    def __iter__(self):
+        self.idx = 0
+        self.order = np.arange(self.batch_length)
+        if self.shuffle:
+            self.order = np.array(random.sample(range(self.batch_length), self.batch_length),
+                                  dtype='int64')
+        return self
+
+    def __next__(self):
+        if self.idx >= self.n_batches:
+            raise StopIteration
+        items = self._next_items()
+        return (map_leaves(lambda leaf: leaf.images(*items), self.x),
+                map_leaves(lambda leaf: leaf.images(*items), self.y))
+
+    def collated_batches(self, channels_first=None, x_dtype=None, y_dtype=None):
+        """
+        Yield the batches as numpy arrays, copied directly from the volume
+        arrays. A channel axis is added to images without components
+        unless channels_first is None, like `Loader` does for images.
+        """
+        iter(self)
+        while self.idx < self.n_batches:
+            items = self._next_items()
+            yield (map_leaves(lambda leaf: leaf.collate(*items, channels_first, x_dtype), self.x),
+                   map_leaves(lambda leaf: leaf.collate(*items, channels_first, y_dtype), self.y))
+
+    def _next_items(self):
+        indices = self.order[self.idx*self.batch_size:(self.idx+1)*self.batch_size]
+        self.idx += 1
+        return self.volume_idx[indices], self.slice_idx[indices]
+
     def __repr__(self):
         return f'''SliceSampler(axis={self.axis}, batch_size={self.batch_size}, shuffle={self.shuffle})'''
 
 
+class SliceArrays:
+    """
+    The volumes of one input or output with the sliced axis moved first,
+    or its values repeated for every slice if it is not an image.
+    """
+    def __init__(self, values, axis):
+        self.is_image = ants.is_image(values[0])
+        if self.is_image:
+            self.reference = values[0]
+            self.axis = axis % values[0].dimension
+            self.has_components = values[0].has_components
+            self.arrays = [np.moveaxis(value.numpy(), self.axis, 0) for value in values]
+        else:
+            self.values = np.array(values)
+
+    def collate(self, volume_idx, slice_idx, channels_first=None, dtype=None):
+        if not self.is_image:
+            values = self.values[volume_idx]
+            if dtype is not None and values.dtype.kind in 'biuf':
+                values = values.astype(dtype, copy=False)
+            return values
+
+        slice_shape = self.arrays[volume_idx[0]].shape[1:]
+        dtype = dtype or self.arrays[volume_idx[0]].dtype
+        if self.has_components or channels_first is None:
+            batch = np.empty((len(volume_idx),) + slice_shape, dtype=dtype)
+            target = batch
+        elif channels_first:
+            batch = np.empty((len(volume_idx), 1) + slice_shape, dtype=dtype)
+            target = batch[:, 0]
+        else:
+            batch = np.empty((len(volume_idx),) + slice_shape + (1,), dtype=dtype)
+            target = batch[..., 0]
+
+        # one fancy-indexed copy per volume
+        for v in np.unique(volume_idx):
+            positions = np.where(volume_idx == v)[0]
+            target[positions] = self.arrays[v][slice_idx[positions]]
+        return batch
+
+    def images(self, volume_idx, slice_idx):
+        if not self.is_image:
+            return self.values[volume_idx]
+
+        ref = self.reference
+        keep = [i for i in range(ref.dimension) if i != self.axis]
+        direction = np.asarray(ref.direction)[np.ix_(keep, keep)]
+        return [ants.from_numpy(np.ascontiguousarray(self.arrays[v][s]),
+                                origin=[ref.origin[i] for i in keep],
+                                spacing=[ref.spacing[i] for i in keep],
+                                direction=direction,
+                                has_components=self.has_components)
+                for v, s in zip(volume_idx, slice_idx)]
+
+
+def foreground_fraction(array):
+    """
+    Fraction of non-zero voxels of every slice (first axis) of an array,
+    computed with a single reduction.
+    """
+    return np.count_nonzero(array, axis=tuple(range(1, array.ndim))) / max(array[0].size, 1)
+
+
+def map_leaves(fn, x):
+    """
+    Apply a function to every leaf of a nested list of inputs (or outputs).
+    A leaf is a SliceArrays or the list of values of all records.
+    """
+    if isinstance(x, SliceArrays):
+        return fn(x)
+    if isinstance(x[0], (list, SliceArrays)):
+        return [map_leaves(fn, xx) for xx in x]
+    return fn(x)
+
+
+def first_leaf(x):
+    while isinstance(x, list):
+        x = x[0]
+    return x
+
+
 def create_slices(x, axis):
     def flatten_extend(matrix):
         flat_list = []
         for row in matrix:
             flat_list.extend(row)
         return flat_list
-    
+
     if isinstance(x[0], list):
         return [create_slices([x[i][j] for i in range(len(x))], axis) for j in range(len(x[0]))]
     if ants.is_image(x[0]):
@@ -2,8 +2,11 @@ import numpy as np
 import random
 import math
 
+import ants
+
 from .patch import create_patches
 from .slice import create_slices
+from .base import take_items, grid_indices
 
 class SlicePatchSampler:
     """
@@ -23,7 +26,16 @@ class SlicePatchSampler:
         self.batch_size = batch_size
         self.shuffle = shuffle
     
+    def n_items(self, shape):
+        axis = self.axis % len(shape)
+        slice_shape = [s for i, s in enumerate(shape) if i != axis]
+        return shape[axis] * len(grid_indices(slice_shape, self.patch_size, self.stride))
+    
     def __call__(self, x, y):
+        # values such as class labels are repeated for every slice of their image
+        if not ants.is_image(y[0]):
+            y = [yy for xx, yy in zip(x, y) for _ in range(xx.shape[self.axis])]
+        
         # create slices of all images
         x = create_slices(x, self.axis)
         y = create_slices(y, self.axis)
@@ -45,10 +57,9 @@ class SlicePatchSampler:
         
         # apply shuffling
         if self.shuffle:
-            indices = random.sample(range(len(self.y)), len(self.y))
-            x = self.x
-            self.x = [x[i] for i in indices]
-            self.y = self.y[indices]
+            indices = random.sample(range(len(self.x)), len(self.x))
+            self.x = take_items(self.x, indices)
+            self.y = take_items(self.y, indices)
             
         return self
 
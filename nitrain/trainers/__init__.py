@@ -1,2 +1,4 @@
 from .trainer import Trainer
-from .torch_trainer import TorchTrainer
\ No newline at end of file
+from .torch_trainer import TorchTrainer
+from . import metrics
+from .distributed import launch
@@ -0,0 +1,111 @@
+"""
+Checkpointing of torch training runs.
+
+A checkpoint holds the model and optimizer state, the epoch and step,
+the random states and the position of the loader, so a run can continue
+from the exact batch where it stopped.
+"""
+import os
+import queue
+import random
+import threading
+import numpy as np
+
+__all__ = ['CheckpointWriter',
+           'load_checkpoint']
+
+
+class CheckpointWriter:
+    """
+    Write checkpoints with `torch.save` in a background thread.
+
+    The state is copied to the CPU when `write()` is called, which is fast,
+    and the slow serialization and disk write happen in the thread so the
+    training step does not stall. Each file is written to a temporary path
+    and then renamed, so a crash during a write never leaves a partial
+    checkpoint behind. At most one checkpoint waits to be written at a time.
+
+    Examples
+    --------
+    >>> writer = CheckpointWriter()
+    >>> writer.write({'model': model.state_dict()}, 'checkpoint.pt')
+    >>> writer.close()
+    """
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=1)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, state, path):
+        if self._error is not None:
+            raise RuntimeError('Writing a checkpoint failed.') from self._error
+        self._queue.put((to_cpu(state), path))
+
+    def close(self):
+        """
+        Wait for pending checkpoints to be written and stop the thread.
+        """
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise RuntimeError('Writing a checkpoint failed.') from self._error
+
+    def _run(self):
+        import torch
+
+        while True:
+            task = self._queue.get()
+            if task is None:
+                break
+            state, path = task
+            try:
+                directory = os.path.dirname(os.path.abspath(path))
+                os.makedirs(directory, exist_ok=True)
+                tmp_path = os.path.join(directory, f'.partial-{os.path.basename(path)}')
+                torch.save(state, tmp_path)
+                os.replace(tmp_path, path)
+            except Exception as e:
+                self._error = e
+
+
+def load_checkpoint(path, device='cpu'):
+    import torch
+    return torch.load(path, map_location=device, weights_only=False)
+
+
+def to_cpu(state):
+    """
+    Copy all tensors of a (nested) state to the CPU, so the copy does not
+    change when training continues.
+    """
+    import torch
+
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {k: to_cpu(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_cpu(v) for v in state)
+    return state
+
+
+def get_rng_state():
+    import torch
+
+    state = {'torch': torch.get_rng_state(),
+             'numpy': np.random.get_state(),
+             'random': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    import torch
+
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
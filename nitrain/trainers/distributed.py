@@ -0,0 +1,106 @@
+"""
+Data-parallel training of torch models over several CPU processes.
+
+Every process trains a copy of the model on its own shard of the data
+and the gradients are averaged over processes with `torch.distributed`
+(gloo backend) after every backward pass, so all copies stay identical.
+"""
+import os
+import socket
+
+__all__ = ['launch',
+           'init_distributed',
+           'get_rank',
+           'get_world_size']
+
+
+def launch(fn, num_processes, args=(), backend='gloo', threads_per_process=None):
+    """
+    Run `fn(*args)` in `num_processes` local processes with a torch.distributed
+    process group initialized in each of them.
+
+    Inside `fn`, `TorchTrainer.fit` detects the process group and trains in
+    data-parallel mode. The cores of the machine are split over the processes
+    so they do not compete for threads. Scripts started with `torchrun` do
+    not need this function.
+
+    Arguments
+    ---------
+    fn : callable
+        function that builds the dataset, loader and trainer and calls fit.
+        It must be defined at the top level of a module so it can be pickled.
+
+    num_processes : integer
+        number of training processes
+
+    threads_per_process : integer (optional)
+        number of torch threads per process. Defaults to the number of cores
+        divided by the number of processes.
+
+    Examples
+    --------
+    >>> def train():
+    ...     loader = nt.Loader(dataset, images_per_batch=8, shuffle=True)
+    ...     trainer = TorchTrainer(model, optimizer, loss, metrics)
+    ...     trainer.fit(loader, epochs=10)
+    >>> from nitrain.trainers import launch
+    >>> launch(train, num_processes=8)
+    """
+    import torch.multiprocessing as mp
+
+    if threads_per_process is None:
+        threads_per_process = max(1, (os.cpu_count() or 1) // num_processes)
+
+    mp.spawn(_run_process,
+             args=(fn, args, num_processes, backend, free_port(), threads_per_process),
+             nprocs=num_processes,
+             join=True)
+
+
+def _run_process(rank, fn, args, world_size, backend, port, threads_per_process):
+    import torch
+    import torch.distributed as dist
+
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    os.environ['RANK'] = str(rank)
+    os.environ['LOCAL_RANK'] = str(rank)
+    os.environ['WORLD_SIZE'] = str(world_size)
+
+    torch.set_num_threads(threads_per_process)
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+    try:
+        fn(*args)
+    finally:
+        dist.destroy_process_group()
+
+
+def init_distributed(backend='gloo'):
+    """
+    Initialize the default process group from the environment variables
+    set by `torchrun` if there is more than one process and the group is
+    not initialized yet. Returns whether training is distributed.
+    """
+    import torch.distributed as dist
+
+    if not dist.is_available():
+        return False
+    if not dist.is_initialized() and int(os.environ.get('WORLD_SIZE', 1)) > 1:
+        dist.init_process_group(backend)
+    return dist.is_initialized() and dist.get_world_size() > 1
+
+
+def get_rank():
+    import torch.distributed as dist
+    return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+
+def get_world_size():
+    import torch.distributed as dist
+    return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
@@ -0,0 +1,165 @@
+"""
+Streaming metrics for evaluating torch models.
+
+Each metric keeps a few running sums that are updated batch by batch,
+so evaluation memory does not grow with the size of the dataset.
+"""
+
+__all__ = ['BaseMetric',
+           'MeanSquaredError',
+           'MeanAbsoluteError',
+           'Accuracy',
+           'Dice']
+
+
+class BaseMetric:
+    """
+    Base class of a streaming metric.
+
+    Examples
+    --------
+    >>> from nitrain.trainers import metrics
+    >>> metric = metrics.Dice()
+    >>> for y, y_pred in batches:
+    ...     metric.update(y, y_pred)
+    >>> metric.result()
+    """
+    # names of the running sums, which are summed over processes
+    state_names = ()
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        raise NotImplementedError
+
+    def update(self, y, y_pred):
+        raise NotImplementedError
+
+    def result(self):
+        raise NotImplementedError
+
+    def all_reduce(self):
+        """
+        Sum the running sums over all processes of a torch.distributed
+        group, so `result()` gives the metric of all their batches.
+        """
+        import torch
+        import torch.distributed as dist
+
+        values = torch.tensor([float(getattr(self, name)) for name in self.state_names],
+                              dtype=torch.float64)
+        dist.all_reduce(values)
+        for name, value in zip(self.state_names, values.tolist()):
+            setattr(self, name, value)
+
+    def __call__(self, y, y_pred):
+        """
+        Compute the metric on a single batch.
+        """
+        self.reset()
+        self.update(y, y_pred)
+        result = self.result()
+        self.reset()
+        return result
+
+    def __repr__(self):
+        return f'{type(self).__name__}()'
+
+
+class MeanSquaredError(BaseMetric):
+    state_names = ('total', 'count')
+
+    def reset(self):
+        self.total = 0.0
+        self.count = 0
+
+    def update(self, y, y_pred):
+        y_pred = y_pred.reshape(y.shape).float()
+        self.total += ((y_pred - y.float()) ** 2).sum().item()
+        self.count += y.numel()
+
+    def result(self):
+        return self.total / max(self.count, 1)
+
+
+class MeanAbsoluteError(BaseMetric):
+    state_names = ('total', 'count')
+
+    def reset(self):
+        self.total = 0.0
+        self.count = 0
+
+    def update(self, y, y_pred):
+        y_pred = y_pred.reshape(y.shape).float()
+        self.total += (y_pred - y.float()).abs().sum().item()
+        self.count += y.numel()
+
+    def result(self):
+        return self.total / max(self.count, 1)
+
+
+class Accuracy(BaseMetric):
+    """
+    Fraction of correct predictions.
+
+    If the prediction has a class dimension (dim 1) that the labels do not
+    have, the predicted class is the argmax over it. Otherwise, the
+    predictions are binarized with `threshold`.
+    """
+    state_names = ('correct', 'count')
+
+    def __init__(self, threshold=0.5):
+        self.threshold = threshold
+        super().__init__()
+
+    def reset(self):
+        self.correct = 0
+        self.count = 0
+
+    def update(self, y, y_pred):
+        if y_pred.ndim == y.ndim + 1:
+            y_pred = y_pred.argmax(dim=1)
+        else:
+            y_pred = (y_pred.reshape(y.shape) >= self.threshold).to(y.dtype)
+        self.correct += (y_pred == y).sum().item()
+        self.count += y.numel()
+
+    def result(self):
+        return self.correct / max(self.count, 1)
+
+
+class Dice(BaseMetric):
+    """
+    Dice overlap of binarized predictions and labels, pooled over
+    all batches.
+
+    For one-hot or multi-channel outputs, all channels are pooled. Set
+    `ignore_channels` to leave out channels such as the background.
+    """
+    state_names = ('intersection', 'total')
+
+    def __init__(self, threshold=0.5, ignore_channels=None, channel_dim=1):
+        self.threshold = threshold
+        self.ignore_channels = ignore_channels
+        self.channel_dim = channel_dim
+        super().__init__()
+
+    def reset(self):
+        self.intersection = 0.0
+        self.total = 0.0
+
+    def update(self, y, y_pred):
+        y_pred = (y_pred.reshape(y.shape) >= self.threshold).float()
+        y = (y > 0).float()
+        if self.ignore_channels:
+            keep = [i for i in range(y.shape[self.channel_dim]) if i not in self.ignore_channels]
+            y = y.movedim(self.channel_dim, 0)[keep]
+            y_pred = y_pred.movedim(self.channel_dim, 0)[keep]
+        self.intersection += (y * y_pred).sum().item()
+        self.total += (y.sum() + y_pred.sum()).item()
+
+    def result(self):
+        if self.total == 0:
+            return 1.0
+        return 2 * self.intersection / self.total
@@ -1,11 +1,23 @@
 
-from .torch_utils import torch_model_fit, torch_model_evaluate
+from .torch_utils import torch_model_fit, torch_model_evaluate, torch_model_predict
 
 
 class TorchTrainer:
     """
     The TorchTrainer class provides high-level functionality to train
     models from pytorch on nitrain data loaders.
+    
+    Training is data-parallel over several CPU processes when it runs in
+    a torch.distributed process group, e.g. one started with
+    `nitrain.trainers.launch` or `torchrun`.
+    
+    Examples
+    --------
+    >>> from nitrain.trainers import TorchTrainer, launch
+    >>> def train():
+    ...     trainer = TorchTrainer(model, optimizer, loss, metrics)
+    ...     trainer.fit(loader, epochs=10)
+    >>> launch(train, num_processes=4)
     """
 
     def __init__(self,
@@ -25,22 +37,63 @@ class TorchTrainer:
         self.device = device
         self.kwargs = kwargs
         
-    def fit(self, loader, epochs, validation=None, **kwargs):
+    def fit(self, loader, epochs, validation=None, checkpoint=None,
+            checkpoint_every=None, resume=None, **kwargs):
+        """
+        Fit the model on a loader.
+        
+        Arguments
+        ---------
+        checkpoint : string (optional)
+            file that the model, optimizer, epoch, random states and loader
+            position are written to at the end of every epoch. Checkpoints
+            are written in a background thread.
+        
+        checkpoint_every : integer (optional)
+            also write a checkpoint every `checkpoint_every` steps
+        
+        resume : string or boolean (optional)
+            checkpoint file to continue from, or True to continue from the
+            `checkpoint` file if it exists. Training continues at the exact
+            batch after the checkpoint.
+        
+        Examples
+        --------
+        >>> trainer.fit(loader, epochs=100, checkpoint='run/checkpoint.pt',
+        ...             checkpoint_every=500, resume=True)
+        """
         return torch_model_fit(self.model, self.loss, self.optimizer, 
                                  self.metrics, self.device, loader, 
-                                 epochs, validation, **kwargs)
+                                 epochs, validation, checkpoint=checkpoint,
+                                 checkpoint_every=checkpoint_every,
+                                 resume=resume, **kwargs)
 
     def evaluate(self, loader):
         return torch_model_evaluate(self.model, self.metrics, self.device, loader)
     
-    #def predict(self, loader):
-    #    pass
-    #
+    def predict(self, loader):
+        return torch_model_predict(self.model, self.device, loader)
+    
     #def summary(self):
     #    pass
-    #
-    #def save(self, path):
-    #    pass
+    
+    def save(self, path):
+        """
+        Save the model and optimizer state to a file.
+        """
+        import torch
+        torch.save({'model': self.model.state_dict(),
+                    'optimizer': self.optimizer.state_dict()}, path)
+    
+    def load(self, path):
+        """
+        Load the model and optimizer state from a file written by `save()`
+        or from a checkpoint written during `fit()`.
+        """
+        from .checkpoint import load_checkpoint
+        state = load_checkpoint(path, self.device)
+        self.model.load_state_dict(state['model'])
+        self.optimizer.load_state_dict(state['optimizer'])
     
     def __repr__(self):
         s = 'TorchTrainer ({})\n'.format('Custom')
@@ -1,88 +1,424 @@
+import os
+import time
 import numpy as np
 
 
-def torch_model_fit(model, loss, optimizer, metrics, device, loader, epochs, validation, **kwargs):
+def torch_model_fit(model, loss, optimizer, metrics, device, loader, epochs, validation,
+                    accumulation_steps=1, compile_model=False, log_every=None,
+                    checkpoint=None, checkpoint_every=None, resume=None, **kwargs):
     """
     Fit a torch model on a loader
+    
+    Batches can have multiple inputs and outputs (lists of arrays or tensors).
+    Multiple inputs are passed to the model as separate arguments. With multiple
+    outputs, `loss` can be a list with one loss function per output and the
+    losses are summed.
+    
+    Arguments
+    ---------
+    accumulation_steps : integer
+        number of batches whose gradients are accumulated before each
+        optimizer step, to train with a larger effective batch size
+    
+    compile_model : boolean
+        whether to compile the model with `torch.compile` first
+    
+    log_every : integer (optional)
+        print the running loss every `log_every` steps. By default only
+        a summary is printed at the end of each epoch.
+    
+    checkpoint : string (optional)
+        file that a checkpoint is written to at the end of every epoch. The
+        model, optimizer, epoch, step, random states and loader position are
+        saved in a background thread, so training does not wait for the write.
+    
+    checkpoint_every : integer (optional)
+        also write a checkpoint every `checkpoint_every` steps within an
+        epoch. Checkpoints are only written right after an optimizer step,
+        so no accumulated gradients are lost.
+    
+    resume : string or boolean (optional)
+        checkpoint file to continue training from. If True, the `checkpoint`
+        file is used if it exists. Training continues at the batch after the
+        last one of the checkpoint, without reading the consumed batches again.
+        In distributed training, the shuffle seed shared by the processes
+        is saved too, so later epochs are shuffled like in the interrupted run.
+    
+    The time spent waiting for data and the time spent in the forward and
+    backward passes are measured separately and printed for every epoch,
+    which shows whether training is limited by the data pipeline. On a GPU
+    the device is only synchronized when the times are printed, so the
+    compute time is the time since the start of the epoch that was not spent
+    waiting for data.
+    
+    If a torch.distributed process group is initialized (e.g., by
+    `nitrain.trainers.launch` or `torchrun`), training is data-parallel:
+    each process reads its own shard of the loader, gradients are averaged
+    over processes after every backward pass and the validation metrics are
+    aggregated over all processes. All processes train on as many batches as
+    the smallest shard has, which is agreed on once per epoch for loaders with
+    a length and checked at every step for other loaders. Only the first
+    process prints and writes checkpoints.
     """
     import torch
+    from .checkpoint import CheckpointWriter, load_checkpoint, get_rng_state, set_rng_state
+    from .distributed import init_distributed, get_rank, get_world_size
+    
+    distributed = init_distributed()
+    rank = get_rank()
+    world_size = get_world_size()
+    log = print if rank == 0 else (lambda *args, **kwargs: None)
+    
+    ddp_model = None
+    train_model = model
+    if distributed:
+        import torch.distributed as dist
+        from torch.nn.parallel import DistributedDataParallel
+        loader = shard_loader(loader)
+        if validation:
+            validation = shard_loader(validation)
+        ddp_model = train_model = DistributedDataParallel(model)
     
-    # start training loop
-    best_metric = -1
-    best_metric_epoch = -1
-    epoch_loss_values = []
+    if compile_model:
+        train_model = torch.compile(train_model)
+    is_cuda = torch.device(device).type == 'cuda'
+    
+    if resume is True:
+        resume = checkpoint if checkpoint is not None and os.path.exists(checkpoint) else None
+    
+    start_epoch = 0
+    state = None
     metric_values = []
-    for epoch in range(epochs):
-        print("-" * 10)
-        print(f"epoch {epoch + 1}/{epochs}")
-        model.train()
-        epoch_loss = 0
-        step = 0
-        for inputs, outputs in loader:
-            step += 1
-            # TODO: support multiple inputs + outputs here
-            inputs = torch.tensor(inputs).to(device)
-            labels = torch.tensor(outputs).to(device)
-            
-            optimizer.zero_grad()
-            outputs = model(inputs)
+    if resume:
+        checkpoint_state = load_checkpoint(resume, device)
+        if len(checkpoint_state['ranks']) != world_size:
+            raise ValueError(f"The checkpoint was written by {len(checkpoint_state['ranks'])} "
+                             f"processes but there are {world_size}.")
+        model.load_state_dict(checkpoint_state['model'])
+        optimizer.load_state_dict(checkpoint_state['optimizer'])
+        start_epoch = checkpoint_state['epoch']
+        metric_values = checkpoint_state['metric_values']
+        state = dict(checkpoint_state['ranks'][rank], step=checkpoint_state['step'])
+        set_rng_state(state['rng'])
+        # the shuffle seed that the processes shared in the interrupted run,
+        # so that the later epochs are shuffled like in that run
+        if distributed and checkpoint_state.get('loader_seed') is not None:
+            loader.seed = checkpoint_state['loader_seed']
+        log(f"resuming from epoch {start_epoch + 1}, step {state['step']}")
+    
+    writer = CheckpointWriter() if checkpoint is not None and rank == 0 else None
+    
+    def write_checkpoint(epoch, step, epoch_loss, loader_state):
+        # the random states, loss and loader position differ per process
+        rank_state = {'rng': get_rng_state(),
+                      'epoch_loss': epoch_loss,
+                      'loader': loader_state}
+        rank_states = [rank_state]
+        if distributed:
+            rank_states = [None] * world_size
+            dist.all_gather_object(rank_states, rank_state)
+        if writer is not None:
+            writer.write({'model': model.state_dict(),
+                          'optimizer': optimizer.state_dict(),
+                          'epoch': epoch,
+                          'step': step,
+                          'metric_values': metric_values,
+                          'loader_seed': getattr(loader, 'seed', None),
+                          'ranks': rank_states}, checkpoint)
+    
+    try:
+        for epoch in range(start_epoch, epochs):
+            if hasattr(loader, 'set_epoch'):
+                loader.set_epoch(epoch)
+            _fit_epoch(train_model, ddp_model, model, loss, optimizer, metrics, device,
+                       loader, epoch, epochs, validation, accumulation_steps, log_every,
+                       is_cuda, metric_values, log,
+                       write_checkpoint if checkpoint is not None else None,
+                       checkpoint_every, state if epoch == start_epoch else None)
+    finally:
+        if writer is not None:
+            writer.close()
+    return metric_values
+
+
+def _fit_epoch(train_model, ddp_model, model, loss, optimizer, metrics, device, loader,
+               epoch, epochs, validation, accumulation_steps, log_every, is_cuda,
+               metric_values, log, write_checkpoint, checkpoint_every, state):
+    """
+    Train a torch model for one epoch, starting after the last batch of a
+    checkpoint `state` if one is given.
+    """
+    import torch
+    from contextlib import nullcontext
+    
+    log("-" * 10)
+    log(f"epoch {epoch + 1}/{epochs}")
+    model.train()
+    optimizer.zero_grad(set_to_none=True)
+    
+    epoch_loss = torch.zeros((), device=device)
+    step = 0
+    data_time = 0
+    compute_time = 0
+    
+    # every process stops at the same step, so no process waits for
+    # gradients of a process that has run out of batches
+    n_steps = None
+    if ddp_model is not None and hasattr(loader, '__len__'):
+        n_steps = min_processes(len(loader))
+    
+    if state is not None and state['step'] > 0:
+        epoch_loss += state['epoch_loss']
+        step = state['step']
+        if state['loader'] is not None and hasattr(loader, 'iterate'):
+            batches = loader.iterate(state['loader'])
+        else:
+            # other loaders can only skip consumed batches by reading them
+            batches = iter(loader)
+            for _ in range(step):
+                next(batches)
+    else:
+        batches = iter(loader)
+    last_checkpoint_step = step
+    epoch_start_time = time.perf_counter()
+    
+    def elapsed_compute_time():
+        # wait for the queued device work only when the times are reported
+        if is_cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter() - epoch_start_time - data_time
+    
+    while n_steps is None or step < n_steps:
+        start_time = time.perf_counter()
+        batch = next(batches, None)
+        
+        if ddp_model is not None and n_steps is None and not all_processes(batch is not None):
+            break
+        if batch is None:
+            break
+        inputs, labels = batch
+        
+        data_time += time.perf_counter() - start_time
+        step += 1
+        
+        inputs = to_device(inputs, device)
+        labels = to_device(labels, device)
+        
+        # gradients are only averaged over processes before an optimizer step
+        is_update = step % accumulation_steps == 0
+        with ddp_model.no_sync() if ddp_model is not None and not is_update else nullcontext():
+            if isinstance(inputs, list):
+                outputs = train_model(*inputs)
+            else:
+                outputs = train_model(inputs)
             
-            loss_value = loss(outputs, labels)
-            loss_value.backward()
+            loss_value = compute_loss(loss, outputs, labels)
+            (loss_value / accumulation_steps).backward()
+        
+        if is_update:
             optimizer.step()
-            
-            epoch_loss += loss_value.item()
-            
-            print(f"{step}/{len(loader.dataset) // loader.images_per_batch}, " f"train_loss: {loss_value.item():.4f}")
-            epoch_len = len(loader.dataset) // loader.images_per_batch
-        epoch_loss /= step
-        epoch_loss_values.append(epoch_loss)
-        print(f"epoch {epoch + 1} average loss: {epoch_loss:.4f}")
+            optimizer.zero_grad(set_to_none=True)
         
-        # validation
-        if validation:
-            results = torch_model_evaluate(model, metrics, device, validation)
-            metric_values.append(results)
-            print(
-                f"Current epoch: {epoch + 1};  "
-                f"Metrics: {[round(r,4) for r in results]}"
-            )
-    return metric_values
+        # keep the loss on the device so there is no sync every step
+        epoch_loss += loss_value.detach()
+        
+        if write_checkpoint and checkpoint_every and is_update \
+                and step - last_checkpoint_step >= checkpoint_every:
+            loader_state = loader.state_dict() if hasattr(loader, 'state_dict') else None
+            write_checkpoint(epoch, step, epoch_loss.item(), loader_state)
+            last_checkpoint_step = step
+        
+        if log_every and step % log_every == 0:
+            compute_time = elapsed_compute_time()
+            log(f"{step}, train_loss: {epoch_loss.item() / step:.4f}, "
+                f"data: {data_time:.1f}s, compute: {compute_time:.1f}s")
+    
+    # step on the gradients of a last incomplete accumulation
+    if step % accumulation_steps != 0:
+        if ddp_model is not None:
+            average_gradients(model)
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+    
+    if ddp_model is not None:
+        import torch.distributed as dist
+        dist.all_reduce(epoch_loss)
+        epoch_loss /= dist.get_world_size()
+    
+    epoch_loss = epoch_loss.item() / max(step, 1)
+    compute_time = elapsed_compute_time()
+    log(f"epoch {epoch + 1} average loss: {epoch_loss:.4f}, "
+        f"data: {data_time:.1f}s, compute: {compute_time:.1f}s")
+    
+    # validation
+    if validation:
+        results = torch_model_evaluate(model, metrics, device, validation)
+        metric_values.append(results)
+        log(
+            f"Current epoch: {epoch + 1};  "
+            f"Metrics: {[round(r,4) for r in results]}"
+        )
+    
+    if write_checkpoint:
+        write_checkpoint(epoch + 1, 0, 0.0, None)
+
+
+def shard_loader(loader):
+    """
+    Get a nitrain loader that reads only the shard of this process.
+    
+    Nitrain loaders find the rank and number of processes themselves, but
+    without a seed each process would shuffle differently, so the shuffle
+    seed of the first process is shared with all processes. Other loaders
+    are returned as they are and must be sharded by the user.
+    """
+    import torch.distributed as dist
+    
+    if not hasattr(loader, 'shard') or loader.seed is not None:
+        return loader
+    
+    seed = [np.random.randint(2**31)]
+    dist.broadcast_object_list(seed, src=0)
+    
+    loader = loader.copy()
+    loader.seed = seed[0]
+    return loader
+
+
+def all_processes(flag):
+    """
+    Whether a flag is True in every process.
+    """
+    import torch
+    import torch.distributed as dist
+    
+    value = torch.tensor(int(flag))
+    dist.all_reduce(value, op=dist.ReduceOp.MIN)
+    return bool(value.item())
+
+
+def min_processes(value):
+    """
+    The smallest value of an integer over all processes.
+    """
+    import torch
+    import torch.distributed as dist
+    
+    value = torch.tensor(int(value))
+    dist.all_reduce(value, op=dist.ReduceOp.MIN)
+    return int(value.item())
+
+
+def average_gradients(model):
+    import torch.distributed as dist
+    
+    world_size = dist.get_world_size()
+    for param in model.parameters():
+        if param.grad is not None:
+            dist.all_reduce(param.grad)
+            param.grad /= world_size
+
+
+def to_device(x, device):
+    """
+    Move a batch (an array, a tensor, or a list of them) to a device.
+    
+    Numpy arrays are wrapped without a copy and the transfer is non-blocking,
+    which lets host-to-device copies overlap with compute from pinned memory.
+    """
+    import torch
+    
+    if isinstance(x, (list, tuple)):
+        return [to_device(xx, device) for xx in x]
+    if not isinstance(x, torch.Tensor):
+        x = torch.as_tensor(x)
+    return x.to(device, non_blocking=True)
+
+
+def compute_loss(loss, outputs, labels):
+    if isinstance(loss, (list, tuple)):
+        return sum(loss_fn(output, label) for loss_fn, output, label in zip(loss, outputs, labels))
+    return loss(outputs, labels)
    
 
 def torch_model_predict(model, device, loader):
     import torch
     model.eval()
+    y_pred = []
     with torch.no_grad():
-        y_pred = torch.tensor([], device=device)
-        y = torch.tensor([], device=device)
-        for val_data in loader:
-            val_images, val_labels = (
-                torch.tensor(val_data[0]).to(device),
-                torch.tensor(val_data[1]).to(device),
-            )
-            y_pred = torch.cat([y_pred, model(val_images)], dim=0)
-    return y_pred
+        for inputs, _ in loader:
+            inputs = to_device(inputs, device)
+            outputs = model(*inputs) if isinstance(inputs, list) else model(inputs)
+            y_pred.append(outputs)
+    # a single concatenation at the end instead of one per batch
+    return torch.cat(y_pred, dim=0) if y_pred else torch.tensor([], device=device)
 
 
 def torch_model_evaluate(model, metrics, device, loader):
+    """
+    Evaluate a torch model on a loader.
+    
+    Streaming metrics (see `nitrain.trainers.metrics`) are updated batch by
+    batch and each batch is discarded afterwards, so memory use does not grow
+    with the loader. Plain metric functions `metric_fn(y, y_pred)` need all
+    predictions at once, so they are only kept when such functions are used.
+    
+    If a torch.distributed process group is initialized, the running sums of
+    streaming metrics are summed over processes and plain metric functions
+    are averaged over processes, weighted by their number of samples.
+    """
     import torch
-    metric_values = []
+    from .metrics import BaseMetric
+    from .distributed import get_world_size
+    
+    distributed = get_world_size() > 1
+    
+    streaming = [isinstance(metric, BaseMetric) for metric in metrics]
+    for metric, is_streaming in zip(metrics, streaming):
+        if is_streaming:
+            metric.reset()
+    
     model.eval()
+    y_pred_list = []
+    y_list = []
     with torch.no_grad():
-        # TODO: infer datatypes and support multi-inputs / outputs
-        y_pred = torch.tensor([], device=device)
-        y = torch.tensor([], device=device)
-        for val_data in loader:
-            val_images, val_labels = (
-                torch.tensor(val_data[0]).to(device),
-                torch.tensor(val_data[1]).to(device),
-            )
-            y_pred = torch.cat([y_pred, model(val_images)], dim=0)
-            y = torch.cat([y, val_labels], dim=0)
-
-        for metric_fn in metrics:
-            result = metric_fn(y, y_pred)
-            metric_values.append(result)
+        for inputs, labels in loader:
+            inputs = to_device(inputs, device)
+            labels = to_device(labels, device)
+            outputs = model(*inputs) if isinstance(inputs, list) else model(inputs)
+            
+            for metric, is_streaming in zip(metrics, streaming):
+                if is_streaming:
+                    metric.update(labels, outputs)
+            
+            if not all(streaming):
+                y_pred_list.append(outputs)
+                y_list.append(labels)
+        
+        if not all(streaming) and y_list:
+            y_pred = torch.cat(y_pred_list, dim=0)
+            y = torch.cat(y_list, dim=0)
+    
+        metric_values = []
+        for metric, is_streaming in zip(metrics, streaming):
+            if is_streaming:
+                if distributed:
+                    metric.all_reduce()
+                metric_values.append(metric.result())
+            elif distributed:
+                n_samples = len(y) if y_list else 0
+                value = metric(y, y_pred) if y_list else 0.0
+                metric_values.append(mean_over_processes(value, n_samples))
+            else:
+                metric_values.append(metric(y, y_pred))
         
     return metric_values
+
+
+def mean_over_processes(value, weight):
+    import torch
+    import torch.distributed as dist
+    
+    total = torch.tensor([float(value) * weight, weight], dtype=torch.float64)
+    dist.all_reduce(total)
+    return (total[0] / max(total[1].item(), 1)).item()
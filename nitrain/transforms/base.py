@@ -1,6 +1,13 @@
 # transforms perform some function that alters your images
 import os
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+import ants
+
+# the thread pool opened by `thread_pool` in this thread, if any
+_pool_state = threading.local()
 
 class BaseTransform:
     
@@ -13,13 +20,75 @@ class BaseTransform:
     def __call__(self, *inputs):
         raise NotImplementedError
 
+    def inverse(self):
+        raise NotImplementedError
+
     def __repr__(self):
         raise NotImplementedError
 
 
+def from_numpy_like(array, image):
+    """
+    Create an image with the same header as `image` from a numpy array.
+    
+    Unlike ants.from_numpy_like, float64 results of numpy math are stored
+    as float32 unless `image` itself is double precision, so transforms do
+    not silently double the memory of every image.
+    """
+    if array.dtype == np.float64 and image.pixeltype != 'double':
+        array = array.astype('float32')
+    elif array.dtype == np.float16:
+        array = array.astype('float32')
+    return ants.from_numpy_like(array, image)
+
+
+@contextmanager
+def thread_pool(num_threads, executor=None):
+    """
+    Run the per-image work of transforms (e.g., smoothing or resampling the
+    T1, T2 and segmentation of one record) on a pool of threads. ITK filters
+    release the GIL, so the images are transformed concurrently. Work that is
+    already running on the pool is not split again. A pool made with
+    `pool_executor` can be given to reuse it instead of opening a new one.
+    
+    Examples
+    --------
+    >>> from nitrain.transforms.base import thread_pool
+    >>> with thread_pool(4):
+    ...     t1, t2 = tx.Resample((1, 1, 1), use_voxels=False)(t1, t2)
+    """
+    if executor is None:
+        with pool_executor(num_threads) as executor:
+            with thread_pool(num_threads, executor):
+                yield executor
+        return
+    
+    previous = getattr(_pool_state, 'executor', None)
+    _pool_state.executor = executor
+    try:
+        yield executor
+    finally:
+        _pool_state.executor = previous
 
 
+def pool_executor(num_threads):
+    """
+    Open a pool of threads for `thread_pool` that can be reused for many
+    calls, e.g. for all the image batches of an epoch.
+    """
+    return ThreadPoolExecutor(num_threads, initializer=_mark_pool_thread)
 
 
+def _mark_pool_thread():
+    _pool_state.in_pool = True
 
 
+def map_images(fn, images):
+    """
+    Apply a function to every image, on the thread pool of `thread_pool`
+    if one is open in this thread.
+    """
+    executor = getattr(_pool_state, 'executor', None)
+    if executor is None or len(images) < 2 or getattr(_pool_state, 'in_pool', False):
+        return [fn(image) for image in images]
+    return list(executor.map(fn, images))
@@ -1,5 +1,5 @@
 
-from .base import BaseTransform
+from .base import BaseTransform, map_images
 
 __all__ = [
     'Astype',
@@ -39,10 +39,10 @@ class Smooth(BaseTransform):
         self.max_kernel_width = max_kernel_width
     
     def __call__(self, *images):
-        images = [image.smooth_image(self.sigma,
-                                     self.sigma_in_physical_coordinates,
-                                     self.FWHM,
-                                     self.max_kernel_width) for image in images]
+        images = map_images(lambda image: image.smooth_image(self.sigma,
+                                                             self.sigma_in_physical_coordinates,
+                                                             self.FWHM,
+                                                             self.max_kernel_width), images)
         return images if len(images) > 1 else images[0]
 
 
@@ -80,9 +80,9 @@ class Resample(BaseTransform):
         self.interp_type = interp_type
         
     def __call__(self, *images):
-        images = [image.resample_image(self.resample_params,
-                                       self.use_voxels,
-                                       self.interp_type) for image in images]
+        images = map_images(lambda image: image.resample_image(self.resample_params,
+                                                               self.use_voxels,
+                                                               self.interp_type), images)
         return images if len(images) > 1 else images[0]
 
 class Slice(BaseTransform):
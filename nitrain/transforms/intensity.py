@@ -1,4 +1,4 @@
-from .base import BaseTransform
+from .base import BaseTransform, map_images
 
 __all__ = ['ImageMath',
            'BiasCorrection',
@@ -21,7 +21,7 @@ class ImageMath(BaseTransform):
         self.args = args
     
     def __call__(self, *images):
-        images = [image.iMath(self.operation, *self.args) for image in images]
+        images = map_images(lambda image: image.iMath(self.operation, *self.args), images)
         return images if len(images) > 1 else images[0]
     
 class BiasCorrection(BaseTransform):
@@ -36,7 +36,7 @@ class BiasCorrection(BaseTransform):
         pass
 
     def __call__(self, *images):
-        images = [image.n4_bias_field_correction() for image in images]
+        images = map_images(lambda image: image.n4_bias_field_correction(), images)
         return images if len(images) > 1 else images[0]
 
 class StandardNormalize(BaseTransform):
@@ -54,7 +54,8 @@ class StandardNormalize(BaseTransform):
     def __call__(self, *images):
         new_images = []
         for image in images:
-            image = image.clone('float')
+            if image.pixeltype != 'float':
+                image = image.clone('float')
             mean_val = self.mean if self.mean else image.mean()
             std_val = self.std if self.std else image.std()
             image = (image - mean_val) / std_val
@@ -76,7 +77,8 @@ class RangeNormalize(BaseTransform):
     def __call__(self, *images):
         new_images = []
         for image in images:
-            image = image.clone('float')
+            if image.pixeltype != 'float':
+                image = image.clone('float')
             minimum = image.min()
             maximum = image.max()
             if maximum - minimum == 0:
@@ -1,4 +1,5 @@
 import ants
+import numpy as np
 
 from .base import BaseTransform
 
@@ -12,29 +13,81 @@ class LabelsToChannels(BaseTransform):
     segmentation image.
     
     If an image has shape (100,100) and has three unique values (0,1,2),
-    then this transform will return an image with shape (100,100,3) where
-    (100,100,0) = 1 if the original value is 0, (100,100,1) = 1 if the original
-    value is 1, and (100,100,2) = 2 if the original value is 2. 
+    then this transform will return an image with shape (100,100,2) where
+    (100,100,0) = 1 if the original value is 1 and (100,100,1) = 1 if the 
+    original value is 2. The background value 0 does not get a channel.
     
     It is also possible to keep the original values in the channels 
     instead of making all values equal to 1.
+    
+    By default the channels are made from the unique values of each image,
+    so two images with different labels get different channel orders. Pass
+    `labels` to fix the channels: channel i is always `labels[i]` and any
+    value not in `labels` is treated as background.
+    
+    With `as_index=True` no one-hot image is made at all. Instead, a single
+    channel integer image is returned where each voxel holds i+1 if its value
+    is `labels[i]` and 0 otherwise. This is the target format expected by
+    sparse categorical losses and uses 1/C of the memory.
+    
+    An image with only background, or an empty `labels` list, gives a single
+    all-zero channel (or an all-zero index image).
+    
+    Examples
+    --------
+    >>> import ants
+    >>> from nitrain import transforms as tx
+    >>> img = ants.image_read(ants.get_data('r16')).kmeans_segmentation(3)['segmentation']
+    >>> my_tx = tx.LabelsToChannels(labels=[1,2,3])
+    >>> img_tx = my_tx(img)
+    >>> my_tx = tx.LabelsToChannels(labels=[1,2,3], as_index=True)
+    >>> img_tx = my_tx(img)
     """
-    def __init__(self, keep_values=False, channels_first=False):
+    def __init__(self, labels=None, keep_values=False, channels_first=False, as_index=False):
+        self.labels = labels
         self.keep_values = keep_values
         self.channels_first = channels_first
+        self.as_index = as_index
     
     def __call__(self, *images):
-        images = [labels_to_channels(image, self.keep_values, self.channels_first) for image in images]
+        images = [labels_to_channels(image, self.keep_values, self.channels_first,
+                                     self.labels, self.as_index) for image in images]
         return images if len(images) > 1 else images[0]
     
-def labels_to_channels(image, keep_values, channels_first):
-    unique_vals = image.unique()
-    tmp_imgs = []
-    for val in unique_vals:
-        if val != 0:
-            tmp_img = image * (image==val)
-            if not keep_values:
-                tmp_img[tmp_img!=0] = 1
-            tmp_imgs.append(tmp_img)
-    new_img = ants.merge_channels(tmp_imgs, channels_first=channels_first)
-    return new_img
\ No newline at end of file
+def labels_to_channels(image, keep_values, channels_first, labels=None, as_index=False):
+    array = image.numpy()
+    
+    if labels is None:
+        labels = np.unique(array)
+        labels = labels[labels != 0]
+    labels = np.asarray(labels)
+    
+    if len(labels) == 0:
+        # only background, so no voxel gets a channel
+        hit = np.zeros(array.shape, dtype=bool)
+        channel = np.zeros(0, dtype='int64')
+    else:
+        # find the channel of every voxel in a single vectorized pass
+        # instead of making one full size mask per label
+        order = np.argsort(labels, kind='stable')
+        sorted_labels = labels[order]
+        idx = np.searchsorted(sorted_labels, array)
+        idx[idx == len(labels)] = 0
+        hit = sorted_labels[idx] == array
+        channel = order[idx[hit]]
+    
+    if as_index:
+        index_dtype = 'uint8' if len(labels) < 256 else 'uint32'
+        new_array = np.zeros(array.shape, dtype=index_dtype)
+        new_array[hit] = channel + 1
+        return ants.from_numpy(new_array, origin=image.origin,
+                               spacing=image.spacing, direction=image.direction)
+    
+    # images cannot have zero channels, so without labels there is one empty channel
+    new_array = np.zeros(array.shape + (max(len(labels), 1),), dtype=array.dtype)
+    new_array[np.nonzero(hit) + (channel,)] = array[hit] if keep_values else 1
+    
+    new_img = ants.from_numpy(new_array, origin=image.origin, spacing=image.spacing,
+                              direction=image.direction, has_components=True)
+    new_img.channels_first = channels_first
+    return new_img
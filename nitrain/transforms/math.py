@@ -2,7 +2,7 @@
 import ants
 import numpy as np
 
-from .base import BaseTransform
+from .base import BaseTransform, from_numpy_like
 
 __all__ = [
     'Abs',
@@ -19,7 +19,7 @@ class Abs(BaseTransform):
     def __init__(self):
         pass
     def __call__(self, *images):
-        images = [image.abs() for image in images]
+        images = [from_numpy_like(np.abs(image.numpy()), image) for image in images]
         return images if len(images) > 1 else images[0]
 
 
@@ -27,7 +27,7 @@ class Ceil(BaseTransform):
     def __init__(self):
         pass
     def __call__(self, *images):
-        images = [ants.from_numpy_like(np.ceil(image.numpy()), image) for image in images]
+        images = [from_numpy_like(np.ceil(image.numpy()), image) for image in images]
         return images if len(images) > 1 else images[0]
 
 
@@ -35,7 +35,7 @@ class Floor(BaseTransform):
     def __init__(self):
         pass
     def __call__(self, *images):
-        images = [ants.from_numpy_like(np.floor(image.numpy()), image) for image in images]
+        images = [from_numpy_like(np.floor(image.numpy()), image) for image in images]
         return images if len(images) > 1 else images[0]
 
 
@@ -43,7 +43,7 @@ class Log(BaseTransform):
     def __init__(self):
         pass
     def __call__(self, *images):
-        images = [ants.from_numpy_like(np.log(image.numpy()), image) for image in images]
+        images = [from_numpy_like(np.log(image.numpy()), image) for image in images]
         return images if len(images) > 1 else images[0]
 
 
@@ -51,7 +51,7 @@ class Exp(BaseTransform):
     def __init__(self):
         pass
     def __call__(self, *images):
-        images = [ants.from_numpy_like(np.exp(image.numpy()), image) for image in images]
+        images = [from_numpy_like(np.exp(image.numpy()), image) for image in images]
         return images if len(images) > 1 else images[0]
 
 
@@ -59,7 +59,7 @@ class Sqrt(BaseTransform):
     def __init__(self):
         pass
     def __call__(self, *images):
-        images = [ants.from_numpy_like(np.sqrt(image.numpy()), image) for image in images]
+        images = [from_numpy_like(np.sqrt(image.numpy()), image) for image in images]
         return images if len(images) > 1 else images[0]
 
 
@@ -67,5 +67,5 @@ class Power(BaseTransform):
     def __init__(self, value):
         self.value = value
     def __call__(self, *images):
-        images = [ants.from_numpy_like(np.power(image.numpy(), self.value), image) for image in images]
+        images = [from_numpy_like(np.power(image.numpy(), self.value), image) for image in images]
         return images if len(images) > 1 else images[0]
\ No newline at end of file
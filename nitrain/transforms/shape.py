@@ -1,6 +1,6 @@
 import ants
 
-from .base import BaseTransform
+from .base import BaseTransform, map_images
 
 __all__ = [
     'AddChannel',
@@ -34,5 +34,5 @@ class Reorient(BaseTransform):
         self.orientation = orientation
         
     def __call__(self, *images):
-        images = [image.reorient_image2(self.orientation) for image in images]
+        images = map_images(lambda image: image.reorient_image2(self.orientation), images)
         return images if len(images) > 1 else images[0]
\ No newline at end of file
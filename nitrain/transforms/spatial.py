@@ -1,8 +1,10 @@
 import ants
 import math
+import threading
+import weakref
 import numpy as np
 
-from .base import BaseTransform
+from .base import BaseTransform, map_images
 
 __all__ = [
     'ApplyAntsTransform',
@@ -14,6 +16,46 @@ __all__ = [
     'Translate'
 ]
 
+# what the last call of each transform in this thread did, for `inverse()`.
+# Transforms never store it on themselves so that one transform object can
+# be called from several threads at once.
+_last_calls = threading.local()
+
+
+def remember_call(transform, value):
+    if not hasattr(_last_calls, 'values'):
+        _last_calls.values = weakref.WeakKeyDictionary()
+    _last_calls.values[transform] = value
+
+
+def last_call(transform):
+    value = getattr(_last_calls, 'values', {}).get(transform)
+    if value is None:
+        raise Exception('The transform must be called before its inverse can be computed.')
+    return value
+
+
+def apply_affine(transform, matrix, images, reference=None):
+    """
+    Apply an affine matrix to images, about the center of mass of the
+    reference or else of each image. A new ants transform is created for
+    every image, so the transform object itself is never modified.
+    """
+    def apply(image):
+        ants_tx = ants.new_ants_transform(precision="float",
+                                          dimension=matrix.shape[0],
+                                          transform_type="AffineTransform")
+        ants_tx.set_parameters(matrix)
+        center = reference if reference is not None else image
+        ants_tx.set_fixed_parameters(center.get_center_of_mass())
+        return ants_tx.apply_to_image(image, reference), ants_tx
+    
+    results = map_images(apply, images)
+    remember_call(transform, results[-1][1])
+    new_images = [result[0] for result in results]
+    return new_images if len(new_images) > 1 else new_images[0]
+
+
 class ApplyAntsTransform(BaseTransform):
     
     def __init__(self, transform):
@@ -29,7 +71,7 @@ class ApplyAntsTransform(BaseTransform):
         self.transform = transform
 
     def __call__(self, *images):
-        images = [self.transform.apply_to_image(image) for image in images]
+        images = map_images(self.transform.apply_to_image, images)
         return images if len(images) > 1 else images[0]
     
 class AffineTransform(BaseTransform):
@@ -48,22 +90,17 @@ class AffineTransform(BaseTransform):
         """
         self.array = array
         self.reference = reference
-            
-        self.tx = ants.new_ants_transform(precision="float", 
-                                          dimension=array.shape[0], 
-                                          transform_type="AffineTransform")
-        if self.reference is not None:
-            self.tx.set_fixed_parameters(self.reference.get_center_of_mass())
         
     def __call__(self, *images):
-        self.tx.set_parameters(self.array)
-        new_images = []
-        for image in images:
-            if not self.reference:
-                self.tx.set_fixed_parameters(image.get_center_of_mass())
-            new_image = self.tx.apply_to_image(image, self.reference)
-            new_images.append(new_image)
-        return new_images if len(new_images) > 1 else new_images[0]
+        return apply_affine(self, np.asarray(self.array), images, self.reference)
+
+    def inverse(self):
+        """
+        Get the transform that undoes the last call of this transform,
+        e.g. to map a prediction on an augmented image back to the
+        space of the original image.
+        """
+        return ApplyAntsTransform(last_call(self).invert())
 
 class Shear(BaseTransform):
     def __init__(self, shear, reference=None):
@@ -83,12 +120,6 @@ class Shear(BaseTransform):
         
         self.shear = shear
         self.reference = reference
-            
-        self.tx = ants.new_ants_transform(precision="float", 
-                                          dimension=len(shear),
-                                          transform_type="AffineTransform")
-        if self.reference is not None:
-            self.tx.set_fixed_parameters(self.reference.get_center_of_mass())
         
     def __call__(self, *images):
         shear = [math.pi / 180 * s for s in self.shear]
@@ -98,15 +129,10 @@ class Shear(BaseTransform):
             shear_matrix = np.array([[1, shear[0], shear[0], 0],
                                      [shear[1], 1, shear[1], 0],
                                      [shear[2], shear[2], 1, 0]])
-        self.tx.set_parameters(shear_matrix)
-        
-        new_images = []
-        for image in images:
-            if not self.reference:
-                self.tx.set_fixed_parameters(image.get_center_of_mass())
-            new_image = self.tx.apply_to_image(image, self.reference)
-            new_images.append(new_image)
-        return new_images if len(new_images) > 1 else new_images[0]
+        return apply_affine(self, shear_matrix, images, self.reference)
+
+    def inverse(self):
+        return ApplyAntsTransform(last_call(self).invert())
 
 class Rotate(BaseTransform):
     def __init__(self, rotation, reference=None):
@@ -123,12 +149,6 @@ class Rotate(BaseTransform):
         """
         self.rotation = rotation
         self.reference = reference
-            
-        self.tx = ants.new_ants_transform(precision="float", 
-                                          dimension=3 if isinstance(rotation, (tuple,list)) else 2,
-                                          transform_type="AffineTransform")
-        if self.reference is not None:
-            self.tx.set_fixed_parameters(self.reference.get_center_of_mass())
         
     def __call__(self, *images):
         rotation = self.rotation
@@ -174,15 +194,10 @@ class Rotate(BaseTransform):
             )
             rotation_matrix = rotate_matrix_x.dot(rotate_matrix_y).dot(rotate_matrix_z)[:3, :]
         
-        self.tx.set_parameters(rotation_matrix)
-        
-        new_images = []
-        for image in images:
-            if not self.reference:
-                self.tx.set_fixed_parameters(image.get_center_of_mass())
-            new_image = self.tx.apply_to_image(image, self.reference)
-            new_images.append(new_image)
-        return new_images if len(new_images) > 1 else new_images[0]
+        return apply_affine(self, rotation_matrix, images, self.reference)
+
+    def inverse(self):
+        return ApplyAntsTransform(last_call(self).invert())
 
 class Zoom(object):
     def __init__(self, zoom, reference=None):
@@ -200,26 +215,13 @@ class Zoom(object):
         self.zoom = zoom
         self.reference = reference
 
-    def __call__(self, *images):        
-        new_images = []
-        for image in images:
-            nd = image.dimension
-            
-            tx = ants.new_ants_transform(
-                precision="float", dimension=nd, transform_type="AffineTransform"
-            )
-            if self.reference:
-                tx.set_fixed_parameters(self.reference.get_center_of_mass())
-            else:
-                tx.set_fixed_parameters(image.get_center_of_mass())
-                
-            zoom = self.zoom
-            zoom_matrix = np.concatenate((np.eye(nd)*1/zoom, np.zeros((nd,1))), axis=1)
-            tx.set_parameters(zoom_matrix)
-        
-            new_image = tx.apply_to_image(image, self.reference)
-            new_images.append(new_image)
-        return new_images if len(new_images) > 1 else new_images[0]
+    def __call__(self, *images):
+        nd = images[0].dimension
+        zoom_matrix = np.concatenate((np.eye(nd)*1/self.zoom, np.zeros((nd,1))), axis=1)
+        return apply_affine(self, zoom_matrix, images, self.reference)
+
+    def inverse(self):
+        return ApplyAntsTransform(last_call(self).invert())
 
 class Flip(BaseTransform):
     
@@ -234,9 +236,30 @@ class Flip(BaseTransform):
         self.axis = axis
         
     def __call__(self, *images):
+        # images are reflected about their center of mass
+        remember_call(self, images[-1].get_center_of_mass())
         images = [ants.reflect_image(image, self.axis) for image in images]
         return images if len(images) > 1 else images[0]
 
+    def inverse(self):
+        """
+        Get the transform that undoes the last call of this transform.
+        
+        The reflection is done about the center of mass of the last flipped
+        image, so predictions with a different center of mass are still
+        mapped back onto the original image.
+        """
+        center = last_call(self)
+        dimension = len(center)
+        matrix = np.eye(dimension)
+        matrix[self.axis, self.axis] = -1
+        tx = ants.new_ants_transform(precision="float",
+                                     dimension=dimension,
+                                     transform_type="AffineTransform")
+        tx.set_parameters(np.concatenate((matrix, np.zeros((dimension, 1))), axis=1))
+        tx.set_fixed_parameters(center)
+        return ApplyAntsTransform(tx)
+
 class Translate(object):
     def __init__(self, translation, reference=None):
         """
@@ -256,12 +279,6 @@ class Translate(object):
         self.translation = translation
         self.reference = reference
 
-        self.tx = ants.new_ants_transform(
-            precision="float", dimension=len(translation), transform_type="AffineTransform"
-        )
-        if self.reference is not None:
-            self.tx.set_fixed_parameters(self.reference.get_center_of_mass())
-
     def __call__(self, *images):
         translation = self.translation
         
@@ -269,13 +286,7 @@ class Translate(object):
         translation_matrix = np.concatenate((np.eye(nd), 
                                              np.array(translation).reshape(nd,1)), 
                                             axis=1)
-            
-        self.tx.set_parameters(translation_matrix)
-        
-        new_images = []
-        for image in images:
-            if not self.reference:
-                self.tx.set_fixed_parameters(image.get_center_of_mass())
-            new_image = self.tx.apply_to_image(image, self.reference)
-            new_images.append(new_image)
-        return new_images if len(new_images) > 1 else new_images[0]
+        return apply_affine(self, translation_matrix, images, self.reference)
+
+    def inverse(self):
+        return ApplyAntsTransform(last_call(self).invert())
@@ -4,7 +4,7 @@ import random
 import string
 import numpy as np
 
-from .base import BaseTransform
+from .base import BaseTransform, from_numpy_like
 
 __all__ = ['CustomFunction',
            'NumpyFunction']
@@ -49,5 +49,5 @@ class NumpyFunction(BaseTransform):
         self.kwargs = kwargs
         
     def __call__(self, *images):
-        images = [ants.from_numpy_like(self.fn(image.numpy(), **self.kwargs), image) for image in images]
+        images = [from_numpy_like(self.fn(image.numpy(), **self.kwargs), image) for image in images]
         return images if len(images) > 1 else images[0]
\ No newline at end of file
@@ -28,6 +28,8 @@ $PYCMD test_datasets_infer.py $@
 
 echo "Testing loaders"
 $PYCMD test_loaders.py $@
+$PYCMD test_loaders_shared_memory.py $@
+$PYCMD test_loaders_torch.py $@
 
 echo "Testing models"
 $PYCMD test_models.py $@
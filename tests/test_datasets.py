@@ -281,6 +281,51 @@ class TestClass_FolderDataset(unittest.TestCase):
         # test repr
         r = dataset.__repr__()
         
+    def test_scan_metadata(self):
+        tmp_dir = self.tmp_dir
+        dataset = nt.Dataset(
+            inputs=[readers.ImageReader('*/img2d.nii.gz'),
+                    readers.ImageReader('*/img3d.nii.gz')],
+            outputs=readers.ColumnReader('age'),
+            base_dir=tmp_dir,
+            base_file=os.path.join(tmp_dir, 'participants.csv')
+        )
+        path = os.path.join(tmp_dir, 'metadata.npz')
+        index = dataset.scan_metadata(path)
+        self.assertEqual(len(index), 10)
+        self.assertEqual(index['shape'].shape, (10, 3))
+
+        header = index.get(dataset.inputs.values[0][1])
+        self.assertEqual(header['shape'], (182, 218, 182))
+        self.assertEqual(header['orientation'], 'RAI')
+        self.assertEqual(index.get(dataset.inputs.values[0][0])['shape'], (256, 256))
+        self.assertEqual(index.get(dataset.inputs.values[0][0])['spacing'], (1.0, 1.0))
+
+        # the saved index is reused and only changed files are read again
+        ants.image_write(ants.image_read(ants.get_data('r16')).resample_image((64, 64), True),
+                         dataset.inputs.values[2][0])
+        index2 = nt.Dataset(inputs=readers.ImageReader('*/img2d.nii.gz'),
+                            outputs=readers.ColumnReader('age'),
+                            base_dir=tmp_dir,
+                            base_file=os.path.join(tmp_dir, 'participants.csv')).scan_metadata(path)
+        self.assertEqual(len(index2), 5)
+        self.assertEqual(index2.get(dataset.inputs.values[2][0])['shape'], (64, 64))
+        self.assertEqual(nt.datasets.MetadataIndex.load(path).get(dataset.inputs.values[2][0])['shape'], (64, 64))
+
+        # files that changed after the dataset was scanned are read again
+        from nitrain.datasets.metadata import record_shapes
+        self.assertEqual(dataset.metadata.get(dataset.inputs.values[2][0])['shape'], (256, 256))
+        self.assertEqual(record_shapes(dataset)[2], (64, 64))
+
+        # headers are cached, and changing a returned header leaves the cache intact
+        from nitrain.datasets.metadata import read_header
+        read_header(dataset.inputs.values[2][0])['shape'] = None
+        self.assertEqual(read_header(dataset.inputs.values[2][0])['shape'], (64, 64))
+
+        # the shapes of split datasets come from the index
+        ds_train, ds_test = dataset.split(0.8)
+        self.assertEqual(ds_test.metadata.get(ds_test.inputs.values[0][1])['shape'], (182, 218, 182))
+
     def test_double_image_input(self):
         tmp_dir = self.tmp_dir
         dataset = nt.Dataset(
@@ -501,6 +546,17 @@ class TestOther_Bugs(unittest.TestCase):
         
         self.assertEqual(len(dataset.inputs.values), 9)
         
+    def test_dtype(self):
+        base_dir = nt.fetch_data('example-01')
+        
+        dataset = nt.Dataset(inputs=readers.ImageReader('*/img3d.nii.gz'),
+                            outputs=readers.ImageReader('*/img3d_seg.nii.gz', dtype='uint8'),
+                            base_dir=base_dir)
+        
+        x, y = dataset[0]
+        self.assertEqual(x.pixeltype, 'float')
+        self.assertEqual(y.pixeltype, 'unsigned char')
+        
     def test_non_existent_files(self):
         base_dir = nt.fetch_data('example-01')
             
@@ -11,7 +11,7 @@ import ants
 import nitrain as nt
 from nitrain import transforms as tx
 from nitrain.readers import ImageReader
-from nitrain.samplers import SliceSampler
+from nitrain.samplers import SliceSampler, PatchSampler
 
 class TestClass_OcclusionExplainer(unittest.TestCase):
     def setUp(self):
@@ -23,12 +23,13 @@ class TestClass_OcclusionExplainer(unittest.TestCase):
     def test_image_to_image_segmentation(self):
         base_dir = nt.fetch_data('example-01')
 
-        dataset = nt.Dataset(inputs=ImageReader('*/img3d.nii.gz'),
-                            outputs=ImageReader('*/img3d_seg.nii.gz'),
+        dataset = nt.Dataset(inputs=ImageReader('*/img2d.nii.gz'),
+                            outputs=ImageReader('*/img2d.nii.gz'),
                             transforms={
-                                    ('inputs','outputs'): tx.Resample((40,40,40))
+                                    ('inputs','outputs'): tx.Resample((40,40))
                             },
                             base_dir=base_dir)
+        dataset = dataset.select(2)
         
         arch_fn = nt.fetch_architecture('unet', dim=2)
         model = arch_fn((40,40,1),
@@ -37,18 +38,22 @@ class TestClass_OcclusionExplainer(unittest.TestCase):
                         number_of_filters_at_base_layer=16,
                         mode='sigmoid')
         
-        explainer = nt.OcclusionExplainer(model)
+        explainer = nt.OcclusionExplainer(model, sampler=PatchSampler(8, 8, batch_size=25))
         res = explainer.fit(dataset)
         
+        self.assertEqual(len(res), 2)
+        self.assertEqual(res[0].shape, (40,40))
+        
     def test_image_to_image_regression(self):
         base_dir = nt.fetch_data('example-01')
 
-        dataset = nt.Dataset(inputs=ImageReader('*/img3d.nii.gz'),
-                            outputs=ImageReader('*/img3d_100.nii.gz'),
+        dataset = nt.Dataset(inputs=ImageReader('*/img2d.nii.gz'),
+                            outputs=ImageReader('*/img2d.nii.gz'),
                             transforms={
-                                    ('inputs','outputs'): tx.Resample((40,40,40))
+                                    ('inputs','outputs'): tx.Resample((40,40))
                             },
                             base_dir=base_dir)
+        dataset = dataset.select(2)
 
         arch_fn = nt.fetch_architecture('unet', dim=2)
         model = arch_fn((40,40,1),
@@ -57,9 +62,145 @@ class TestClass_OcclusionExplainer(unittest.TestCase):
                         number_of_filters_at_base_layer=16,
                         mode='regression')
         
-        explainer = nt.OcclusionExplainer(model)
+        explainer = nt.OcclusionExplainer(model, window_size=10, stride=5, use_labels=True)
         res = explainer.fit(dataset)
         
+        self.assertEqual(len(res), 2)
+        self.assertEqual(res[0].shape, (40,40))
+        
+    def test_importance_location(self):
+        class RegionModel:
+            # the prediction only depends on one region of the image
+            def __init__(self):
+                self.batch_sizes = []
+            def predict(self, x, verbose=0):
+                self.batch_sizes.append(len(x))
+                return x[:, 10:20, 5:15].mean(axis=(1,2,3))[:,None]
+        
+        img = ants.from_numpy(np.random.rand(30,40).astype('float32') + 1,
+                              spacing=(2,2), origin=(5,5))
+        model = RegionModel()
+        explainer = nt.OcclusionExplainer(model, sampler=PatchSampler(5, 5, batch_size=16))
+        res = explainer.fit(img)
+        
+        self.assertTrue(ants.is_image(res))
+        self.assertEqual(res.spacing, img.spacing)
+        self.assertEqual(res.origin, img.origin)
+        self.assertEqual(model.batch_sizes, [1, 16, 16, 16])
+        
+        arr = res.numpy()
+        self.assertTrue(arr[10:20,5:15].min() > 0)
+        self.assertAlmostEqual(float(arr[20:,:].max()), 0, places=5)
+
+
+    def test_class_label(self):
+        class ClassModel:
+            # the score of class 1 only depends on one region of the image
+            def predict(self, x, verbose=0):
+                return np.stack([x.mean(axis=(1,2,3)), x[:, 10:20, 5:15].mean(axis=(1,2,3))], axis=1)
+        
+        img = ants.from_numpy(np.random.rand(30,40).astype('float32') + 1)
+        dataset = nt.Dataset([img], [1])
+        res = nt.OcclusionExplainer(ClassModel(), window_size=5, use_labels=True).fit(dataset)
+        
+        arr = res[0].numpy()
+        self.assertTrue(arr[10:20,5:15].min() > 0)
+        self.assertAlmostEqual(float(arr[20:,:].max()), 0, places=5)
+
+    def test_coarse_to_fine(self):
+        class RegionModel:
+            def __init__(self):
+                self.n_images = 0
+            def predict(self, x, verbose=0):
+                self.n_images += len(x)
+                return x[:, 20:28, 36:44, 8:16].mean(axis=(1,2,3,4))[:,None]
+        
+        img = ants.from_numpy(np.random.rand(64,64,32).astype('float32') + 1)
+        
+        model = RegionModel()
+        res_full = nt.OcclusionExplainer(model, window_size=4, batch_size=256).fit(img)
+        n_full = model.n_images
+        
+        model = RegionModel()
+        explainer = nt.OcclusionExplainer(model, window_size=16, min_window_size=4,
+                                          threshold=0.3, batch_size=256)
+        res = explainer.fit(img)
+        
+        self.assertTrue(model.n_images < n_full / 10)
+        self.assertEqual(explainer.n_evaluations, model.n_images - 1)
+        nptest.assert_array_equal(res.numpy() > 0, res_full.numpy() > 0)
+        
+        # budget of model evaluations
+        model = RegionModel()
+        explainer = nt.OcclusionExplainer(model, window_size=16, min_window_size=4,
+                                          max_evaluations=40)
+        res = explainer.fit(img)
+        self.assertEqual(explainer.n_evaluations, 40)
+
+
+class TestClass_GradientExplainers(unittest.TestCase):
+    def setUp(self):
+        import keras
+        # model output is the sum of squared voxels, so gradients are known
+        inputs = keras.Input((12,10,8,1))
+        outputs = keras.layers.Lambda(lambda t: keras.ops.sum(t**2, axis=(1,2,3,4))[:,None])(inputs)
+        self.model = keras.Model(inputs, outputs)
+        self.img = ants.from_numpy(np.random.rand(12,10,8).astype('float32'), spacing=(2,2,2))
+
+    def test_gradient(self):
+        res = nt.GradientExplainer(self.model).fit(self.img)
+        self.assertTrue(ants.is_image(res))
+        self.assertEqual(res.spacing, self.img.spacing)
+        nptest.assert_allclose(res.numpy(), 2 * self.img.numpy(), rtol=1e-4, atol=1e-5)
+
+        res = nt.GradientExplainer(self.model).fit([self.img, self.img])
+        self.assertEqual(len(res), 2)
+
+    def test_smoothgrad(self):
+        res = nt.SmoothGradExplainer(self.model, n_samples=64, batch_size=32).fit(self.img)
+        self.assertEqual(res.shape, self.img.shape)
+        self.assertTrue(np.abs(res.numpy() - 2 * self.img.numpy()).mean() < 0.1)
+
+    def test_integrated_gradients(self):
+        res = nt.IntegratedGradientsExplainer(self.model, n_steps=16, batch_size=8).fit(self.img)
+        nptest.assert_allclose(res.numpy(), self.img.numpy()**2, rtol=1e-3, atol=1e-4)
+
+    def test_torch(self):
+        import torch
+        
+        class SquareModel(torch.nn.Module):
+            def __init__(self):
+                super().__init__()
+                self.weight = torch.nn.Parameter(torch.ones(1))
+            def forward(self, x):
+                return self.weight * (x**2).sum(dim=(1,2,3,4))[:,None]
         
+        model = SquareModel()
+        res = nt.GradientExplainer(model, expand_dims=0).fit(self.img)
+        nptest.assert_allclose(res.numpy(), 2 * self.img.numpy(), rtol=1e-4, atol=1e-5)
+        # explaining a model does not touch the gradients of its parameters
+        self.assertIsNone(model.weight.grad)
+        self.assertTrue(model.weight.requires_grad)
+
+    def test_unet(self):
+        base_dir = nt.fetch_data('example-01')
+        dataset = nt.Dataset(inputs=ImageReader('*/img2d.nii.gz'),
+                            outputs=ImageReader('*/img2d.nii.gz'),
+                            transforms={
+                                    ('inputs','outputs'): tx.Resample((32,32))
+                            },
+                            base_dir=base_dir)
+        dataset = dataset.select(2)
+
+        arch_fn = nt.fetch_architecture('unet', dim=2)
+        model = arch_fn((32,32,1),
+                        number_of_outputs=1,
+                        number_of_layers=2,
+                        number_of_filters_at_base_layer=8,
+                        mode='sigmoid')
+        res = nt.SmoothGradExplainer(model, n_samples=8).fit(dataset)
+        self.assertEqual(len(res), 2)
+        self.assertEqual(res[0].shape, (32,32))
+
 if __name__ == '__main__':
     run_tests()
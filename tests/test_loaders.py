@@ -1,4 +1,5 @@
 import os
+import threading
 import unittest
 from main import run_tests
 
@@ -12,7 +13,17 @@ import nitrain as nt
 from nitrain import samplers, readers, transforms as tx
 from nitrain.readers import ImageReader
 from nitrain.samplers import SliceSampler
-from nitrain.loaders.loader import record_generator
+
+class ITKThreads:
+    """
+    Transform that fills an image with the number of threads of its process
+    that are not Python threads, i.e. the threads that ITK started.
+    """
+    def __call__(self, *images):
+        n = float(len(os.listdir('/proc/self/task')) - threading.active_count())
+        images = [image.new_image_like(np.full(image.shape, n, dtype='float32')) for image in images]
+        return images if len(images) > 1 else images[0]
+
 
 class TestClass_DatasetLoader(unittest.TestCase):
     def setUp(self):
@@ -69,8 +80,7 @@ class TestClass_DatasetLoader(unittest.TestCase):
         x_batch, y_batch = next(iter(loader2))
         self.assertTrue(x_batch.shape == (4, 1, 256, 256))
         
-        gen = record_generator(loader)
-        xb,yb = next(iter(gen))
+        xb, yb = next(iter(loader))
         
     def test_copy(self):
         import ants
@@ -95,8 +105,37 @@ class TestClass_DatasetLoader(unittest.TestCase):
         x_batch, y_batch = next(iter(keras_loader))
         self.assertEqual(x_batch.shape, (4, 256, 256, 1))
         
-        gen = record_generator(loader)
-        xb,yb = next(iter(gen))
+        xb, yb = next(iter(loader))
+        
+    def test_to_keras_shuffle(self):
+        imgs = [ants.from_numpy(np.zeros((4, 4), dtype='float32')) for _ in range(8)]
+        dataset = nt.Dataset(imgs, list(range(8)))
+        for seed in [None, 3]:
+            loader = nt.Loader(dataset, images_per_batch=2, shuffle=True, seed=seed)
+            keras_loader = loader.to_keras()
+            epochs = [[int(y) for xb, yb in keras_loader for y in yb.numpy()] for _ in range(3)]
+            for epoch in epochs:
+                self.assertEqual(sorted(epoch), list(range(8)))
+            # a new order every pass over the pipeline
+            self.assertTrue(len(set(tuple(epoch) for epoch in epochs)) > 1)
+
+    def test_to_keras_matches_loader(self):
+        img = ants.from_numpy(np.random.rand(20, 24, 5).astype('float32'))
+        x = [img + i for i in range(5)]
+        dataset = nt.Dataset([x, x], x)
+        loader = nt.Loader(dataset, images_per_batch=2,
+                           sampler=samplers.SliceSampler(batch_size=4, axis=2))
+        
+        keras_loader = loader.to_keras()
+        self.assertEqual(keras_loader.element_spec[1].shape.as_list(), [None, 20, 24, 1])
+        
+        batches = list(loader)
+        keras_batches = list(keras_loader)
+        self.assertEqual(len(batches), len(keras_batches))
+        for (xb, yb), (xb2, yb2) in zip(batches, keras_batches):
+            nptest.assert_allclose(xb[0], xb2[0].numpy())
+            nptest.assert_allclose(xb[1], xb2[1].numpy())
+            nptest.assert_allclose(yb, yb2.numpy())
         
     def test_keras_multi(self):
         img2d = ants.image_read(ants.get_data('r16'))
@@ -114,8 +153,7 @@ class TestClass_DatasetLoader(unittest.TestCase):
         self.assertEqual(xb[1].shape, (4,256,256,1))
         self.assertEqual(yb.shape, (4))
         
-        gen = record_generator(loader)
-        xb,yb = next(iter(gen))
+        xb, yb = next(iter(loader))
         
     def test_3d(self):
         loader = nt.Loader(self.dataset_3d, images_per_batch=4)
@@ -138,8 +176,7 @@ class TestClass_DatasetLoader(unittest.TestCase):
         x_batch, y_batch = next(iter(loader2))
         self.assertTrue(x_batch.shape == (4, 1, 182, 218, 182))
         
-        gen = record_generator(loader)
-        xb,yb = next(iter(gen))
+        xb, yb = next(iter(loader))
 
     def test_3d_no_expand(self):
         loader = nt.Loader(self.dataset_3d, images_per_batch=4,
@@ -151,8 +188,7 @@ class TestClass_DatasetLoader(unittest.TestCase):
         x_batch, y_batch = next(iter(loader2))
         self.assertTrue(x_batch.shape == (4, 182, 218, 182))
         
-        gen = record_generator(loader)
-        xb,yb = next(iter(gen))
+        xb, yb = next(iter(loader))
     
     def test_image_to_image(self):
         img = ants.image_read(ants.get_data('r16'))
@@ -171,8 +207,7 @@ class TestClass_DatasetLoader(unittest.TestCase):
         self.assertTrue(x_batch.shape == (4, 256, 256, 1))
         self.assertTrue(y_batch.shape == (4, 256, 256, 1))
         
-        gen = record_generator(loader)
-        xb,yb = next(iter(gen))
+        xb, yb = next(iter(loader))
 
     def test_multi_image_to_image(self):
         import ants
@@ -196,8 +231,7 @@ class TestClass_DatasetLoader(unittest.TestCase):
         self.assertTrue(tuple(x_batch[1].shape) == (4, 256, 256, 1))
         self.assertTrue(tuple(y_batch.shape) == (4, 256, 256, 1))
         
-        gen = record_generator(loader)
-        xb,yb = next(iter(gen))
+        xb, yb = next(iter(loader))
     
     def test_image_to_image_with_slice_sampler(self):
         img = ants.image_read(ants.get_data('mni'))
@@ -317,6 +351,238 @@ class TestClass_DatasetLoader(unittest.TestCase):
         self.assertEqual(xb.shape, (20,40,40,1))
         self.assertEqual(yb.shape, (20,40,40,2))
 
-    
+    def test_dtype(self):
+        base_dir = nt.fetch_data('example-01')
+
+        dataset = nt.Dataset(inputs=ImageReader('*/img3d.nii.gz'),
+                            outputs=ImageReader('*/img3d_multiseg.nii.gz', dtype='uint8'),
+                            transforms={
+                                    'outputs': tx.LabelsToChannels()
+                            },
+                            base_dir=base_dir)
+
+        loader = nt.Loader(dataset,
+                           images_per_batch=2,
+                           channels_first=None,
+                           dtype={'inputs': 'float16'},
+                           sampler=SliceSampler(batch_size=10, axis=2))
+
+        xb, yb = next(iter(loader))
+        self.assertEqual(xb.dtype, np.float16)
+        self.assertEqual(yb.dtype, np.uint8)
+        self.assertEqual(xb.shape[0], 10)
+
+    def test_shuffle(self):
+        from nitrain.loaders.loader import buffer_shuffle
+
+        loader = nt.Loader(self.dataset_2d, images_per_batch=3, shuffle=True, seed=0)
+        y = np.concatenate([yb for _, yb in loader])
+        self.assertEqual(sorted(y), list(range(10)))
+        self.assertNotEqual(list(y), list(range(10)))
+
+        # reads follow the planned order, also when they are read ahead
+        order = np.concatenate(loader._image_batches())
+        nptest.assert_equal(y, order)
+        loader.prefetch = 2
+        nptest.assert_equal(np.concatenate([yb for _, yb in loader]), order)
+
+        # a shuffle buffer moves every record by at most the buffer size
+        indices = buffer_shuffle(1000, 10, np.random.default_rng(0))
+        self.assertEqual(sorted(indices), list(range(1000)))
+        self.assertTrue(np.all(np.arange(1000) - np.argsort(indices) <= 10))
+        self.assertFalse(np.array_equal(indices, np.arange(1000)))
+
+        loader = nt.Loader(self.dataset_2d, images_per_batch=3, shuffle=4, seed=0)
+        self.assertEqual(sorted(np.concatenate([yb for _, yb in loader])), list(range(10)))
+
+    def test_pool(self):
+        imgs = [ants.from_numpy(np.full((8,8,5), i, dtype='float32')) for i in range(6)]
+        dataset = nt.Dataset(imgs, imgs)
+        loader = nt.Loader(dataset, images_per_batch=1, pool_size=3,
+                           sampler=SliceSampler(batch_size=4, axis=2))
+
+        np.random.seed(0)
+        batches = list(loader)
+        subjects = [xb[:, 0, 0, 0].astype('int') for xb, _ in batches]
+
+        # every slice is drawn exactly once and stays paired with its output
+        self.assertEqual(sorted(np.concatenate(subjects)), sorted(list(range(6)) * 5))
+        for xb, yb in batches:
+            nptest.assert_array_equal(xb, yb)
+
+        # batches mix subjects, but only from the records in the pool
+        self.assertTrue(len(set(subjects[0])) > 1)
+        self.assertTrue(set(subjects[0]) <= {0, 1, 2})
+
+        # a pass over the pool resumes after its consumed batches
+        np.random.seed(1)
+        batches = list(loader)
+        np.random.seed(1)
+        partial = loader.iterate()
+        for _ in range(3):
+            next(partial)
+        state = loader.state_dict()
+        np.random.seed(2)
+        resumed = list(loader.iterate(state))
+        self.assertEqual(len(resumed), len(batches) - 3)
+        for (xb, _), (xb2, _) in zip(batches[3:], resumed):
+            nptest.assert_array_equal(xb, xb2)
+
+    def test_shard(self):
+        def shards(**kwargs):
+            loaders = [nt.Loader(self.dataset_2d, images_per_batch=2, rank=rank,
+                                 world_size=3, **kwargs) for rank in range(3)]
+            return [np.concatenate(loader._image_batches()) for loader in loaders], loaders
+
+        # padded: equal shards that cover every record
+        indices, loaders = shards(shuffle=True, seed=1)
+        self.assertEqual([len(i) for i in indices], [4, 4, 4])
+        self.assertEqual(set(np.concatenate(indices)), set(range(10)))
+        self.assertEqual(len(loaders[0]), 2)
+
+        # the same order in every process, a new order every epoch
+        nptest.assert_equal(indices[0], shards(shuffle=True, seed=1)[0][0])
+        loaders[0].set_epoch(1)
+        self.assertFalse(np.array_equal(indices[0], np.concatenate(loaders[0]._image_batches())))
+
+        # dropped: disjoint shards
+        indices, loaders = shards(shuffle=True, seed=1, drop_last=True)
+        self.assertEqual([len(i) for i in indices], [3, 3, 3])
+        self.assertEqual(len(set(np.concatenate(indices))), 9)
+
+        # the rank and world size are inferred from the environment
+        os.environ['RANK'], os.environ['WORLD_SIZE'] = '1', '2'
+        try:
+            loader = nt.Loader(self.dataset_2d, images_per_batch=5)
+            self.assertEqual(loader.shard(), (1, 2))
+            xb, yb = next(iter(loader))
+            nptest.assert_equal(yb, [1, 3, 5, 7, 9])
+        finally:
+            del os.environ['RANK'], os.environ['WORLD_SIZE']
+        self.assertEqual(loader.shard(), (0, 1))
+
+    def test_len_from_headers(self):
+        import tempfile
+        from nitrain.datasets import metadata
+
+        # images of different sizes on disk
+        tmpdir = tempfile.TemporaryDirectory()
+        for i in range(5):
+            img = ants.from_numpy(np.random.rand(20 + 4*i, 24, 10 + i).astype('float32'))
+            ants.image_write(img, os.path.join(tmpdir.name, f'img{i}.nii.gz'))
+        dataset = nt.Dataset(inputs=ImageReader('*.nii.gz'), outputs=ImageReader('*.nii.gz'),
+                             base_dir=tmpdir.name)
+
+        self.assertEqual(metadata.record_shapes(dataset)[2], (28, 24, 12))
+        self.assertEqual(metadata.read_header(dataset.inputs.values[2])['shape'], (28, 24, 12))
+
+        for sampler in [samplers.SliceSampler(batch_size=4, axis=0),
+                        samplers.BlockSampler((8, 8, 8), stride=(8, 8, 8), batch_size=5),
+                        samplers.SlicePatchSampler((8, 8), stride=(8, 8), axis=2, batch_size=7)]:
+            for kwargs in [dict(), dict(shuffle=True), dict(world_size=2, rank=1)]:
+                loader = nt.Loader(dataset, images_per_batch=2, sampler=sampler, **kwargs)
+                self.assertEqual(len(loader), len(list(loader)))
+
+        # transforms that change the shape
+        loader = nt.Loader(dataset, images_per_batch=2, sampler=samplers.SliceSampler(batch_size=4),
+                           transforms={('inputs', 'outputs'): tx.Resample((10, 10, 6))})
+        self.assertEqual(len(loader), len(list(loader)))
+
+        # printing reads no headers and len sees files that changed
+        loader = nt.Loader(dataset, images_per_batch=2, sampler=samplers.SliceSampler(batch_size=4, axis=0))
+        self.assertNotIn('batches', repr(loader))
+        n_batches = len(loader)
+        self.assertIn(f'batches={n_batches}', repr(loader))
+        ants.image_write(ants.from_numpy(np.random.rand(40, 24, 10).astype('float32')),
+                         dataset.inputs.values[0])
+        self.assertEqual(len(loader), len(list(loader)))
+        self.assertTrue(len(loader) > n_batches)
+
+        # images in memory
+        for sampler, kwargs in [(samplers.SliceSampler(batch_size=50, axis=0), dict()),
+                                (samplers.SliceSampler(batch_size=50, axis=0), dict(pool_size=3)),
+                                (samplers.PatchSampler((96, 96), (64, 64), batch_size=7), dict())]:
+            loader = nt.Loader(self.dataset_2d, images_per_batch=4, sampler=sampler, **kwargs)
+            self.assertEqual(len(loader), len(list(loader)))
+        tmpdir.cleanup()
+
+    def test_bucket_by(self):
+        shapes = [(20, 24), (20, 24), (32, 24), (20, 24), (32, 24), (30, 20)]
+        imgs = [ants.from_numpy(np.full(shape, i + 1, dtype='float32')) for i, shape in enumerate(shapes)]
+        dataset = nt.Dataset(imgs, imgs)
+
+        loader = nt.Loader(dataset, images_per_batch=2, bucket_by='shape', shuffle=True)
+        batches = list(loader)
+        self.assertEqual(len(batches), len(loader))
+        self.assertEqual(sorted(len(yb) for xb, yb in batches), [1, 1, 2, 2])
+        for xb, yb in batches:
+            values = xb[:, 0, 0, 0].astype('int64') - 1
+            self.assertEqual(len(set(shapes[v] for v in values)), 1)
+            self.assertEqual(xb.shape[1:3], shapes[values[0]])
+
+        # coarser buckets are padded at the end to the largest shape of the bucket
+        loader = nt.Loader(dataset, images_per_batch=3, bucket_by=lambda h: h['shape'][0] > 25)
+        (xb1, yb1), (xb2, yb2) = list(loader)
+        self.assertEqual(xb1.shape, (3, 20, 24, 1))
+        self.assertEqual(xb2.shape, (3, 32, 24, 1))
+        self.assertEqual(xb2[2, 31, 23, 0], 0)
+        self.assertEqual(xb2[2, 29, 19, 0], 6)
+        nptest.assert_equal(xb2, yb2)
+
+        with self.assertRaises(Exception):
+            nt.Loader(dataset, images_per_batch=2, bucket_by='shape', pool_size=2)
+
+    def test_num_threads(self):
+        from nitrain.loaders.threads import thread_plan
+        self.assertEqual(thread_plan(16, 4), ('inter', 4))
+        self.assertEqual(thread_plan(3, 8), ('inter', 1))
+        self.assertEqual(thread_plan(8, 0), ('intra', 8))
+
+    @unittest.skipUnless(os.path.exists('/proc/self/task'), 'needs /proc to count threads')
+    def test_num_threads_workers(self):
+        imgs = [ants.from_numpy(np.random.rand(8, 8).astype('float32')) for _ in range(4)]
+        dataset = nt.Dataset(imgs, list(range(4)))
+        environ = dict(os.environ)
+        
+        # ITK starts as many threads as the budget of each worker allows
+        loader = nt.Loader(dataset, images_per_batch=2, num_workers=2, num_threads=6,
+                           transforms={'inputs': ITKThreads()})
+        x = np.concatenate([xb for xb, yb in loader])
+        self.assertEqual(x.max(), 3)
+        self.assertEqual(dict(os.environ), environ)
+
+    def test_transform_threads(self):
+        import threading
+        from nitrain.transforms.base import thread_pool, map_images
+
+        with thread_pool(2):
+            names = map_images(lambda i: threading.current_thread().name, [0, 1, 2])
+        self.assertNotIn(threading.current_thread().name, names)
+
+        imgs = [ants.from_numpy(np.random.rand(16, 16, 8).astype('float32')) for _ in range(5)]
+        transforms = {('inputs-0', 'inputs-1', 'outputs'): [tx.Smooth(1), tx.Resample((8, 8, 4))]}
+        dataset = nt.Dataset([imgs, [img * 2 for img in imgs]], imgs,
+                             transforms={'inputs-0': tx.Smooth(2)})
+        for images_per_batch in [1, 3]:
+            batches = list(nt.Loader(dataset, images_per_batch=images_per_batch,
+                                     transforms=transforms))
+            threaded = list(nt.Loader(dataset, images_per_batch=images_per_batch,
+                                      transforms=transforms, transform_threads=3))
+            self.assertEqual(len(batches), len(threaded))
+            for (xb, yb), (xb2, yb2) in zip(batches, threaded):
+                nptest.assert_allclose(xb[0], xb2[0])
+                nptest.assert_allclose(xb[1], xb2[1])
+                nptest.assert_allclose(yb, yb2)
+
+        # one pool of threads for the whole pass
+        from unittest import mock
+        from nitrain.loaders import loader as loader_module
+        with mock.patch.object(loader_module, 'pool_executor',
+                               wraps=loader_module.pool_executor) as pool_executor:
+            list(nt.Loader(dataset, images_per_batch=1, transforms=transforms,
+                           transform_threads=3))
+        self.assertEqual(pool_executor.call_count, 1)
+
+
 if __name__ == '__main__':
     run_tests()
@@ -0,0 +1,86 @@
+import os
+import unittest
+from main import run_tests
+
+import numpy as np
+import numpy.testing as nptest
+
+import ants
+import nitrain as nt
+from nitrain import samplers
+from nitrain.loaders.shared_memory import to_shared_memory, from_shared_memory, free_shared_memory
+
+
+class TestFunction_shared_memory(unittest.TestCase):
+
+    def test_round_trip(self):
+        x = [np.random.rand(4, 10, 12, 1), np.ones((4, 10, 12, 1), dtype='uint8')]
+        y = np.arange(4)
+
+        desc = to_shared_memory((x, y))
+        x2, y2 = from_shared_memory(desc)
+
+        self.assertTrue(isinstance(x2, list))
+        self.assertEqual(len(x2), 2)
+        nptest.assert_array_equal(x2[0], x[0])
+        nptest.assert_array_equal(x2[1], x[1])
+        self.assertEqual(x2[1].dtype, np.uint8)
+        nptest.assert_array_equal(y2, y)
+
+    def test_values_pass_through(self):
+        y = np.array(['a', 'b'], dtype=object)
+        desc = to_shared_memory((np.zeros((2, 3)), y))
+        x2, y2 = from_shared_memory(desc)
+        self.assertEqual(list(y2), ['a', 'b'])
+
+    def test_views_outlive_block(self):
+        desc = to_shared_memory(np.arange(10.0))
+        x = from_shared_memory(desc)
+        view = x[2:5]
+        del x
+        nptest.assert_array_equal(view, [2.0, 3.0, 4.0])
+
+    def test_free(self):
+        desc = to_shared_memory(np.zeros(10))
+        free_shared_memory(desc)
+        with self.assertRaises(FileNotFoundError):
+            from_shared_memory(desc)
+
+
+class TestClass_LoaderWorkers(unittest.TestCase):
+    def setUp(self):
+        imgs = [ants.from_numpy(np.random.rand(20, 24, 16).astype('float32') + i) for i in range(7)]
+        self.dataset = nt.Dataset([imgs, imgs], imgs)
+
+    def test_workers_match_main_process(self):
+        for sampler in [None, samplers.SliceSampler(batch_size=9, axis=2)]:
+            loader = nt.Loader(self.dataset, images_per_batch=2, sampler=sampler)
+            loader_workers = nt.Loader(self.dataset, images_per_batch=2, sampler=sampler, num_workers=2)
+
+            batches = list(loader)
+            batches_workers = list(loader_workers)
+            self.assertEqual(len(batches), len(batches_workers))
+
+            for (xb, yb), (xb2, yb2) in zip(batches, batches_workers):
+                nptest.assert_array_equal(xb[0], xb2[0])
+                nptest.assert_array_equal(xb[1], xb2[1])
+                nptest.assert_array_equal(yb, yb2)
+
+    def test_early_stop(self):
+        loader = nt.Loader(self.dataset, images_per_batch=2, num_workers=2)
+        it = iter(loader)
+        xb, yb = next(it)
+        it.close()
+        self.assertEqual(xb[0].shape, (2, 20, 24, 16, 1))
+
+    def test_worker_error(self):
+        imgs = [ants.from_numpy(np.random.rand(20, 24).astype('float32')) for i in range(4)]
+        dataset = nt.Dataset(imgs, imgs)
+        loader = nt.Loader(dataset, images_per_batch=2, num_workers=2,
+                           sampler=samplers.BlockSampler(4, 4, batch_size=4))
+        with self.assertRaises(RuntimeError):
+            list(loader)
+
+
+if __name__ == '__main__':
+    run_tests()
@@ -0,0 +1,115 @@
+import os
+import unittest
+from main import run_tests
+
+import numpy as np
+import numpy.testing as nptest
+
+import ants
+import nitrain as nt
+from nitrain import samplers, transforms as tx
+
+
+class RandomValue:
+    """Transform that fills an image with a random value."""
+    def __call__(self, image):
+        return image.new_image_like(np.full(image.shape, np.random.rand(), dtype='float32'))
+
+
+class TestClass_TorchLoader(unittest.TestCase):
+    def setUp(self):
+        imgs = [ants.from_numpy(np.random.rand(20, 24, 16).astype('float32') + i) for i in range(6)]
+        self.imgs = imgs
+        self.dataset = nt.Dataset(imgs, list(range(6)))
+        self.dataset_multi = nt.Dataset([imgs, imgs], imgs)
+
+    def test_to_torch(self):
+        import torch
+        dataset = nt.Dataset(self.imgs, self.imgs)
+        loader = nt.Loader(dataset, images_per_batch=2, channels_first=True,
+                           sampler=samplers.SliceSampler(batch_size=8, axis=2))
+        torch_loader = loader.to_torch()
+
+        batches = list(torch_loader)
+        self.assertEqual(len(batches), len(list(loader)))
+        xb, yb = batches[0]
+        self.assertTrue(isinstance(xb, torch.Tensor))
+        self.assertEqual(tuple(xb.shape), (8, 1, 20, 24))
+
+    def test_to_torch_workers(self):
+        loader = nt.Loader(self.dataset_multi, images_per_batch=2)
+        torch_loader = loader.to_torch(num_workers=2, persistent_workers=True)
+
+        batches = list(torch_loader)
+        self.assertEqual(len(batches), 3)
+
+        # every record is loaded exactly once across workers
+        means = sorted([float(xb[0][i].mean()) for xb, yb in batches for i in range(len(xb[0]))])
+        nptest.assert_allclose(means, [float(img.mean()) for img in self.imgs], rtol=1e-5)
+
+    def test_to_torch_workers_shuffle(self):
+        imgs = [ants.from_numpy(np.zeros((4, 4), dtype='float32')) for _ in range(8)]
+        loader = nt.Loader(nt.Dataset(imgs, list(range(8))), images_per_batch=1, shuffle=True)
+
+        for persistent_workers in [False, True]:
+            torch_loader = loader.to_torch(num_workers=2, persistent_workers=persistent_workers)
+            epochs = [[int(y) for xb, yb in torch_loader for y in yb] for _ in range(3)]
+
+            # every record exactly once per epoch, in a new order every epoch
+            for epoch in epochs:
+                self.assertEqual(sorted(epoch), list(range(8)))
+            self.assertTrue(len(set(tuple(epoch) for epoch in epochs)) > 1)
+
+    def test_to_torch_workers_seed(self):
+        loader = nt.Loader(self.dataset, images_per_batch=1, seed=5,
+                           transforms={'inputs': RandomValue()})
+
+        def values():
+            return [float(xb[0].flatten()[0]) for xb, yb in loader.to_torch(num_workers=2)]
+
+        # seeded random transforms repeat, but differ between epochs
+        first = values()
+        self.assertEqual(values(), first)
+        self.assertEqual(len(set(first)), len(first))
+        loader.set_epoch(1)
+        self.assertNotEqual(values(), first)
+
+    @unittest.skipUnless(os.path.exists('/proc/self/task'), 'needs /proc to count threads')
+    def test_to_torch_num_threads(self):
+        from test_loaders import ITKThreads
+        dataset = nt.Dataset(self.imgs[:4], list(range(4)))
+        loader = nt.Loader(dataset, images_per_batch=2, num_threads=6,
+                           transforms={'inputs': ITKThreads()})
+        x = np.concatenate([xb.numpy() for xb, yb in loader.to_torch(num_workers=2)])
+        self.assertEqual(x.max(), 3)
+
+    def test_torch_dataset(self):
+        import torch
+        from torch.utils.data import DataLoader
+        from nitrain.loaders.torch_dataset import TorchDataset, worker_init_fn
+
+        torch_dataset = TorchDataset(self.dataset, transforms={'inputs': tx.RandomFlip(p=0.5)})
+        self.assertEqual(len(torch_dataset), 6)
+
+        x, y = torch_dataset[0]
+        self.assertEqual(x.shape, (1, 20, 24, 16))
+
+        torch_loader = DataLoader(torch_dataset, batch_size=4, shuffle=True,
+                                  num_workers=2, worker_init_fn=worker_init_fn)
+        xb, yb = next(iter(torch_loader))
+        self.assertEqual(tuple(xb.shape), (4, 1, 20, 24, 16))
+        self.assertEqual(tuple(yb.shape), (4,))
+
+    def test_torch_dataset_multi(self):
+        from torch.utils.data import DataLoader
+        from nitrain.loaders.torch_dataset import TorchDataset
+
+        torch_dataset = TorchDataset(self.dataset_multi, channels_first=False)
+        xb, yb = next(iter(DataLoader(torch_dataset, batch_size=3)))
+        self.assertEqual(len(xb), 2)
+        self.assertEqual(tuple(xb[1].shape), (3, 20, 24, 16, 1))
+        self.assertEqual(tuple(yb.shape), (3, 20, 24, 16, 1))
+
+
+if __name__ == '__main__':
+    run_tests()
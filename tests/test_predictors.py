@@ -11,7 +11,7 @@ import ants
 import nitrain as nt
 from nitrain import transforms as tx
 from nitrain.readers import ImageReader
-from nitrain.samplers import SliceSampler
+from nitrain.samplers import SliceSampler, PatchSampler, BlockSampler
 
 class TestClass_Predictor(unittest.TestCase):
     def setUp(self):
@@ -69,7 +69,139 @@ class TestClass_Predictor(unittest.TestCase):
         self.assertTrue(ants.is_image(y_pred[0]))
         self.assertEqual(y_pred[0].shape, (40,40,40))
         self.assertEqual(len(y_pred), len(dataset))
+
+
+    def test_sliding_window_segmentation(self):
+        base_dir = nt.fetch_data('example-01')
+
+        dataset = nt.Dataset(inputs=ImageReader('*/img2d.nii.gz'),
+                            outputs=ImageReader('*/img2d.nii.gz'),
+                            transforms={
+                                    ('inputs','outputs'): tx.Resample((40,40))
+                            },
+                            base_dir=base_dir)
+
+        arch_fn = nt.fetch_architecture('unet', dim=2)
+        model = arch_fn((16,16,1),
+                        number_of_outputs=1,
+                        number_of_layers=2,
+                        number_of_filters_at_base_layer=8,
+                        mode='sigmoid')
+
+        predictor = nt.Predictor(model,
+                                 task='segmentation',
+                                 sampler=PatchSampler(16, 16, batch_size=8),
+                                 overlap=0.5)
+        y_pred = predictor.predict(dataset)
+        
+        self.assertEqual(len(y_pred), len(dataset))
+        self.assertEqual(y_pred[0].shape, (40,40))
+        self.assertEqual(y_pred[0].pixeltype, 'unsigned char')
+
+    def test_sliding_window_blending(self):
+        class IdentityModel:
+            def predict(self, x, verbose=0):
+                return x
+        
+        img = ants.from_numpy(np.random.rand(20,10,25).astype('float32'),
+                              spacing=(2,2,3), origin=(10,10,10))
+        dataset = nt.Dataset([img, img], [img, img])
+        
+        for blend in ['gaussian', 'mean']:
+            predictor = nt.Predictor(IdentityModel(),
+                                     task='regression',
+                                     sampler=BlockSampler(8, 6, batch_size=5),
+                                     blend=blend)
+            y_pred = predictor.predict(dataset)
+            
+            # identity predictions are stitched back exactly
+            nptest.assert_allclose(y_pred[0].numpy(), img.numpy(), rtol=1e-5)
+            self.assertEqual(y_pred[0].spacing, img.spacing)
+            self.assertEqual(y_pred[0].origin, img.origin)
         
+        with self.assertRaises(ValueError):
+            nt.Predictor(IdentityModel(), task='regression', blend='max')
+
+
+    def test_cross_subject_batches(self):
+        class IdentityModel:
+            def __init__(self):
+                self.batch_sizes = []
+            def predict(self, x, verbose=0):
+                self.batch_sizes.append(len(x))
+                return x
+        
+        imgs = [ants.from_numpy(np.random.rand(20,10,5).astype('float32')) for _ in range(5)]
+        dataset = nt.Dataset(imgs, imgs)
+        
+        # 5 subjects x 5 slices are packed into full batches of 8
+        model = IdentityModel()
+        predictor = nt.Predictor(model, task='regression',
+                                 sampler=SliceSampler(batch_size=8, axis=2))
+        y_pred = predictor.predict(dataset)
+        self.assertEqual(model.batch_sizes, [8, 8, 8, 1])
+        for img, img_pred in zip(imgs, y_pred):
+            nptest.assert_allclose(img_pred.numpy(), img.numpy())
+        
+        # whole images
+        model = IdentityModel()
+        predictor = nt.Predictor(model, task='regression', batch_size=2)
+        y_pred = predictor.predict(dataset)
+        self.assertEqual(model.batch_sizes, [2, 2, 1])
+        nptest.assert_allclose(y_pred[4].numpy(), imgs[4].numpy())
+
+    def test_predict_iter_and_to_dir(self):
+        class IdentityModel:
+            def predict(self, x, verbose=0):
+                return x
+        
+        base_dir = nt.fetch_data('example-01')
+        dataset = nt.Dataset(inputs=ImageReader('{id}/img3d.nii.gz'),
+                             outputs=ImageReader('{id}/img3d_seg.nii.gz'),
+                             base_dir=base_dir)
+        predictor = nt.Predictor(IdentityModel(), task='regression',
+                                 sampler=SliceSampler(axis=2), num_workers=2)
         
+        y_pred = list(predictor.predict_iter(dataset))
+        self.assertEqual(len(y_pred), len(dataset))
+        
+        out_dir = tempfile.mkdtemp()
+        files = predictor.predict_to_dir(dataset, out_dir)
+        self.assertEqual(len(files), len(dataset))
+        self.assertEqual(os.path.basename(files[0]), 'sub_0.nii.gz')
+        self.assertTrue(all(os.path.exists(file) for file in files))
+        nptest.assert_allclose(ants.image_read(files[1]).numpy(), y_pred[1].numpy())
+        
+        # existing outputs are skipped when resuming
+        mtimes = [os.path.getmtime(file) for file in files]
+        os.remove(files[2])
+        files = predictor.predict_to_dir(dataset, out_dir)
+        self.assertTrue(os.path.exists(files[2]))
+        self.assertEqual(os.path.getmtime(files[0]), mtimes[0])
+
+    def test_tta(self):
+        class IdentityModel:
+            def __init__(self):
+                self.batch_sizes = []
+            def predict(self, x, verbose=0):
+                self.batch_sizes.append(len(x))
+                return x
+        
+        img = ants.image_read(ants.get_data('r16'))
+        dataset = nt.Dataset([img, img], [img, img])
+        
+        model = IdentityModel()
+        predictor = nt.Predictor(model, task='regression',
+                                 tta=[tx.Flip(0), tx.Flip(1), tx.Rotate(10)])
+        y_pred = predictor.predict(dataset)
+        
+        # the original and augmented copies share one model call per record
+        self.assertEqual(model.batch_sizes, [4, 4])
+        self.assertEqual(y_pred[0].shape, img.shape)
+        
+        # up to interpolation, identity predictions are mapped back onto the image
+        diff = np.abs(y_pred[0].numpy() - img.numpy())[60:200,60:200]
+        self.assertTrue(diff.mean() < 0.05 * img.numpy()[60:200,60:200].mean())
+
 if __name__ == '__main__':
     run_tests()
@@ -34,6 +34,18 @@ class TestClass_BaseSampler(unittest.TestCase):
         
         self.assertTrue(len(y_batch)==3)
         nptest.assert_array_equal(y_batch, np.array([0,1,2]))
+    
+    def test_shuffle_multiple_inputs(self):
+        img = ants.image_read(ants.get_data('r16'))
+        x_raw = [[img * i, img * i] for i in range(5)]
+        y_raw = list(range(5))
+        sampler = samplers.BaseSampler(batch_size=5, shuffle=True)
+        
+        x_batch, y_batch = next(iter(sampler(x_raw, y_raw)))
+        self.assertEqual(sorted(y_batch), list(range(5)))
+        for i in range(5):
+            self.assertEqual(x_batch[0][i].max(), img.max() * y_batch[i])
+            self.assertEqual(x_batch[1][i].max(), img.max() * y_batch[i])
 
 class TestClass_PatchSampler(unittest.TestCase):
     def setUp(self):
@@ -89,9 +101,23 @@ class TestClass_SlicePatchSampler(unittest.TestCase):
         self.assertTrue(x_batch[0].dimension==2)
         self.assertTrue(x_batch[0].shape==(32,32))
         
-        # TODO: fix
-        #self.assertTrue(len(y_batch)==4)
-        #self.assertTrue(all(y_batch==0))
+        self.assertTrue(len(y_batch)==4)
+        self.assertTrue(all(y_batch==0))
+        
+    def test_shuffle(self):
+        img = ants.image_read(ants.get_data('mni')).resample_image((4,4,4))
+        x_raw = [img * 0, img * 0 + 1]
+        
+        # labels and segmentations stay paired with their patches
+        for y_raw in [[0, 1], x_raw]:
+            sampler = samplers.SlicePatchSampler(patch_size=(32,32), stride=(32,32),
+                                                 axis=2, batch_size=4, shuffle=True)
+            for x_batch, y_batch in sampler(x_raw, y_raw):
+                for xx, yy in zip(x_batch, y_batch):
+                    if ants.is_image(yy):
+                        nptest.assert_array_equal(xx.numpy(), yy.numpy())
+                    else:
+                        self.assertEqual(xx.mean(), yy)
         
 class TestClass_SliceSampler(unittest.TestCase):
     def setUp(self):
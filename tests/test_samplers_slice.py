@@ -97,6 +97,54 @@ class TestClass_BaseSampler(unittest.TestCase):
         self.assertEqual(xb[1].shape, (15, 10, 10, 1))
         self.assertEqual(yb.shape, (15, 12, 12, 1))
         
+    def test_matches_slice_images(self):
+        from nitrain.samplers import SliceSampler
+        img = ants.image_read(ants.get_data('mni')).resample_image((4,4,4))
+        seg = ants.threshold_image(img, 5000, 1e9)
+        ds = nt.Dataset([img, img * 2], [seg, seg])
+        
+        for axis, channels_first in [(0, False), (1, True), (-1, None)]:
+            loader = nt.Loader(ds, images_per_batch=2, channels_first=channels_first,
+                               sampler=SliceSampler(batch_size=16, axis=axis))
+            xb = np.concatenate([xb for xb, _ in loader])
+            expected = np.stack([s.numpy() for s in create_slices([img, img * 2], axis)])
+            if channels_first is not None:
+                expected = np.expand_dims(expected, 1 if channels_first else -1)
+            nptest.assert_array_equal(xb, expected)
+        
+        # the sampler can still be iterated for slice images
+        x_batch, y_batch = next(iter(SliceSampler(batch_size=4, axis=2)([img], [seg])))
+        self.assertEqual(len(x_batch), 4)
+        self.assertEqual(x_batch[0].shape, img.shape[:2])
+        self.assertEqual(x_batch[0].spacing, img.spacing[:2])
+    
+    def test_min_foreground(self):
+        from nitrain.samplers import SliceSampler
+        seg = np.zeros((8,8,10), dtype='float32')
+        seg[2:6, 2:6, 3:7] = 1
+        seg[0, 0, 8] = 1
+        imgs = [ants.from_numpy(np.random.rand(8,8,10).astype('float32')) for _ in range(2)]
+        ds = nt.Dataset(imgs, [ants.from_numpy(seg)] * 2)
+        
+        sampler = SliceSampler(batch_size=100, axis=-1, min_foreground=0, foreground='outputs')
+        xb, yb = next(iter(nt.Loader(ds, images_per_batch=2, sampler=sampler)))
+        self.assertEqual(len(xb), 10)
+        self.assertTrue(np.all(yb.reshape(10, -1).sum(axis=1) > 0))
+        
+        sampler = SliceSampler(batch_size=100, axis=-1, min_foreground=0.1, foreground='outputs')
+        xb, yb = next(iter(nt.Loader(ds, images_per_batch=2, sampler=sampler)))
+        self.assertEqual(len(xb), 8)
+    
+    def test_labels_per_slice(self):
+        from nitrain.samplers import SliceSampler
+        imgs = [ants.from_numpy(np.full((8,8,5), i, dtype='float32')) for i in range(3)]
+        ds = nt.Dataset(imgs, [0, 1, 2])
+        loader = nt.Loader(ds, images_per_batch=3,
+                           sampler=SliceSampler(batch_size=15, shuffle=True))
+        xb, yb = next(iter(loader))
+        self.assertEqual(yb.shape, (15,))
+        nptest.assert_array_equal(xb[:, 0, 0, 0], yb)
+        
         
 if __name__ == '__main__':
     run_tests()
@@ -11,6 +11,56 @@ import ants
 import nitrain as nt
 
 
+def distributed_train(out_dir):
+    import torch
+    import torch.distributed as dist
+    from nitrain.trainers import TorchTrainer, metrics
+    from nitrain.trainers.torch_utils import shard_loader
+    
+    imgs = [ants.from_numpy(np.full((4,4), i, dtype='float32')) for i in range(10)]
+    dataset = nt.Dataset(imgs, [float(i) for i in range(10)])
+    loader = nt.Loader(dataset, images_per_batch=2, channels_first=True, shuffle=True,
+                       sampler=nt.samplers.BaseSampler(batch_size=2))
+    
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(16, 1), torch.nn.Flatten(0))
+    trainer = TorchTrainer(model=model, loss=torch.nn.MSELoss(),
+                           optimizer=torch.optim.SGD(model.parameters(), 0.001),
+                           metrics=[metrics.MeanSquaredError()])
+    results = trainer.fit(loader, epochs=2, validation=loader)
+    
+    rank = dist.get_rank()
+    shard = np.concatenate(shard_loader(loader)._image_batches())
+    np.savez(os.path.join(out_dir, f'rank{rank}.npz'), shard=shard, results=np.array(results),
+             weight=model[1].weight.detach().numpy())
+
+
+def distributed_resume(out_dir):
+    import torch
+    import torch.distributed as dist
+    from nitrain.trainers import TorchTrainer
+    from nitrain.trainers.checkpoint import load_checkpoint
+    
+    imgs = [ants.from_numpy(np.full((4,4), i, dtype='float32')) for i in range(8)]
+    dataset = nt.Dataset(imgs, [float(i) for i in range(8)])
+    loader = nt.Loader(dataset, images_per_batch=2, channels_first=True, shuffle=True)
+    
+    model = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(16, 1), torch.nn.Flatten(0))
+    trainer = TorchTrainer(model=model, loss=torch.nn.MSELoss(),
+                           optimizer=torch.optim.SGD(model.parameters(), 0.001), metrics=[])
+    path = os.path.join(out_dir, 'checkpoint.pt')
+    trainer.fit(loader, epochs=1, checkpoint=path)
+    dist.barrier()
+    seed = load_checkpoint(path, 'cpu')['loader_seed']
+    
+    # a new shuffle seed would be drawn for the resumed run
+    np.random.seed(dist.get_rank() + 10)
+    trainer.fit(loader, epochs=2, checkpoint=path, resume=True)
+    dist.barrier()
+    resumed_seed = load_checkpoint(path, 'cpu')['loader_seed']
+    np.save(os.path.join(out_dir, f'seeds{dist.get_rank()}.npy'), [seed, resumed_seed])
+
+
 class TestClass_LocalTrainer(unittest.TestCase):
     def setUp(self):
         pass
@@ -123,6 +173,167 @@ class TestClass_LocalTrainer(unittest.TestCase):
         #results = trainer.evaluate(test_loader)
         
         shutil.rmtree(tmpdir.name)
+    def test_multi_input_accumulation(self):
+        import torch
+        from nitrain.trainers import TorchTrainer
+        
+        imgs = [ants.from_numpy(np.random.rand(8,8).astype('float32')) for _ in range(12)]
+        dataset = nt.Dataset([imgs, imgs], list(np.random.rand(12).astype('float32')))
+        loader = nt.Loader(dataset, images_per_batch=4, channels_first=True)
+        
+        class TwoInputModel(torch.nn.Module):
+            def __init__(self):
+                super().__init__()
+                self.linear = torch.nn.Linear(128, 1)
+            def forward(self, a, b):
+                return self.linear(torch.cat([a.flatten(1), b.flatten(1)], 1))[:,0]
+        
+        model = TwoInputModel()
+        weights = model.linear.weight.detach().clone()
+        trainer = TorchTrainer(model=model,
+                               loss=torch.nn.MSELoss(),
+                               optimizer=torch.optim.SGD(model.parameters(), 0.01),
+                               metrics=[],
+                               device='cpu')
+        trainer.fit(loader, epochs=2, accumulation_steps=2, log_every=1)
+        
+        self.assertTrue((model.linear.weight - weights).abs().sum().item() > 0)
+        self.assertTrue(all(p.grad is None for p in model.parameters()))
+
+    def test_checkpoint_resume(self):
+        import random
+        import torch
+        from nitrain import transforms as tx
+        from nitrain.trainers import TorchTrainer
+
+        imgs = [ants.from_numpy(np.random.rand(8,8).astype('float32')) for _ in range(12)]
+        dataset = nt.Dataset(imgs, list(np.random.rand(12).astype('float32')))
+
+        class CountingLoss(torch.nn.Module):
+            def __init__(self, fail_at=None):
+                super().__init__()
+                self.n_calls = 0
+                self.fail_at = fail_at
+            def forward(self, y_pred, y):
+                self.n_calls += 1
+                if self.n_calls == self.fail_at:
+                    raise RuntimeError('crash')
+                return torch.mean((y_pred - y) ** 2)
+
+        def make_trainer(loss):
+            torch.manual_seed(0)
+            model = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Dropout(0.2),
+                                        torch.nn.Linear(64, 1), torch.nn.Flatten(0))
+            return TorchTrainer(model=model, loss=loss,
+                                optimizer=torch.optim.Adam(model.parameters(), 0.01),
+                                metrics=[], device='cpu')
+
+        def make_loader():
+            return nt.Loader(dataset, images_per_batch=4, channels_first=True,
+                             transforms={'inputs': tx.RandomFlip()},
+                             sampler=nt.samplers.BaseSampler(batch_size=2))
+
+        # uninterrupted run
+        np.random.seed(1); random.seed(1)
+        trainer = make_trainer(CountingLoss())
+        trainer.fit(make_loader(), epochs=2)
+
+        # crash in the middle of the second epoch, then resume
+        tmpdir = tempfile.TemporaryDirectory()
+        path = os.path.join(tmpdir.name, 'checkpoint.pt')
+        np.random.seed(1); random.seed(1)
+        crashed = make_trainer(CountingLoss(fail_at=10))
+        with self.assertRaises(RuntimeError):
+            crashed.fit(make_loader(), epochs=2, checkpoint=path, checkpoint_every=1)
+
+        np.random.seed(2); random.seed(2); torch.manual_seed(2)
+        resumed_loss = CountingLoss()
+        resumed = make_trainer(resumed_loss)
+        resumed.fit(make_loader(), epochs=2, checkpoint=path, resume=True)
+
+        # only the batches after the checkpoint were trained on
+        self.assertEqual(resumed_loss.n_calls, 12 - 9)
+        for p1, p2 in zip(trainer.model.parameters(), resumed.model.parameters()):
+            nptest.assert_allclose(p1.detach().numpy(), p2.detach().numpy(), rtol=1e-6)
+
+        # save and load
+        trainer.save(path)
+        resumed.load(path)
+        y_pred = resumed.predict(make_loader())
+        self.assertEqual(tuple(y_pred.shape), (12,))
+        tmpdir.cleanup()
+
+    def test_distributed(self):
+        from nitrain.trainers import launch
+        
+        tmpdir = tempfile.TemporaryDirectory()
+        launch(distributed_train, num_processes=2, args=(tmpdir.name,))
+        
+        r0 = np.load(os.path.join(tmpdir.name, 'rank0.npz'))
+        r1 = np.load(os.path.join(tmpdir.name, 'rank1.npz'))
+        
+        # disjoint shards that cover the dataset
+        self.assertEqual(len(np.intersect1d(r0['shard'], r1['shard'])), 0)
+        self.assertEqual(sorted(np.concatenate([r0['shard'], r1['shard']])), list(range(10)))
+        
+        # identical models and aggregated metrics on every process
+        nptest.assert_allclose(r0['weight'], r1['weight'])
+        nptest.assert_allclose(r0['results'], r1['results'])
+        tmpdir.cleanup()
+
+    def test_distributed_resume(self):
+        from nitrain.trainers import launch
+        
+        tmpdir = tempfile.TemporaryDirectory()
+        launch(distributed_resume, num_processes=2, args=(tmpdir.name,))
+        
+        # the resumed run keeps the shuffle seed of the interrupted run
+        for rank in range(2):
+            seed, resumed_seed = np.load(os.path.join(tmpdir.name, f'seeds{rank}.npy'))
+            self.assertEqual(seed, resumed_seed)
+        tmpdir.cleanup()
+
+class TestClass_Metrics(unittest.TestCase):
+
+    def test_streaming_matches_full(self):
+        import torch
+        from nitrain.trainers import metrics
+        
+        y = (torch.rand(20, 1, 8, 8) > 0.5).float()
+        y_pred = torch.rand(20, 1, 8, 8)
+        
+        for metric in [metrics.Dice(), metrics.MeanSquaredError(),
+                       metrics.MeanAbsoluteError(), metrics.Accuracy()]:
+            full = metric(y, y_pred)
+            metric.reset()
+            for i in range(0, 20, 6):
+                metric.update(y[i:i+6], y_pred[i:i+6])
+            self.assertAlmostEqual(metric.result(), full, places=5)
+
+    def test_accuracy_classes(self):
+        import torch
+        from nitrain.trainers import metrics
+        
+        y = torch.tensor([0, 1, 2, 1])
+        y_pred = torch.eye(3)[[0, 1, 1, 1]]
+        self.assertEqual(metrics.Accuracy()(y, y_pred), 0.75)
+
+    def test_evaluate(self):
+        import torch
+        from nitrain.trainers import metrics
+        from nitrain.trainers.torch_utils import torch_model_evaluate
+        
+        imgs = [ants.from_numpy((np.random.rand(8,8) > 0.5).astype('float32')) for _ in range(12)]
+        loader = nt.Loader(nt.Dataset(imgs, imgs), images_per_batch=5, channels_first=True)
+        
+        def mse_fn(y, y_pred):
+            return ((y - y_pred)**2).mean().item()
+        
+        results = torch_model_evaluate(torch.nn.Identity(),
+                                       [metrics.Dice(), metrics.MeanSquaredError(), mse_fn],
+                                       'cpu', loader)
+        self.assertEqual(results, [1.0, 0.0, 0.0])
+
 
 if __name__ == '__main__':
     run_tests()
\ No newline at end of file
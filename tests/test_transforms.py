@@ -208,6 +208,11 @@ class TestClass_MathTransforms(unittest.TestCase):
         img2d_tx = my_tx(self.img_2d)
         img3d_tx = my_tx(self.img_3d)
 
+    def test_no_double_output(self):
+        for my_tx in [tx.Abs(), tx.Log(), tx.Sqrt(), tx.Power(2)]:
+            img2d_tx = my_tx(self.img_2d)
+            self.assertEqual(img2d_tx.pixeltype, 'float')
+
 class TestClass_ShapeTransforms(unittest.TestCase):
     
     def setUp(self):
@@ -330,6 +335,31 @@ class TestClass_SpatialTransforms(unittest.TestCase):
         mytx = tx.Flip()
         img2 = mytx(img)
 
+    def test_inverse(self):
+        img = ants.image_read(ants.get_data('r16'))
+        for mytx in [tx.Flip(0), tx.Rotate(10), tx.Translate((5, 3))]:
+            img2 = mytx(img)
+            img3 = mytx.inverse()(img2)
+            self.assertEqual(img3.shape, img.shape)
+            # up to interpolation, the image is mapped back onto itself
+            diff = np.abs(img3.numpy() - img.numpy())[60:200,60:200]
+            diff_tx = np.abs(img2.numpy() - img.numpy())[60:200,60:200]
+            self.assertTrue(diff.mean() < 0.5 * diff_tx.mean())
+
+    def test_threads(self):
+        from concurrent.futures import ThreadPoolExecutor
+        imgs = [ants.image_read(ants.get_data(name)) for name in ['r16', 'r27', 'r30', 'r62']]
+        for mytx in [tx.Rotate(10), tx.Shear((0, 10)), tx.Zoom(0.9), tx.Translate((5, 3)), tx.Flip(0)]:
+            # calls do not modify the transform object
+            state = dict(vars(mytx))
+            serial = [mytx(img).numpy() for img in imgs * 4]
+            self.assertEqual(list(vars(mytx)), list(state))
+            self.assertTrue(all(vars(mytx)[k] is v for k, v in state.items()))
+            with ThreadPoolExecutor(4) as executor:
+                threaded = list(executor.map(lambda img: mytx(img).numpy(), imgs * 4))
+            for a, b in zip(serial, threaded):
+                nptest.assert_allclose(a, b, atol=1e-2)
+
     def test_Translate(self):
         img2d = ants.image_read(ants.get_data('r16'))
         img3d = ants.image_read(ants.get_data('mni'))
@@ -372,6 +402,44 @@ class TestLabels(unittest.TestCase):
 
         img2d_tx = my_tx(img2d)
         img3d_tx = my_tx(img3d)
+        self.assertEqual(img2d_tx.shape, (100,100))
+        self.assertEqual(img2d_tx.components, 3)
+        self.assertEqual(img3d_tx.numpy().shape, (100,100,100,3))
+        self.assertTrue(np.array_equal(img3d_tx.numpy()[...,1], img3d.numpy() == 2))
+
+    def test_LabelsToChannels_labels(self):
+        img2d = ants.from_numpy(np.zeros((100,100)))
+        img2d[:20,:] = 1
+        img2d[20:40,:] = 2
+        img2d[40:60,:] = 3
+        
+        my_tx = tx.LabelsToChannels(labels=[3,1,5], keep_values=True)
+        img2d_tx = my_tx(img2d)
+        self.assertEqual(img2d_tx.components, 3)
+        self.assertEqual(img2d_tx.numpy()[...,0].sum(), 20*100*3)
+        self.assertEqual(img2d_tx.numpy()[...,2].sum(), 0)
+        
+        my_tx = tx.LabelsToChannels(labels=[3,1,5], as_index=True)
+        img2d_tx = my_tx(img2d)
+        self.assertEqual(img2d_tx.components, 1)
+        self.assertEqual(img2d_tx.pixeltype, 'unsigned char')
+        self.assertEqual(img2d_tx[0,0], 2)
+        self.assertEqual(img2d_tx[50,0], 1)
+        self.assertEqual(img2d_tx[30,0], 0)
+
+    def test_LabelsToChannels_background(self):
+        img2d = ants.from_numpy(np.zeros((10,10)))
+        
+        for my_tx in [tx.LabelsToChannels(), tx.LabelsToChannels(labels=[])]:
+            img2d_tx = my_tx(img2d)
+            self.assertEqual(img2d_tx.components, 1)
+            self.assertEqual(img2d_tx.numpy().shape, (10,10,1))
+            self.assertEqual(img2d_tx.numpy().sum(), 0)
+        
+        for my_tx in [tx.LabelsToChannels(as_index=True), tx.LabelsToChannels(labels=[], as_index=True)]:
+            img2d_tx = my_tx(img2d)
+            self.assertEqual(img2d_tx.shape, (10,10))
+            self.assertEqual(img2d_tx.numpy().sum(), 0)
     
 class TestErrors(unittest.TestCase):
     